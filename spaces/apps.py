@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class DjangoSpacesConfig(AppConfig):
     name = 'spaces'
+
+    def ready(self):
+        from . import signals  # noqa: connects the signal receivers
+        signals.connect_plugin_receivers()
+        from .registry import get_snapshot
+        get_snapshot()  # all plugins defined in models are registered now
+        signals.connect_search_receivers()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from guardian.utils import get_group_obj_perms_model, get_user_obj_perms_model
+
+from .cache import bump_generation, get_generation, get_spaces_cache
+from .instrumentation import count
+from .models import Space
+
+SPACE_VERSION_KEY = 'spaces:perms:space:%s'
+USER_VERSION_KEY = 'spaces:perms:user:%s'
+PERMISSIONS_KEY = 'spaces:perms:%s:%s:%s:%s'
+MEMO_ATTR = '_space_permissions'
+
+
+def load_space_permissions(user, space):
+    """
+    Fetch the codenames of all object permissions the user has for the
+    space, directly or through one of its groups, with a single query.
+    """
+    ctype = ContentType.objects.get_for_model(Space)
+    filters = {'content_type': ctype, 'object_pk': str(space.pk)}
+    user_perms = get_user_obj_perms_model().objects.filter(
+        user=user, **filters).values_list('permission__codename', flat=True)
+    group_perms = get_group_obj_perms_model().objects.filter(
+        group__user=user, **filters).values_list('permission__codename', flat=True)
+    return frozenset(user_perms.union(group_perms))
+
+
+def get_space_permissions(user, space):
+    """
+    Return the codenames of the user's object permissions for the space.
+
+    The result is memoized on the user object for the rest of the request
+    and cached in the Django cache, tagged with one version counter for the
+    space and one for the user. Permission rows of the space and group
+    memberships of the user bump them (see spaces.signals).
+    """
+    memo = user.__dict__.setdefault(MEMO_ATTR, {})
+    try:
+        perms = memo[space.pk]
+    except KeyError:
+        pass
+    else:
+        count('permission_hits')
+        return perms
+    cache = get_spaces_cache()
+    key = PERMISSIONS_KEY % (
+        space.pk, get_generation(cache, SPACE_VERSION_KEY % space.pk),
+        user.pk, get_generation(cache, USER_VERSION_KEY % user.pk))
+    perms = cache.get(key)
+    if perms is None:
+        count('permission_misses')
+        perms = load_space_permissions(user, space)
+        cache.set(key, perms, getattr(settings, 'SPACES_PERMISSION_CACHE_TIMEOUT', 3600))
+    else:
+        count('permission_hits')
+    memo[space.pk] = perms
+    return perms
+
+
+def invalidate_space_permissions(space_pk):
+    bump_generation(get_spaces_cache(), SPACE_VERSION_KEY % space_pk)
+
+
+def invalidate_user_permissions(user_pk, user=None):
+    bump_generation(get_spaces_cache(), USER_VERSION_KEY % user_pk)
+    if user is not None:
+        user.__dict__.pop(MEMO_ATTR, None)
+
+
+class SpacePermissionBackend(object):
+    """
+    Answers object permission checks on Space instances from the cached
+    result of get_space_permissions(), so permission_required, SpacesMixin
+    and templates don't query guardian's tables on every check.
+
+    Add it in front of guardian's backend:
+
+        AUTHENTICATION_BACKENDS = (
+            'django.contrib.auth.backends.ModelBackend',
+            'spaces.backends.SpacePermissionBackend',
+            'guardian.backends.ObjectPermissionBackend',
+        )
+
+    For spaces it has the final say on behalf of guardian: a permission
+    the user lacks is denied right away instead of asking guardian again.
+    Checks for anonymous users and other objects are left to the other
+    backends.
+    """
+
+    def authenticate(self, request, **credentials):
+        return None
+
+    def has_perm(self, user_obj, perm, obj=None):
+        if not isinstance(obj, Space) or obj.pk is None:
+            return False
+        if not user_obj.is_authenticated or not user_obj.is_active:
+            return False
+        if '.' in perm:
+            app_label, perm = perm.split('.', 1)
+            if app_label != Space._meta.app_label:
+                return False
+        if user_obj.is_superuser:
+            return True
+        if perm in get_space_permissions(user_obj, obj):
+            return True
+        raise PermissionDenied
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for django-spaces. Run them with
+
+    python manage.py benchspaces [name ...]
+
+Each benchmark runs inside a transaction that is rolled back afterwards,
+so the database is left untouched. They run against the default database,
+so point DATABASES at e.g. a local PostgreSQL server to measure that.
+
+    python manage.py benchspaces --save-baseline baseline.json
+    python manage.py benchspaces --compare baseline.json --threshold 0.2
+
+stores the results and later fails if any latency, query or memory figure
+got worse than the stored one by more than the threshold (20%). Without a
+file name both use DEFAULT_BASELINE, the baseline shipped with
+django-spaces (measured on SQLite with the default sizes). Latencies
+depend on the machine, so they are only compared with a baseline of your
+own; the shipped one checks query counts and memory only.
+"""
+import copy
+import json
+import os
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import timedelta
+from io import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.urls import clear_url_caches, get_urlconf, path, resolve, reverse, set_urlconf
+from django.utils import timezone
+
+from . import util
+from .cache import bump_plugin_version, get_resolution_cache
+from .instrumentation import RequestMetrics
+from .middleware import SpacesMiddleware
+from .models import Space, SpacePlugin, SpacePluginStates, SpaceRole
+from .util import chunked, percentile
+from .urls import space_patterns
+
+BENCHMARK_URLCONF = 'spaces.benchmarks'
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+
+
+def benchmark_view(request, *args, **kwargs):
+    return HttpResponse()
+
+
+urlpatterns = space_patterns(
+    path('benchmark/<int:number>/', benchmark_view, name='spaces-benchmark'),
+)
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(func):
+    """Register a benchmark function under its name minus the bench_ prefix."""
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def measure(func, repeat):
+    """
+    Call func(i) for i in range(repeat), recording wall time and number of
+    queries of every call.
+    """
+    timings = []
+    queries = []
+    for i in range(repeat):
+        # counted by an execute wrapper, as connection.queries_log is
+        # capped and stops growing with big datasets
+        metrics = RequestMetrics()
+        with connection.execute_wrapper(metrics):
+            start = time.perf_counter()
+            func(i)
+            timings.append(time.perf_counter() - start)
+        queries.append(metrics.counters['queries'])
+    return OrderedDict((
+        ('calls', repeat),
+        ('p50_ms', percentile(timings, 50) * 1000),
+        ('p99_ms', percentile(timings, 99) * 1000),
+        ('total_s', sum(timings)),
+        ('queries_mean', sum(queries) / float(repeat)),
+        ('queries_max', max(queries)),
+    ))
+
+
+def measure_memory(func, repeat):
+    """
+    Call func(i) for i in range(repeat) and return the growth of allocated
+    memory in KiB.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(repeat):
+            func(i)
+        return (tracemalloc.get_traced_memory()[0] - before) / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_user(username='spaces-benchmark'):
+    return User.objects.get_or_create(username=username)[0]
+
+
+def run_benchmark(name, size=None):
+    """
+    Run a single benchmark and return its results. ``size`` overrides the
+    benchmark's default dataset size.
+    """
+    func = BENCHMARKS[name]
+    kwargs = {} if size is None else {'size': size}
+    try:
+        with transaction.atomic():
+            result = func(**kwargs)
+            transaction.set_rollback(True)
+    finally:
+        # nothing cached for the rolled back data may survive
+        get_resolution_cache().invalidate()
+        bump_plugin_version()
+    return result
+
+
+def generate_dataset(size, users=None, plugins_per_space=1, batch_size=1000):
+    """
+    Create ``size`` spaces named "Benchmark <i>" (slug benchmark-<i>) with
+    their roles, ``plugins_per_space`` active SpacePlugin rows each and
+    ``users`` users (defaults to size). User i is a member of space i, every
+    tenth user an admin as well.
+    Returns the lists of spaces and users.
+    """
+    users = size if users is None else users
+    owner = benchmark_user()
+    spaces = Space.objects.bulk_provision(
+        [('Benchmark %d' % i, owner) for i in range(size)], batch_size=batch_size)
+    SpacePlugin.objects.bulk_create(
+        [SpacePlugin(space=space, active=True)
+         for space in spaces for j in range(plugins_per_space)],
+        batch_size=batch_size)
+
+    usernames = ['benchmark-user-%d' % i for i in range(users)]
+    User.objects.bulk_create(
+        [User(username=username) for username in usernames], batch_size=batch_size)
+    user_list = []
+    for chunk in chunked(usernames, batch_size):
+        user_list.extend(User.objects.filter(username__in=chunk).order_by('pk'))
+
+    groups = {}
+    for space_id, role, group_id in SpaceRole.objects.filter(
+            space__in=[space.pk for space in spaces[:users]]).values_list(
+            'space_id', 'role', 'group_id').iterator():
+        groups[space_id, role] = group_id
+    memberships = []
+    for i, user in enumerate(user_list):
+        space = spaces[i % size]
+        memberships.append(User.groups.through(
+            user_id=user.pk, group_id=groups[space.pk, SpaceRole.MEMBERS]))
+        if i % 10 == 0:
+            memberships.append(User.groups.through(
+                user_id=user.pk, group_id=groups[space.pk, SpaceRole.ADMINS]))
+    User.groups.through.objects.bulk_create(memberships, batch_size=batch_size)
+    return spaces, user_list
+
+
+def compare_results(results, baseline, threshold=0.2, slack_ms=0.1, slack_kb=64,
+                    latencies=True):
+    """
+    Compare benchmark results ({name: {metric: value}}) with a baseline of
+    the same shape. Returns a list of (name, metric, baseline value, value)
+    for every latency, query or memory figure that got worse by more than
+    threshold (a fraction of the baseline value). Latencies within slack_ms
+    and memory within slack_kb of the baseline never count as regression;
+    with latencies=False they aren't compared at all.
+    """
+    regressions = []
+    for name, result in results.items():
+        for metric, value in result.items():
+            if not ((latencies and metric.endswith('_ms')) or metric.endswith('_kb')
+                    or metric.startswith('queries') or metric.startswith('warm_queries')):
+                continue
+            try:
+                old = baseline[name][metric]
+            except KeyError:
+                continue
+            limit = old * (1 + threshold)
+            if metric.endswith('_ms'):
+                limit = max(limit, old + slack_ms)
+            elif metric.endswith('_kb'):
+                limit = max(limit, old + slack_kb)
+            if value > limit:
+                regressions.append((name, metric, old, value))
+    return regressions
+
+
+def save_results(results, filename):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+@benchmark
+def bench_same_name_slugs(size=1000):
+    """Create ``size`` spaces that all share the same name."""
+    owner = benchmark_user()
+    return measure(
+        lambda i: Space.objects.create(name='Project', created_by=owner), size)
+
+
+def in_distinct_spaces(func):
+    """
+    Wrap func(i) to run with space "benchmark-<i>" activated, starting with
+    empty URL resolver caches.
+    """
+    clear_url_caches()
+
+    def wrapper(i):
+        with util.override('benchmark-%d' % i):
+            func(i)
+    return wrapper
+
+
+def large_caches(size, entries_per_call=10):
+    """
+    Override CACHES with local memory caches (and size the local level of
+    the resolution cache) big enough for ``size`` calls, so warm runs
+    measure cached lookups rather than evictions.
+    """
+    caches = {}
+    for alias in settings.CACHES:
+        caches[alias] = {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'spaces-benchmark-%s' % alias,
+            'OPTIONS': {'MAX_ENTRIES': size * entries_per_call + 1000},
+        }
+    resolution = dict(getattr(settings, 'SPACES_RESOLUTION_CACHE', {}))
+    resolution['OPTIONS'] = dict(resolution.get('OPTIONS', {}), local_size=size + 1000)
+    return override_settings(CACHES=caches, SPACES_RESOLUTION_CACHE=resolution)
+
+
+def measure_cold_and_warm(func, repeat):
+    """
+    Measure func twice: first with empty caches, then again with everything
+    cached by the first run. Figures of the second run get a "warm_" prefix.
+    """
+    result = measure(func, repeat)
+    for key, value in measure(func, repeat).items():
+        if key != 'calls':
+            result['warm_' + key] = value
+    return result
+
+
+def url_benchmark(func, size):
+    memory = measure_memory(in_distinct_spaces(func), size)
+    result = measure(in_distinct_spaces(func), size)
+    result['memory_kb'] = memory
+    return result
+
+
+@benchmark
+def bench_resolve_distinct_spaces(size=10000):
+    """Resolve a space URL in ``size`` different spaces."""
+    return url_benchmark(
+        lambda i: resolve('/benchmark-%d/benchmark/%d/' % (i, i), BENCHMARK_URLCONF),
+        size)
+
+
+@benchmark
+def bench_reverse_distinct_spaces(size=10000):
+    """Reverse a space URL in ``size`` different spaces."""
+    return url_benchmark(
+        lambda i: reverse('spaces-benchmark', BENCHMARK_URLCONF, args=[i]),
+        size)
+
+
+@benchmark
+def bench_middleware_resolution(size=10000):
+    """
+    Resolve requests to ``size`` distinct spaces in SpacesMiddleware.
+    """
+    generate_dataset(size, users=0)
+    get_resolution_cache().invalidate()
+    middleware = SpacesMiddleware(lambda request: HttpResponse())
+    requests = [RequestFactory().get('/benchmark-%d/' % i) for i in range(size)]
+    with large_caches(size):
+        return measure_cold_and_warm(lambda i: middleware.resolve_space(requests[i]), size)
+
+
+@benchmark
+def bench_space_url(size=10000):
+    """Render {% space_url %} for ``size`` distinct spaces."""
+    spaces, users = generate_dataset(size, users=0)
+    template = Template(
+        '{% load space_tags %}{% space_url space "spaces-benchmark" number %}')
+    urlconf = get_urlconf()
+    set_urlconf(BENCHMARK_URLCONF)
+    clear_url_caches()
+    try:
+        return measure_cold_and_warm(
+            lambda i: template.render(Context({'space': spaces[i], 'number': i})), size)
+    finally:
+        set_urlconf(urlconf)
+        clear_url_caches()
+
+
+@benchmark
+def bench_permission_checks(size=10000):
+    """
+    Check the access_space permission of ``size`` users in their spaces,
+    with SpacePermissionBackend in front of guardian's backend.
+    """
+    spaces, users = generate_dataset(size)
+
+    def check(i):
+        # a fresh user object per call, as in a new request
+        user = User(pk=users[i].pk, username=users[i].username, is_active=True)
+        user.has_perm('spaces.access_space', spaces[i])
+
+    with large_caches(size), override_settings(AUTHENTICATION_BACKENDS=[
+            'django.contrib.auth.backends.ModelBackend',
+            'spaces.backends.SpacePermissionBackend',
+            'guardian.backends.ObjectPermissionBackend']):
+        return measure_cold_and_warm(check, size)
+
+
+@benchmark
+def bench_plugin_nav(size=1000):
+    """Render {% space_plugin_nav %} for ``size`` distinct spaces."""
+    spaces, users = generate_dataset(size, plugins_per_space=3)
+    template = Template('{% load space_tags %}{% space_plugin_nav space %}')
+
+    def render(i):
+        # plugin states are memoized per space object, i.e. per request
+        space = copy.copy(spaces[i])
+        SpacePluginStates.clear(space)
+        template.render(Context({'space': space, 'user': users[i]}))
+
+    return measure_cold_and_warm(render, size)
+
+
+@benchmark
+def bench_close_expired_spaces(size=10000):
+    """Archive ``size`` expired spaces with closeexpiredspaces."""
+    spaces, users = generate_dataset(size, users=0)
+    Space.objects.filter(pk__in=[space.pk for space in spaces]).update(
+        expires=timezone.now() - timedelta(days=1))
+    result = measure(
+        lambda i: call_command('closeexpiredspaces', stdout=StringIO()), 1)
+    result['spaces'] = size
+    return result
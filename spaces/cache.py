@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Caching helpers for django-spaces.
+
+The central piece is the space resolution cache used by SpacesMiddleware to
+turn the slug found in the URL into a Space instance without hitting the
+database on every request. Other cached data is invalidated through
+generation counters kept in the cache itself, including the per-space
+namespace plugins can cache their own data in (space_cache_get_or_set(),
+@space_cached).
+"""
+import copy
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+from django.db.models import Model
+from django.http import HttpRequest
+from django.utils.cache import has_vary_header
+from django.utils.module_loading import import_string
+
+from .instrumentation import count
+from .util import get_space
+
+
+class LocalLRUCache(object):
+    """
+    Small thread-safe per-process cache. Holds at most ``maxsize`` entries,
+    evicting the least recently used one first. Entries expire after ``ttl``
+    seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def get_generation(cache, key):
+    """
+    Return the counter stored under key, starting a new one if necessary.
+    """
+    generation = cache.get(key)
+    if generation is None:
+        # Start from a time based value, so an evicted counter never
+        # falls back to a generation that has already been used.
+        cache.add(key, int(time.time() * 1000), None)
+        generation = cache.get(key, 0)
+    return generation
+
+
+def bump_generation(cache, key):
+    """
+    Increment the counter stored under key, invalidating everything
+    tagged with its previous value.
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        # counter has been evicted, next read starts a new one
+        pass
+
+
+def get_spaces_cache():
+    """Return the cache configured by SPACES_CACHE_ALIAS."""
+    return caches[getattr(settings, 'SPACES_CACHE_ALIAS', 'default')]
+
+
+class DummySpaceResolutionCache(object):
+    """
+    Resolution "cache" that always asks the database. Configure it as
+    backend to switch caching off.
+    """
+
+    def __init__(self, **options):
+        pass
+
+    def load(self, slug):
+        from .models import Space
+        return Space.objects.filter(slug=slug).first()
+
+    def get_space(self, slug):
+        """Return the Space with the given slug or None."""
+        count('resolution_misses')
+        return self.load(slug)
+
+    def invalidate(self):
+        """Forget everything resolved so far."""
+        pass
+
+
+class SpaceResolutionCache(DummySpaceResolutionCache):
+    """
+    Two-level cache for slug -> Space lookups.
+
+    The first level is a per-process LRU, the second one the configured
+    Django cache, shared by all workers. Entries of both levels are tagged
+    with a generation counter stored in the shared cache. Saving or deleting
+    any Space bumps that counter, which invalidates the entries of every
+    worker at once, so renamed or archived spaces show up immediately.
+
+    Slugs without a Space are cached as well, as the middleware sees
+    almost every path (e.g. /static/ or /favicon.ico) as a possible slug.
+    """
+    generation_key = 'spaces:resolution:generation'
+    key_template = 'spaces:resolution:%s:%s'
+    not_found = '<no space>'
+
+    def __init__(self, alias='default', timeout=300, local_size=1024,
+                 local_ttl=60, **options):
+        self.alias = alias
+        self.timeout = timeout
+        self.local = LocalLRUCache(maxsize=local_size, ttl=local_ttl)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def generation(self):
+        return get_generation(self.cache, self.generation_key)
+
+    def get_space(self, slug):
+        generation = self.generation()
+        entry = self.local.get(slug)
+        if entry is not None and entry[0] == generation:
+            count('resolution_hits')
+            return self.copy(entry[1])
+
+        key = self.key_template % (generation, slug)
+        space = self.cache.get(key)
+        if space is None:
+            count('resolution_misses')
+            space = self.load(slug)
+            value = self.not_found if space is None else space
+            self.cache.set(key, value, self.timeout)
+        else:
+            count('resolution_hits')
+            if isinstance(space, str):
+                space = None
+        self.local.set(slug, (generation, space))
+        return self.copy(space)
+
+    def copy(self, space):
+        """
+        Every request gets its own copy of the cached instance, so changes
+        and memoized data (like plugin states) don't leak between requests.
+        """
+        return copy.copy(space) if space is not None else None
+
+    def invalidate(self):
+        self.local.clear()
+        bump_generation(self.cache, self.generation_key)
+
+
+_resolution_cache = None
+
+
+def get_resolution_cache():
+    """
+    Return the configured space resolution cache.
+
+    Configured via the SPACES_RESOLUTION_CACHE setting, e.g.:
+
+        SPACES_RESOLUTION_CACHE = {
+            'BACKEND': 'spaces.cache.SpaceResolutionCache',
+            'OPTIONS': {'alias': 'default', 'timeout': 300},
+        }
+    """
+    global _resolution_cache
+    if _resolution_cache is None:
+        config = getattr(settings, 'SPACES_RESOLUTION_CACHE', {})
+        backend = import_string(
+            config.get('BACKEND', 'spaces.cache.SpaceResolutionCache'))
+        _resolution_cache = backend(**config.get('OPTIONS', {}))
+    return _resolution_cache
+
+
+def reset_resolution_cache():
+    """Drop the configured cache instance, e.g. after a settings change."""
+    global _resolution_cache
+    _resolution_cache = None
+
+
+def invalidate_spaces():
+    """
+    Invalidate resolved spaces now and again once the current transaction
+    commits, so no worker can cache the state from before the commit.
+    """
+    resolution_cache = get_resolution_cache()
+    resolution_cache.invalidate()
+    transaction.on_commit(resolution_cache.invalidate)
+
+
+PLUGIN_VERSION_KEY = 'spaces:plugins:version'
+
+
+def get_plugin_version(space_id):
+    """
+    Return the version of the plugin states of the given space. Includes
+    the global version bumped when plugins are enabled or disabled.
+    """
+    cache = get_spaces_cache()
+    return '%s.%s' % (
+        get_generation(cache, PLUGIN_VERSION_KEY),
+        get_generation(cache, '%s:%s' % (PLUGIN_VERSION_KEY, space_id)))
+
+
+def bump_plugin_version(space_id=None):
+    """
+    Invalidate everything cached for the plugin states of the given space,
+    or of all spaces if no space is given.
+    """
+    key = PLUGIN_VERSION_KEY
+    if space_id is not None:
+        key = '%s:%s' % (PLUGIN_VERSION_KEY, space_id)
+    bump_generation(get_spaces_cache(), key)
+
+
+# Per-space namespace for data cached by plugins and applications. Every key
+# contains the current generation of its space (and of all spaces), so
+# bumping a counter drops everything cached for a space at once, without
+# knowing or scanning the keys. Old entries just expire.
+
+SPACE_DATA_VERSION_KEY = 'spaces:data:version'
+
+
+def get_space_id(space):
+    """Return the pk of a Space, pk or slug (resolved through the cache)."""
+    if isinstance(space, str):
+        resolved = get_resolution_cache().get_space(space)
+        return resolved.pk if resolved is not None else None
+    return getattr(space, 'pk', space)
+
+
+def get_space_cache_version(space):
+    """Return the version of everything cached for the space."""
+    cache = get_spaces_cache()
+    return '%s.%s' % (
+        get_generation(cache, SPACE_DATA_VERSION_KEY),
+        get_generation(cache, '%s:%s' % (SPACE_DATA_VERSION_KEY, get_space_id(space))))
+
+
+def invalidate_space_cache(space=None):
+    """
+    Drop everything cached for the space (a Space, pk or slug), or for all
+    spaces if no space is given.
+    """
+    key = SPACE_DATA_VERSION_KEY
+    if space is not None:
+        key = '%s:%s' % (SPACE_DATA_VERSION_KEY, get_space_id(space))
+    bump_generation(get_spaces_cache(), key)
+
+
+def space_cache_key(space, key):
+    """Return the actual cache key for key in the namespace of the space."""
+    return 'spaces:data:%s:%s:%s' % (get_space_id(space), get_space_cache_version(space), key)
+
+
+def space_cache_get(space, key, default=None):
+    return get_spaces_cache().get(space_cache_key(space, key), default)
+
+
+def space_cache_set(space, key, value, timeout=DEFAULT_TIMEOUT):
+    get_spaces_cache().set(space_cache_key(space, key), value, timeout)
+
+
+def space_cache_delete(space, key):
+    get_spaces_cache().delete(space_cache_key(space, key))
+
+
+_missing = object()
+
+
+def space_cache_get_or_set(space, key, default, timeout=DEFAULT_TIMEOUT):
+    """
+    Return the value cached under key for the space. If there is none,
+    cache default (or what default returns, if it is callable) and return
+    it.
+    """
+    full_key = space_cache_key(space, key)
+    cache = get_spaces_cache()
+    value = cache.get(full_key, _missing)
+    if value is _missing:
+        value = default() if callable(default) else default
+        cache.set(full_key, value, timeout)
+    return value
+
+
+def _key_value(value):
+    """
+    Model instances repr to their __str__, which different objects can
+    share, so they are keyed by model and pk instead.
+    """
+    if isinstance(value, Model):
+        return (value._meta.label, value.pk)
+    if isinstance(value, (set, frozenset)):
+        return ('set', sorted((_key_value(item) for item in value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, [_key_value(item) for item in value])
+    if isinstance(value, dict):
+        return ('dict', sorted(((key, _key_value(item)) for key, item in value.items()), key=repr))
+    return value
+
+
+def _call_key(func, args, kwargs):
+    arguments = repr((_key_value(args), sorted(
+        (name, _key_value(value)) for name, value in kwargs.items()))).encode('utf-8')
+    return '%s.%s:%s' % (func.__module__, func.__qualname__,
+                         hashlib.md5(arguments).hexdigest())
+
+
+def space_cached(timeout=DEFAULT_TIMEOUT, per_user=True):
+    """
+    Cache the results of a function or view in the namespace of a space.
+
+    Views are cached for request.SPACE, per full path and - unless per_user
+    is False - per user. Only successful GET and HEAD requests are cached,
+    and no responses that set cookies; neither those varying on Cookie or
+    using a CSRF token if they are shared, i.e. with per_user=False or for
+    anonymous users.
+
+    Functions are cached per arguments (by their repr, model instances by
+    model and pk) for the space given as first argument or as "space"
+    keyword argument, or else for the active space. Without any space,
+    they are just called.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            from .models import Space
+            if args and isinstance(args[0], HttpRequest):
+                return cached_view(func, args[0], args[1:], kwargs)
+            space = kwargs.get('space')
+            if space is None and args and isinstance(args[0], Space):
+                space = args[0]
+            if space is None:
+                space = get_space()
+            if space is None:
+                return func(*args, **kwargs)
+            return space_cache_get_or_set(
+                space, _call_key(func, args, kwargs), lambda: func(*args, **kwargs), timeout)
+
+        def cached_view(view, request, args, kwargs):
+            space = getattr(request, 'SPACE', None)
+            if space is None or request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            user = getattr(request, 'user', None)
+            user_id = user.pk if per_user and user is not None and user.is_authenticated else ''
+            key = 'view:%s.%s:%s:%s' % (
+                view.__module__, view.__qualname__, user_id,
+                hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest())
+            response = space_cache_get(space, key)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming:
+                    if hasattr(response, 'render') and callable(response.render):
+                        response.render()
+                    if is_shareable(request, response, user_id):
+                        space_cache_set(space, key, response, timeout)
+            return response
+
+        def is_shareable(request, response, user_id):
+            """
+            Responses setting cookies are never replayed. Responses cached
+            for all users (or all anonymous ones) must not depend on the
+            cookies of one user or contain a CSRF token (which
+            CSRF_COOKIE_USED tells).
+            """
+            if response.cookies:
+                return False
+            if user_id != '':
+                return True
+            return not (request.META.get('CSRF_COOKIE_USED')
+                        or has_vary_header(response, 'Cookie'))
+
+        return wrapper
+    return decorator
@@ -3,7 +3,10 @@ from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.core.exceptions import PermissionDenied
 from django.utils.functional import wraps
 from guardian.exceptions import GuardianError
-from guardian.utils import get_403_or_None
+try:
+    from guardian.utils import get_40x_or_None as get_403_or_None
+except ImportError:  # django-guardian < 1.4
+    from guardian.utils import get_403_or_None
 from .util import is_space_admin
 
 
@@ -87,11 +90,21 @@ def space_admin_required(func):
     """
     def _decorator(self, *args, **kwargs):
         if self.user and self.user.is_authenticated:
-            is_allowed = is_space_admin(
-                self.user, 
-                self.SPACE
-            )
+            roles = getattr(self, 'SPACE_ROLES', None)
+            if roles is not None:
+                is_allowed = roles.is_admin(self.SPACE)
+            else:
+                is_allowed = is_space_admin(self.user, self.SPACE)
             if is_allowed:
                 return func(self, *args, **kwargs)
         raise PermissionDenied
-    return _decorator
\ No newline at end of file
+    return _decorator
+
+
+def space_writable(view_func):
+    """
+    Marks a view as allowed to handle unsafe requests (POST etc.) in
+    read-only spaces, see SpacesMiddleware.
+    """
+    view_func.space_writable = True
+    return view_func
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Deleting big spaces in small steps.
+
+Space.delete() makes Django collect everything depending on the space
+(plugin rows and all plugin data) in memory and delete it in one
+transaction. The functions here delete the same data chunk by chunk
+instead, each chunk in its own short transaction, and also remove the
+role groups and permission rows the space leaves behind otherwise.
+
+Nothing is remembered between runs: every step only looks at what is
+left, so an interrupted deletion just continues when run again, e.g. with
+the deletespaces command. Plugin data is deleted in the database the space
+is placed in (see spaces.routers).
+"""
+from django.contrib.auth.models import Group
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+
+from .cache import invalidate_spaces
+from .models import SearchTerm, Space, SpacePlugin, SpacePluginStates
+from .roles import delete_roles
+from .routers import delete_space_row, get_space_database
+from .signals import spaces_archived
+
+
+def delete_in_chunks(queryset, batch_size=1000, progress=None, raw=False):
+    """
+    Delete the objects of queryset, at most batch_size per transaction.
+    Calls progress(model label, deleted so far) after every chunk. Returns
+    the number of deleted objects (not counting cascades).
+
+    With raw=True, chunks are deleted with a plain DELETE, skipping signals
+    and cascades; only for rows nothing depends on.
+    """
+    model = queryset.model
+    label = model._meta.label
+    deleted = 0
+    while True:
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        chunk = model._base_manager.db_manager(queryset.db).filter(pk__in=pks)
+        with transaction.atomic(using=chunk.db):
+            if raw:
+                chunk._raw_delete(chunk.db)
+            else:
+                chunk.delete()
+        deleted += len(pks)
+        if progress is not None:
+            progress(label, deleted)
+
+
+def plugin_data_relations(plugin_model):
+    """
+    Return (model, field name) for every foreign key cascading from the
+    plugin model, i.e. where its plugin data is.
+    """
+    relations = []
+    for rel in plugin_model._meta.related_objects:
+        if rel.many_to_many or rel.on_delete is not models.CASCADE:
+            continue
+        if rel.parent_link:
+            continue  # table inheritance, the plugin row itself
+        relations.append((rel.related_model, rel.field.name))
+    return relations
+
+
+def purge_space(space, batch_size=1000, progress=None):
+    """
+    Archive the space and delete all its plugin data and plugin rows in
+    chunks, plugin model by plugin model. The space itself and its roles
+    remain. Returns the number of deleted objects by model label.
+    """
+    if not space.archived:
+        Space.objects.filter(pk=space.pk).update(archived=True)
+        space.archived = True
+        invalidate_spaces()
+        spaces_archived.send(sender=Space, space_ids=[space.pk])
+    database = get_space_database(space)
+    counts = {}
+
+    def add(queryset, **kwargs):
+        label = queryset.model._meta.label
+        counts[label] = counts.get(label, 0) + delete_in_chunks(
+            queryset, batch_size, progress, **kwargs)
+
+    plugin_models = [SpacePlugin] + SpacePluginStates.plugin_models()
+    for plugin_model in plugin_models:
+        plugin_ids = plugin_model._base_manager.db_manager(database).filter(
+            space=space).values('pk')
+        for model, field_name in plugin_data_relations(plugin_model):
+            add(model._base_manager.db_manager(database).filter(
+                **{field_name + '__in': plugin_ids}))
+    # plugin models inheriting from SpacePlugin go with their SpacePlugin rows
+    for plugin_model in reversed(plugin_models):
+        if plugin_model is SpacePlugin or not issubclass(plugin_model, SpacePlugin):
+            add(plugin_model._base_manager.db_manager(database).filter(space=space))
+    add(SearchTerm.objects.filter(space=space), raw=True)
+    return counts
+
+
+def delete_space(space, batch_size=1000, progress=None):
+    """
+    Delete the space with everything belonging to it, in chunks (see
+    purge_space()). Returns the number of deleted objects by model
+    label.
+    """
+    counts = purge_space(space, batch_size, progress)
+    database = get_space_database(space)
+    if database != DEFAULT_DB_ALIAS:
+        # the copy of the space satisfying foreign keys in its database
+        delete_space_row(space, database)
+    counts[Group._meta.label] = delete_roles(space)
+    if progress is not None:
+        progress(Group._meta.label, counts[Group._meta.label])
+    space.delete()
+    counts[Space._meta.label] = 1
+    return counts
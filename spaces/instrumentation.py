@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Request instrumentation for django-spaces.
+
+SpacesInstrumentationMiddleware (see spaces.middleware) measures sampled
+requests: total latency, number and duration of database queries and
+counters other parts of django-spaces increment through count(), like hits
+and misses of the space resolution and permission caches. Every measured
+request is tagged with its space, plugin and view, logged as one JSON line
+to the "spaces.instrumentation" logger and kept in a rolling store, which
+the spacestats command summarizes.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger('spaces.instrumentation')
+
+# counters of the request currently being measured, None if there is none
+_counters = ContextVar('space_request_counters', default=None)
+
+
+def count(name, value=1):
+    """Add value to a counter of the current request, if it is measured."""
+    counters = _counters.get()
+    if counters is not None:
+        counters[name] = counters.get(name, 0) + value
+
+
+class RequestMetrics(object):
+    """
+    Collects the counters of one request. Installed as execute wrapper on
+    the database connections, it times every query as well.
+    """
+
+    def __init__(self):
+        self.counters = {'queries': 0, 'db_ms': 0.0}
+        self.start = time.perf_counter()
+        self.total_ms = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.counters['queries'] += 1
+            self.counters['db_ms'] += (time.perf_counter() - start) * 1000
+
+    def activate(self):
+        return _counters.set(self.counters)
+
+    def deactivate(self, token):
+        _counters.reset(token)
+        self.total_ms = (time.perf_counter() - self.start) * 1000
+
+
+def is_sampled():
+    rate = getattr(settings, 'SPACES_INSTRUMENTATION_SAMPLE_RATE', 1.0)
+    return rate >= 1 or random.random() < rate
+
+
+# plugin names by module of the view, see get_plugin_name()
+_plugin_names = {}
+
+
+def get_plugin_name(view_func):
+    """
+    Return the name of the plugin whose app provides the view function, or
+    None.
+    """
+    from .models import SpacePluginRegistry
+    module = getattr(view_func, '__module__', None)
+    try:
+        return _plugin_names[module]
+    except KeyError:
+        pass
+    app_config = apps.get_containing_app_config(module) if module else None
+    name = None
+    if app_config is not None:
+        for plugin in SpacePluginRegistry.plugins:
+            model = plugin.plugin_model
+            if model is not None and model._meta.app_label == app_config.label:
+                name = plugin.name
+                break
+    _plugin_names[module] = name
+    return name
+
+
+def build_record(request, response, metrics):
+    """Return the measurements of one request as a dict."""
+    space = getattr(request, 'SPACE', None)
+    match = getattr(request, 'resolver_match', None)
+    record = {
+        'time': time.time(),
+        'space': space.slug if space is not None else None,
+        'plugin': get_plugin_name(match.func) if match is not None else None,
+        'view': match.view_name if match is not None else None,
+        'status': getattr(response, 'status_code', None),
+        'total_ms': round(metrics.total_ms, 3),
+    }
+    for name, value in metrics.counters.items():
+        record[name] = round(value, 3) if isinstance(value, float) else value
+    return record
+
+
+class MetricsStore(object):
+    """
+    Rolling store of the last ``size`` request records, kept as ring buffer
+    in the configured cache. Use a cache shared by all workers to see the
+    requests of all of them.
+    """
+    counter_key = 'spaces:metrics:counter'
+    key_template = 'spaces:metrics:%d'
+
+    def __init__(self, size=10000, alias=None, timeout=86400):
+        self.size = size
+        self.alias = alias or getattr(settings, 'SPACES_CACHE_ALIAS', 'default')
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def add(self, record):
+        cache = self.cache
+        cache.add(self.counter_key, 0, None)
+        try:
+            slot = cache.incr(self.counter_key)
+        except ValueError:
+            return
+        cache.set(self.key_template % (slot % self.size), record, self.timeout)
+
+    def records(self):
+        keys = [self.key_template % slot for slot in range(self.size)]
+        records = []
+        for start in range(0, len(keys), 1000):
+            records.extend(self.cache.get_many(keys[start:start + 1000]).values())
+        return sorted(records, key=lambda record: record['time'])
+
+    def clear(self):
+        self.cache.delete_many(
+            [self.counter_key] + [self.key_template % slot for slot in range(self.size)])
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_metrics_store():
+    """
+    Return the rolling store, configured by SPACES_INSTRUMENTATION_STORE,
+    e.g. {'size': 10000, 'alias': 'default', 'timeout': 86400}.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MetricsStore(**getattr(settings, 'SPACES_INSTRUMENTATION_STORE', {}))
+        return _store
+
+
+def reset_metrics_store():
+    global _store
+    _store = None
+
+
+def record_request(request, response, metrics):
+    record = build_record(request, response, metrics)
+    logger.info(json.dumps(record, sort_keys=True))
+    get_metrics_store().add(record)
+    return record
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from spaces.benchmarks import (
+    BENCHMARKS, DEFAULT_BASELINE, compare_results, load_results, run_benchmark, save_results)
+
+
+class Command(BaseCommand):
+    help = ('Run the django-spaces benchmarks. All data created by a '
+            'benchmark is rolled back afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names', nargs='*',
+            help='Benchmarks to run (default: all of %s).' % ', '.join(BENCHMARKS))
+        parser.add_argument(
+            '--size', type=int, help="Override the benchmarks' dataset size.")
+        parser.add_argument(
+            '--save-baseline', metavar='FILE', nargs='?', const=DEFAULT_BASELINE,
+            help='Store the results as JSON baseline in FILE (default: %s).' % DEFAULT_BASELINE)
+        parser.add_argument(
+            '--compare', metavar='FILE', nargs='?', const=DEFAULT_BASELINE,
+            help='Fail if results regressed compared to the baseline in FILE '
+                 '(default: the query counts and memory figures of the baseline '
+                 'shipped with django-spaces).')
+        parser.add_argument(
+            '--threshold', type=float, default=0.2,
+            help='Allowed regression as fraction of the baseline (default: 0.2).')
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmark(s): %s' % ', '.join(sorted(unknown)))
+        baseline = load_results(options['compare']) if options['compare'] else None
+
+        results = OrderedDict()
+        for name in names:
+            result = run_benchmark(name, size=options['size'])
+            results[name] = result
+            self.stdout.write(name)
+            for key, value in result.items():
+                if isinstance(value, float):
+                    value = '%.3f' % value
+                self.stdout.write('    %-18s %s' % (key, value))
+
+        if options['save_baseline']:
+            save_results(results, options['save_baseline'])
+        if baseline is not None:
+            # the shipped latencies were measured on another machine
+            regressions = compare_results(
+                results, baseline, options['threshold'],
+                latencies=options['compare'] != DEFAULT_BASELINE)
+            if regressions:
+                raise CommandError('Regressions compared to %s:\n%s' % (
+                    options['compare'], '\n'.join(
+                        '    %s %s: %.3f -> %.3f' % regression
+                        for regression in regressions)))
+            self.stdout.write('No regressions compared to %s.' % options['compare'])
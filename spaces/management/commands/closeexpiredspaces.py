@@ -1,22 +1,58 @@
 # -*- coding: utf-8 -*-
-from django.core.management.base import BaseCommand, CommandError
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
-from django.utils.translation import ugettext as _
+from django.utils.translation import gettext as _
+from spaces.cache import invalidate_spaces
 from spaces.models import Space
+from spaces.signals import spaces_archived
+
 
 class Command(BaseCommand):
     args = ''
     help = 'Close all spaces whose expiration date lies in the past.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report how many spaces would be closed.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of spaces to archive per UPDATE statement.')
+
     def handle(self, *args, **options):
         """
-        Check the expiration dates of all spaces. If the date has passed, 
-        close that space.
+        Archive all spaces whose expiration date has passed, using set-based
+        UPDATEs of at most batch_size rows. Sends the spaces_archived signal
+        once per batch.
         """
-        now = timezone.now()
-        for space in Space.objects.all():
-            if space.expires and space.expires < now:
-                space.archieved = True
-                space.save()
-                print (_('Note: Space %s has been set to "archieved" status.' % space))
-            
\ No newline at end of file
+        start = time.perf_counter()
+        expired = Space.objects.filter(
+            archived=False, expires__lt=timezone.now()).order_by('pk')
+
+        if options['dry_run']:
+            if options['verbosity'] >= 2:
+                for slug in expired.values_list('slug', flat=True).iterator():
+                    self.stdout.write(_('Would archive space %s.') % slug)
+            self.stdout.write(_('%(count)d spaces would be archived (dry run).') % {
+                'count': expired.count()})
+            return
+
+        total = 0
+        while True:
+            with transaction.atomic():
+                space_ids = list(
+                    expired.values_list('pk', flat=True)[:options['batch_size']])
+                if not space_ids:
+                    break
+                total += Space.objects.filter(
+                    pk__in=space_ids, archived=False).update(archived=True)
+            invalidate_spaces()
+            spaces_archived.send(sender=Space, space_ids=space_ids)
+            if options['verbosity'] >= 2:
+                self.stdout.write(_('Archived %d spaces.') % len(space_ids))
+
+        self.stdout.write(_('%(count)d spaces archived in %(seconds).2fs.') % {
+            'count': total, 'seconds': time.perf_counter() - start})
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from spaces.deletion import delete_space, purge_space
+from spaces.models import Space
+
+
+class Command(BaseCommand):
+    help = ('Delete spaces with all their plugin data, roles and permissions '
+            'in chunks. Run it again to resume an interrupted deletion.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='+', help='Spaces to delete.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of objects to delete per transaction.')
+        parser.add_argument(
+            '--keep-space', action='store_true',
+            help='Only archive the spaces and delete their plugin data.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size has to be at least 1.')
+        spaces = list(Space.objects.filter(slug__in=options['slugs']))
+        missing = set(options['slugs']) - set(space.slug for space in spaces)
+        if missing:
+            raise CommandError('Unknown space(s): %s' % ', '.join(sorted(missing)))
+        pipeline = purge_space if options['keep_space'] else delete_space
+        for space in spaces:
+            start = time.perf_counter()
+            progress = self.progress(space) if options['verbosity'] >= 2 else None
+            counts = pipeline(space, options['batch_size'], progress)
+            self.stdout.write('%s: deleted %d objects in %.2fs.' % (
+                space.slug, sum(counts.values()), time.perf_counter() - start))
+
+    def progress(self, space):
+        def report(label, deleted):
+            self.stdout.write('%s: %s, %d deleted' % (space.slug, label, deleted))
+        return report
+
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import gzip
+import sys
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+from spaces.models import Space
+from spaces.transfer import export_spaces
+
+
+class Command(BaseCommand):
+    help = ('Export spaces with their roles, plugins and plugin data as '
+            'newline-delimited JSON, see importspaces.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='+', help='Spaces to export.')
+        parser.add_argument(
+            '-o', '--output', default='-',
+            help='File to write, "-" for stdout (default). Files ending in '
+                 '.gz are compressed.')
+        parser.add_argument(
+            '--gzip', action='store_true', help='Compress the output.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        spaces = list(Space.objects.filter(slug__in=options['slugs']).order_by('pk'))
+        missing = set(options['slugs']) - set(space.slug for space in spaces)
+        if missing:
+            raise CommandError('Unknown space(s): %s' % ', '.join(sorted(missing)))
+        compress = options['gzip'] or options['output'].endswith('.gz')
+        with ExitStack() as stack:
+            if options['output'] == '-':
+                out = self.stdout
+                if compress:
+                    out = stack.enter_context(
+                        gzip.open(sys.stdout.buffer, 'wt', encoding='utf-8'))
+            else:
+                opener = gzip.open if compress else open
+                out = stack.enter_context(opener(options['output'], 'wt', encoding='utf-8'))
+            count = export_spaces(spaces, out, options['batch_size'])
+        if options['output'] != '-':
+            self.stdout.write('Exported %d spaces, %d rows.' % (len(spaces), count))
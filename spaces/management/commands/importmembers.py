@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import csv
+import sys
+from itertools import groupby
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from spaces.models import Space
+from spaces.roles import ROLES, add_members, change_role
+from spaces.util import chunked
+
+
+class Command(BaseCommand):
+    help = ('Add users to spaces. Reads CSV rows of the form '
+            '"space slug,username[,role]" from a file or stdin, one batch '
+            'at a time, so the input may be arbitrarily large.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('csvfile', help='CSV file to read, "-" for stdin.')
+        parser.add_argument(
+            '--role', choices=ROLES, default=ROLES[-1],
+            help='Role for rows without one (default: %(default)s).')
+        parser.add_argument(
+            '--move', action='store_true',
+            help='Take away other roles the users have in the space.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['csvfile'] == '-':
+            self.import_rows(sys.stdin, options)
+        else:
+            with open(options['csvfile'], newline='') as csvfile:
+                self.import_rows(csvfile, options)
+
+    def read_rows(self, csvfile, default_role):
+        for lineno, row in enumerate(csv.reader(csvfile), 1):
+            if not row or not row[0].strip():
+                continue
+            if len(row) < 2 or not row[1].strip():
+                raise CommandError('Line %d: no username given.' % lineno)
+            role = row[2].strip() if len(row) > 2 and row[2].strip() else default_role
+            if role not in ROLES:
+                raise CommandError('Line %d: unknown role "%s".' % (lineno, role))
+            yield row[0].strip(), row[1].strip(), role
+
+    def import_rows(self, csvfile, options):
+        spaces = {}
+        imported = skipped = 0
+        for batch in chunked(self.read_rows(csvfile, options['role']), options['batch_size']):
+            slugs = set(slug for slug, username, role in batch) - set(spaces)
+            spaces.update((space.slug, space) for space in Space.objects.filter(slug__in=slugs))
+            user_ids = dict(User.objects.filter(
+                username__in=set(username for slug, username, role in batch)
+            ).values_list('username', 'pk'))
+
+            rows = []
+            for slug, username, role in batch:
+                if slug not in spaces or username not in user_ids:
+                    self.stderr.write('Skipping %s,%s: unknown space or user.' % (slug, username))
+                    skipped += 1
+                    continue
+                rows.append((slug, role, user_ids[username]))
+            rows.sort()
+            for (slug, role), group in groupby(rows, key=lambda row: row[:2]):
+                ids = [user_id for slug, role, user_id in group]
+                if options['move']:
+                    change_role(spaces[slug], ids, role, batch_size=options['batch_size'])
+                else:
+                    add_members(spaces[slug], ids, role, batch_size=options['batch_size'])
+                imported += len(ids)
+        self.stdout.write('Imported %d memberships, skipped %d rows.' % (imported, skipped))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import sys
+from contextlib import ExitStack
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from spaces.transfer import InvalidExport, import_spaces
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class Command(BaseCommand):
+    help = ('Import spaces written by exportspaces as new spaces. Batches are '
+            'committed as they are loaded; remove the spaces of a failed '
+            'import with deletespaces.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'file', help='Export to read, "-" for stdin. Compressed input is detected.')
+        parser.add_argument(
+            '--created-by', metavar='USERNAME',
+            help='Owner of the new spaces (default: the exported owner).')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        created_by = None
+        if options['created_by']:
+            try:
+                created_by = User.objects.get_by_natural_key(options['created_by'])
+            except User.DoesNotExist:
+                raise CommandError('Unknown user %s.' % options['created_by'])
+        with ExitStack() as stack:
+            if options['file'] == '-':
+                raw = sys.stdin.buffer
+            else:
+                raw = stack.enter_context(open(options['file'], 'rb'))
+            if raw.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+                raw = gzip.GzipFile(fileobj=raw)
+            lines = io.TextIOWrapper(raw, encoding='utf-8')
+            try:
+                spaces = import_spaces(lines, created_by, options['batch_size'])
+            except InvalidExport as e:
+                raise CommandError(str(e))
+            finally:
+                lines.detach()
+        for space in spaces:
+            self.stdout.write('Imported space %s.' % space.slug)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from spaces.models import Space
+from spaces.routers import MoveError, get_space_database, move_space
+
+
+class Command(BaseCommand):
+    help = ('Move the plugin data of a space to another database, see '
+            'spaces.routers. Run it again to resume an interrupted move.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug', help='Space to move.')
+        parser.add_argument('database', help='Alias of the target database.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of rows to copy per transaction.')
+
+    def handle(self, *args, **options):
+        try:
+            space = Space.objects.get(slug=options['slug'])
+        except Space.DoesNotExist:
+            raise CommandError('Unknown space %s.' % options['slug'])
+        source = get_space_database(space)
+        progress = self.progress if options['verbosity'] >= 2 else None
+        start = time.perf_counter()
+        try:
+            copied = move_space(space, options['database'], options['batch_size'], progress)
+        except MoveError as e:
+            raise CommandError(str(e))
+        self.stdout.write('Moved %s from %s to %s: %d rows copied in %.2fs.' % (
+            space.slug, source, options['database'], copied, time.perf_counter() - start))
+
+    def progress(self, label, copied):
+        self.stdout.write('%s: %d copied' % (label, copied))
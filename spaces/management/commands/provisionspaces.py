@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import csv
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from spaces.models import Space
+from spaces.util import chunked
+
+
+class Command(BaseCommand):
+    help = ('Create many spaces at once. Reads CSV rows of the form '
+            '"space name,owner username" from a file or stdin.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('csvfile', help='CSV file to read, "-" for stdin.')
+        parser.add_argument(
+            '--owner', help='Username of the owner for rows without one.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        """
+        Provision all spaces listed in the CSV input within one transaction.
+        """
+        if options['csvfile'] == '-':
+            rows = self.read_rows(sys.stdin, options['owner'])
+        else:
+            with open(options['csvfile'], newline='') as csvfile:
+                rows = self.read_rows(csvfile, options['owner'])
+
+        usernames = set(owner for name, owner in rows)
+        owners = {}
+        for chunk in chunked(usernames, options['batch_size']):
+            owners.update(
+                (user.username, user)
+                for user in User.objects.filter(username__in=chunk))
+        missing = usernames - set(owners)
+        if missing:
+            raise CommandError('Unknown owner(s): %s' % ', '.join(sorted(missing)))
+
+        spaces = Space.objects.bulk_provision(
+            [(name, owners[owner]) for name, owner in rows],
+            batch_size=options['batch_size'])
+        self.stdout.write('Created %d spaces.' % len(spaces))
+
+    def read_rows(self, csvfile, default_owner):
+        rows = []
+        for lineno, row in enumerate(csv.reader(csvfile), 1):
+            if not row or not row[0].strip():
+                continue
+            owner = row[1].strip() if len(row) > 1 and row[1].strip() else default_owner
+            if not owner:
+                raise CommandError('Line %d: no owner given.' % lineno)
+            rows.append((row[0].strip(), owner))
+        return rows
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from spaces.models import Space
+from spaces.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the search index from the searchable_fields of all '
+            'registered plugins.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'slugs', nargs='*', help='Spaces to reindex (default: all).')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not options['slugs']:
+            count = rebuild_index(batch_size=options['batch_size'])
+            self.stdout.write('Indexed %d objects.' % count)
+            return
+        spaces = list(Space.objects.filter(slug__in=options['slugs']))
+        missing = set(options['slugs']) - set(space.slug for space in spaces)
+        if missing:
+            raise CommandError('Unknown space(s): %s' % ', '.join(sorted(missing)))
+        for space in spaces:
+            count = rebuild_index(space, batch_size=options['batch_size'])
+            self.stdout.write('%s: indexed %d objects.' % (space.slug, count))
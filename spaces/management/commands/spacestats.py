@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from spaces.instrumentation import get_metrics_store
+from spaces.util import percentile
+
+GROUPINGS = ('space', 'plugin')
+
+
+def summarize(records, key):
+    """
+    Group request records by the given key and return one row of
+    aggregated figures per group.
+    """
+    groups = OrderedDict()
+    for record in records:
+        groups.setdefault(record.get(key) or '-', []).append(record)
+    rows = []
+    for name, group in groups.items():
+        latencies = [record['total_ms'] for record in group]
+        rows.append(OrderedDict((
+            (key, name),
+            ('requests', len(group)),
+            ('mean_ms', sum(latencies) / len(group)),
+            ('p50_ms', percentile(latencies, 50)),
+            ('p99_ms', percentile(latencies, 99)),
+            ('queries_mean', sum(record.get('queries', 0) for record in group) / float(len(group))),
+            ('db_ms', sum(record.get('db_ms', 0) for record in group)),
+        )))
+    return rows
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Command(BaseCommand):
+    help = ('Show the slowest spaces and plugins of the requests recorded by '
+            'SpacesInstrumentationMiddleware.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=10)
+        parser.add_argument(
+            '--by', choices=GROUPINGS, action='append',
+            help='Group by space or plugin (default: both).')
+        parser.add_argument(
+            '--format', choices=('text', 'prometheus'), default='text')
+        parser.add_argument(
+            '--clear', action='store_true', help='Empty the store afterwards.')
+
+    def handle(self, *args, **options):
+        if options['top'] < 1:
+            raise CommandError('--top has to be at least 1.')
+        store = get_metrics_store()
+        records = store.records()
+        for key in options['by'] or GROUPINGS:
+            rows = sorted(summarize(records, key), key=lambda row: -row['mean_ms'])
+            rows = rows[:options['top']]
+            if options['format'] == 'prometheus':
+                self.write_prometheus(key, rows)
+            else:
+                self.write_text(key, rows, len(records))
+        if options['clear']:
+            store.clear()
+
+    def write_text(self, key, rows, total):
+        self.stdout.write('Slowest %ss (%d requests recorded)' % (key, total))
+        self.stdout.write('%-30s %8s %9s %9s %9s %8s %9s' % (
+            key, 'requests', 'mean_ms', 'p50_ms', 'p99_ms', 'queries', 'db_ms'))
+        for row in rows:
+            self.stdout.write('%-30s %8d %9.1f %9.1f %9.1f %8.1f %9.1f' % tuple(row.values()))
+
+    def write_prometheus(self, key, rows):
+        """
+        Write the figures as Prometheus gauges. They describe the requests
+        currently kept in the store, not all requests ever made.
+        """
+        for name, help_text in (
+                ('requests', 'Recorded requests'),
+                ('mean_ms', 'Mean latency of recorded requests in milliseconds'),
+                ('p99_ms', '99th percentile latency of recorded requests in milliseconds'),
+                ('queries_mean', 'Mean number of database queries per recorded request'),
+                ('db_ms', 'Total database time of recorded requests in milliseconds')):
+            metric = 'spaces_%s_%s' % (key, name)
+            self.stdout.write('# HELP %s %s' % (metric, help_text))
+            self.stdout.write('# TYPE %s gauge' % metric)
+            for row in rows:
+                self.stdout.write('%s{%s="%s"} %s' % (
+                    metric, key, escape_label(row[key]), row[name]))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from spaces.registry import sync_plugins
+
+
+class Command(BaseCommand):
+    help = ('Like syncplugins, but only touches the database if the '
+            'registered plugins changed since the last sync. Cheap enough '
+            'to run on every deploy or worker start.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true', help='Sync even if nothing changed.')
+
+    def handle(self, *args, **options):
+        if sync_plugins(force=options['force'], verbosity=options['verbosity']):
+            self.stdout.write('Plugins synced.')
+        else:
+            self.stdout.write('Plugins unchanged, nothing to sync.')
@@ -1,19 +1,52 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import re
 
-from .util import activate, deactivate
+from .util import override
 
 
-from django.shortcuts import get_object_or_404
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db import connections
 from django.utils.deprecation import MiddlewareMixin
-from .models import Space
+from django.utils.functional import SimpleLazyObject
+from .cache import get_resolution_cache
+from .instrumentation import RequestMetrics, is_sampled, record_request
+from .roles import SpaceRoles
+from .throttling import release, throttle
+
+# requests allowed in read-only spaces
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
 
 class SpacesMiddleware(MiddlewareMixin):
     """
     Variant of django.middleware.locale.LocaleMiddleware.
     Reads the current space from URL prefixes.
-    Sets request.SPACE.
+    Sets request.SPACE and request.SPACE_ROLES (a lazily created
+    spaces.roles.SpaceRoles resolver for request.user).
+
+    Slugs are resolved through the space resolution cache (see
+    spaces.cache), so most requests don't touch the database here.
+
+    Archived and expired spaces are read-only: request.SPACE_READONLY is
+    set for them, and unsafe requests (POST, PUT, ...) are denied unless
+    the view is marked with the space_writable decorator or
+    SpaceWritableMixin. Set SPACES_READONLY_ENFORCE to False to only set
+    the flag. This only uses the resolved space, no queries are needed.
+
+    Requests beyond the rate and concurrency limits of their space
+    (SPACES_RATE_LIMITS, see spaces.throttling) are answered with 429.
+
+    Works with both sync and async views. The active space is kept in a
+    context variable that is only set while the request is handled, so
+    concurrent requests served by the same thread don't see each other's
+    space.
     """
+    sync_capable = True
+    async_capable = True
 
     space_prefix_re = re.compile(r'^/([-\w]+)/?')
 
@@ -27,19 +60,114 @@ class SpacesMiddleware(MiddlewareMixin):
         space_slug = regex_match.groups()[0]
         return space_slug
 
-    def process_request(self, request):
+    def resolve_space(self, request):
+        """
+        Set request.SPACE and request.SPACE_ROLES. Returns the slug of the
+        space or None if the request isn't inside a space.
+        """
+        request.SPACE_ROLES = SimpleLazyObject(
+            lambda: SpaceRoles.for_user(getattr(request, 'user', None)))
+        request.SPACE = None
+        request.SPACE_READONLY = False
         space_slug = self.get_space_slug(request)
         if space_slug is None:
-            deactivate()
-            request.SPACE = None
-        else:
-            space = Space.objects.filter(slug=space_slug).first()
-            if space:
-                activate(space_slug)
-                request.SPACE = space
-            else:
-                deactivate()
-                request.SPACE = None
+            return None
+        space = get_resolution_cache().get_space(space_slug)
+        if not space:
+            return None
+        request.SPACE = space
+        request.SPACE_READONLY = space.is_readonly()
+        return space_slug
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not getattr(request, 'SPACE_READONLY', False) or request.method in SAFE_METHODS:
+            return None
+        if not getattr(settings, 'SPACES_READONLY_ENFORCE', True):
+            return None
+        view_class = getattr(view_func, 'view_class', None)
+        if getattr(view_func, 'space_writable', False) or \
+                getattr(view_class, 'space_writable', False):
+            return None
+        raise PermissionDenied('This space is read-only.')
 
     def process_response(self, request, response):
-        return response
\ No newline at end of file
+        return response
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        space_slug = self.resolve_space(request)
+        response = throttle(request)
+        if response is not None:
+            return response
+        try:
+            with override(space_slug):
+                response = self.get_response(request)
+        finally:
+            release(request)
+        return self.process_response(request, response)
+
+    def resolve_and_throttle(self, request):
+        return self.resolve_space(request), throttle(request)
+
+    async def __acall__(self, request):
+        space_slug, response = await sync_to_async(
+            self.resolve_and_throttle, thread_sensitive=True)(request)
+        if response is not None:
+            return response
+        try:
+            with override(space_slug):
+                response = await self.get_response(request)
+        finally:
+            await sync_to_async(release, thread_sensitive=True)(request)
+        return self.process_response(request, response)
+
+
+class SpacesInstrumentationMiddleware(MiddlewareMixin):
+    """
+    Measures a sample of requests (SPACES_INSTRUMENTATION_SAMPLE_RATE,
+    defaults to 1.0, i.e. all of them), see spaces.instrumentation.
+    Put it in front of SpacesMiddleware, so space resolution is measured
+    as well:
+
+        MIDDLEWARE = [
+            'spaces.middleware.SpacesInstrumentationMiddleware',
+            'spaces.middleware.SpacesMiddleware',
+            ...
+        ]
+
+    Database queries of async views run in other threads and are not
+    counted.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not is_sampled():
+            return self.get_response(request)
+        metrics = RequestMetrics()
+        token = metrics.activate()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            metrics.deactivate(token)
+        record_request(request, response, metrics)
+        return response
+
+    async def __acall__(self, request):
+        if not is_sampled():
+            return await self.get_response(request)
+        metrics = RequestMetrics()
+        token = metrics.activate()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.deactivate(token)
+        await sync_to_async(record_request, thread_sensitive=True)(
+            request, response, metrics)
+        return response
@@ -0,0 +1,61 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:34
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+ROLE_LABELS = {
+    'Space Admins': 'admins',
+    'Team': 'team',
+    'Members': 'members',
+}
+
+
+def backfill_space_roles(apps, schema_editor):
+    """
+    Create SpaceRole rows for the existing "<space pk>: <role label>" groups.
+    """
+    Group = apps.get_model('auth', 'Group')
+    Space = apps.get_model('spaces', 'Space')
+    SpaceRole = apps.get_model('spaces', 'SpaceRole')
+    group_name_re = re.compile(r'^([0-9]+): (%s)$' % '|'.join(ROLE_LABELS))
+
+    space_ids = set(Space.objects.values_list('pk', flat=True))
+    groups = Group.objects.filter(name__regex=group_name_re.pattern)
+    roles = []
+    for group_id, name in groups.values_list('pk', 'name').iterator():
+        match = group_name_re.match(name)
+        space_id = int(match.group(1))
+        if space_id in space_ids:
+            roles.append(SpaceRole(
+                space_id=space_id,
+                role=ROLE_LABELS[match.group(2)],
+                group_id=group_id,
+            ))
+    SpaceRole.objects.bulk_create(roles, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0001_initial'),
+        ('spaces', '0004_spaceplugin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpaceRole',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('admins', 'Space Admins'), ('team', 'Team'), ('members', 'Members')], max_length=16)),
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='space_role', to='auth.group')),
+                ('space', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='space_roles', to='spaces.space')),
+            ],
+            options={
+                'unique_together': {('space', 'role')},
+            },
+        ),
+        migrations.RunPython(backfill_space_roles, migrations.RunPython.noop),
+    ]
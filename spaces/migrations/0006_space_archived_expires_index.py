@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces', '0005_spacerole'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='space',
+            index=models.Index(fields=['archived', 'expires'], name='spaces_spac_archive_0d465b_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces', '0007_searchterm'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='space',
+            index=models.Index(fields=['created_at', 'id'], name='spaces_spac_created_bceffc_idx'),
+        ),
+    ]
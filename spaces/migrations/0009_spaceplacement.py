@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces', '0008_space_created_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpacePlacement',
+            fields=[
+                ('space', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='placement', serialize=False, to='spaces.space')),
+                ('database', models.CharField(max_length=64)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces', '0009_spaceplacement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='spaceplacement',
+            name='archived_before_move',
+            field=models.BooleanField(editable=False, null=True),
+        ),
+    ]
@@ -21,4 +21,11 @@ class SpaceAdminRequiredMixin(SpacesMixin):
     def dispatch(self, request, *args, **kwargs):
         return super(SpaceAdminRequiredMixin, self).dispatch(
             request, *args, **kwargs
-        )
\ No newline at end of file
+        )
+
+class SpaceWritableMixin(object):
+    """
+    Allow unsafe requests (POST etc.) to a class based view even if the
+    current space is read-only, see SpacesMiddleware.
+    """
+    space_writable = True
@@ -1,15 +1,197 @@
 # -*- coding: utf-8 -*-
 import itertools
-from django.db import models
+from django.core import checks
+from django.core.exceptions import FieldDoesNotExist
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Cast, Length
 from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
 from django.template.exceptions import TemplateDoesNotExist
 from django.template.loader import get_template
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.text import slugify
 from djangoplugins.point import PluginPoint
 
-# Create your models here.
+def slug_with_suffix(slug, suffix, max_length):
+    """
+    Append a number suffix to a slug, shortening the slug where it would
+    otherwise overflow max_length.
+    """
+    if not suffix:
+        return slug[:max_length]
+    suffix = str(suffix)
+    return '%s%s' % (slug[:max_length - len(suffix)], suffix)
+
+
+def allocate_slug(slug, taken, counters, max_length):
+    """
+    Return the first unused variant of slug according to the in-memory set
+    ``taken`` and mark it as used. ``counters`` remembers the last suffix
+    handed out per slug, so allocating many duplicates stays cheap.
+    """
+    suffix = counters.get(slug, 0)
+    candidate = slug_with_suffix(slug, suffix, max_length)
+    while candidate in taken:
+        suffix += 1
+        candidate = slug_with_suffix(slug, suffix, max_length)
+    counters[slug] = suffix
+    taken.add(candidate)
+    return candidate
+
+
+def keyset_cursor(space):
+    """
+    Return the cursor pointing behind the given space for
+    SpaceInstanceQuerySet.after().
+    """
+    return '%s,%s' % (space.created_at.isoformat(), space.pk)
+
+
+class SpaceInstanceQuerySet(models.QuerySet):
+
+    def for_user(self, user):
+        """
+        Return the non-archived spaces the user may access (has the
+        access_space permission for, directly or through a group), ordered
+        by creation, with one query. Each space is annotated with
+
+          * user_role: the user's highest role in it (or None)
+          * expired: whether its expiry date has passed
+          * active_plugins: the number of its active plugins
+
+        Superusers get all non-archived spaces.
+        """
+        from guardian.utils import get_group_obj_perms_model, get_user_obj_perms_model
+        from .roles import ROLES
+
+        if user is None or not user.is_authenticated or not user.is_active:
+            return self.none()
+        queryset = self.filter(archived=False)
+        if not user.is_superuser:
+            perm_filter = {
+                'content_type': ContentType.objects.get_for_model(self.model),
+                'object_pk': Cast(models.OuterRef('pk'), models.CharField()),
+                'permission__codename': 'access_space',
+            }
+            queryset = queryset.filter(
+                models.Exists(get_user_obj_perms_model().objects.filter(
+                    user=user, **perm_filter))
+                | models.Exists(get_group_obj_perms_model().objects.filter(
+                    group__user=user, **perm_filter)))
+        rank = models.Case(
+            *[models.When(role=role, then=models.Value(i)) for i, role in enumerate(ROLES)],
+            output_field=models.IntegerField())
+        user_role = (SpaceRole.objects.filter(space=models.OuterRef('pk'), group__user=user)
+                         .order_by(rank).values('role')[:1])
+        return queryset.annotate(
+            user_role=models.Subquery(user_role),
+            expired=models.Case(
+                models.When(expires__lt=timezone.now(), then=models.Value(True)),
+                default=models.Value(False), output_field=models.BooleanField()),
+            active_plugins=models.Count(
+                'spaceplugin', filter=models.Q(spaceplugin__active=True)),
+        ).order_by('created_at', 'pk')
+
+    def after(self, cursor):
+        """
+        Keyset pagination: restrict to the spaces created after the one the
+        cursor (see keyset_cursor(), or a Space) points to. Unlike
+        OFFSET, this costs the same on every page.
+        """
+        if not cursor:
+            return self
+        if isinstance(cursor, Space):
+            cursor = keyset_cursor(cursor)
+        created_at, pk = cursor.rsplit(',', 1)
+        created_at = parse_datetime(created_at)
+        if created_at is None:
+            raise ValueError('Malformed cursor %r.' % cursor)
+        return self.filter(
+            models.Q(created_at__gt=created_at)
+            | models.Q(created_at=created_at, pk__gt=int(pk)))
+
+
+class SpaceInstanceManager(models.Manager.from_queryset(SpaceInstanceQuerySet)):
+    """
+    Default manager of the Space model (not to be confused with SpaceManager,
+    which is used by space-aware plugin models).
+    """
+
+    def free_slug_suffix(self, slug, minimum=0):
+        """
+        Return the number suffix that makes slug unique (0 meaning no
+        suffix at all), but at least ``minimum``.
+
+        A single query fetches the existing variant with the highest suffix
+        (longest first, then alphabetically last) and whether slug itself is
+        taken; as long as it isn't, slug is used as it is. Only if the suffix
+        forces the slug to be shortened, further candidates are probed one by
+        one.
+        """
+        max_length = self.model._meta.get_field('slug').max_length
+        slug = slug[:max_length]
+        last = (self.filter(slug__startswith=slug, slug__regex=r'^%s[0-9]*$' % slug)
+                    .annotate(exact=models.Exists(self.filter(slug=slug)))
+                    .order_by(Length('slug').desc(), '-slug')
+                    .values_list('slug', 'exact').first())
+        suffix = minimum
+        if last is not None and (minimum or last[1]):
+            suffix = max(suffix, int(last[0][len(slug):] or 0) + 1)
+        # shortened variants don't match the pattern above
+        while suffix and len(slug) + len(str(suffix)) > max_length and \
+                self.filter(slug=slug_with_suffix(slug, suffix, max_length)).exists():
+            suffix += 1
+        return suffix
+
+    def next_free_slug(self, slug):
+        """
+        Return slug, or the first of slug1, slug2 ... not used yet.
+        """
+        max_length = self.model._meta.get_field('slug').max_length
+        return slug_with_suffix(slug, self.free_slug_suffix(slug), max_length)
+
+    def bulk_provision(self, spaces, batch_size=500):
+        """
+        Create many spaces at once, including their role groups and
+        permissions. ``spaces`` is an iterable of (name, created_by) tuples.
+
+        Slugs are allocated in memory against a single fetch of the existing
+        slugs, everything else is inserted with batched bulk_create()
+        statements inside one transaction. Unlike Space.save(), no post_save
+        signals are sent.
+        Returns the list of created spaces.
+        """
+        from .cache import invalidate_spaces
+        from .roles import roles_init_bulk
+        from .util import chunked
+
+        max_length = self.model._meta.get_field('slug').max_length
+        with transaction.atomic(using=self.db):
+            taken = set(self.values_list('slug', flat=True).iterator())
+            counters = {}
+            new_spaces = []
+            for name, created_by in spaces:
+                slug = allocate_slug(
+                    slugify(name)[:max_length], taken, counters, max_length)
+                new_spaces.append(
+                    self.model(name=name, slug=slug, created_by=created_by))
+            self.bulk_create(new_spaces, batch_size=batch_size)
+
+            # not every database backend returns the primary keys from
+            # bulk_create(), so fetch the new rows again.
+            slugs = [space.slug for space in new_spaces]
+            by_slug = {}
+            for chunk in chunked(slugs, batch_size):
+                by_slug.update(
+                    (space.slug, space) for space in self.filter(slug__in=chunk))
+            created = [by_slug[slug] for slug in slugs]
+            roles_init_bulk(created, batch_size=batch_size)
+        invalidate_spaces()
+        return created
+
+
 class Space(models.Model):
     name = models.CharField(verbose_name="Space Name", max_length=256)
     slug = models.SlugField(blank=True, unique=True)
@@ -18,12 +200,17 @@ class Space(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = SpaceInstanceManager()
 
     class Meta:
         permissions = (
                 ('access_space', 'Access this Space'),
                 ('add_space_member', 'Add new member to this Space'),    
         )
+        indexes = (
+            models.Index(fields=['archived', 'expires']),  # closeexpiredspaces
+            models.Index(fields=['created_at', 'id']),  # keyset pagination
+        )
 
 
     def __str__(self):
@@ -32,6 +219,9 @@ class Space(models.Model):
     def get_absolute_url(self):
         return '/%s/' % self.slug
 
+    # how often to retry saving with a new slug if a concurrent save took it
+    slug_attempts = 5
+
     def save(self, *args, **kwargs):
         from .roles import roles_init_new
 
@@ -39,31 +229,104 @@ class Space(models.Model):
         if not self.id:
             is_create = True
 
-        if not self.slug:
-            max_length = self._meta.get_field('slug').max_length #SlugField is a rather small CharField, so we have to be carful not to overflow that restriction with our number suffix
-            slug = self.slug = slugify(self.name)[:max_length]
-            for x in itertools.count(1):
-                if not Space.objects.filter(slug=self.slug).exists():
-                    break
-                self.slug = '%s%d' % (slug[:max_length - len(str(x))], x)
-
-        super(Space, self).save(*args, **kwargs)
+        if self.slug:
+            super(Space, self).save(*args, **kwargs)
+        else:
+            self.save_with_free_slug(*args, **kwargs)
 
         if is_create:
             roles_init_new(self)
 
+    def save_with_free_slug(self, *args, **kwargs):
+        """
+        Derive a unique slug from the name and save. The unique index on slug
+        is the final arbiter: if another process took the slug in the
+        meantime, the next free one is tried.
+        """
+        max_length = self._meta.get_field('slug').max_length #SlugField is a rather small CharField, so we have to be carful not to overflow that restriction with our number suffix
+        slug = slugify(self.name)[:max_length]
+        suffix = 0
+        for attempt in itertools.count(1):
+            suffix = Space.objects.free_slug_suffix(slug, minimum=suffix)
+            self.slug = slug_with_suffix(slug, suffix, max_length)
+            try:
+                with transaction.atomic(using=kwargs.get('using')):
+                    super(Space, self).save(*args, **kwargs)
+                return
+            except IntegrityError:
+                taken = Space.objects.filter(slug=self.slug).exists()
+                if attempt >= self.slug_attempts or not taken:
+                    self.slug = ''
+                    raise
+                suffix += 1
+
+    def get_role_group(self, role):
+        return Group.objects.filter(
+            space_role__space=self, space_role__role=role).first()
+
+    def get_role_users(self, role):
+        """Return all users having the given role in this space."""
+        return User.objects.filter(
+            groups__space_role__space=self, groups__space_role__role=role)
 
     def get_team(self):
-        return Group.objects.filter(name="%s: Team" % str(self.pk)).first()
+        return self.get_role_group(SpaceRole.TEAM)
 
     def get_members(self):
-        return Group.objects.filter(name="%s: Members" % str(self.pk)).first()
+        return self.get_role_group(SpaceRole.MEMBERS)
 
     def get_admins(self):
-        return Group.objects.filter(name="%s: Space Admins" % str(self.pk)).first()
+        return self.get_role_group(SpaceRole.ADMINS)
 
     def is_expired(self):
-        return self.expires < timezone.now()
+        return self.expires is not None and self.expires < timezone.now()
+
+    def is_readonly(self):
+        """Archived and expired spaces can't be changed any more."""
+        return self.archived or self.is_expired()
+
+
+class SpaceRole(models.Model):
+    """
+    Links a Space to the Group holding the users of one of its roles.
+    The group name ("<space pk>: <role label>") is informational only,
+    all lookups go through this model.
+    """
+    ADMINS = 'admins'
+    TEAM = 'team'
+    MEMBERS = 'members'
+    ROLE_CHOICES = (
+        (ADMINS, 'Space Admins'),
+        (TEAM, 'Team'),
+        (MEMBERS, 'Members'),
+    )
+
+    space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name='space_roles')
+    role = models.CharField(max_length=16, choices=ROLE_CHOICES)
+    group = models.OneToOneField(Group, on_delete=models.CASCADE, related_name='space_role')
+
+    class Meta:
+        unique_together = (('space', 'role'),)
+
+    def __str__(self):
+        return '%s: %s' % (self.space_id, self.get_role_display())
+
+
+class SpacePlacement(models.Model):
+    """
+    The database holding the plugin rows and plugin data of a space, for
+    spaces.routers.SpaceShardRouter. Spaces without one use the default
+    database. Change it with spaces.routers.move_space() only.
+    """
+    space = models.OneToOneField(
+        Space, on_delete=models.CASCADE, primary_key=True, related_name='placement')
+    database = models.CharField(max_length=64)
+    # archived state of the space before a move that is still going on,
+    # restored once it is done, even if it has been resumed
+    archived_before_move = models.BooleanField(null=True, editable=False)
+
+    def __str__(self):
+        return '%s: %s' % (self.space_id, self.database)
 
 
 class SpacePluginRegistry(PluginPoint):
@@ -78,9 +341,28 @@ class SpacePluginRegistry(PluginPoint):
     # searchable_fields = ((ModelDefinition, ('field__relatedfield1', 'field_relatedfield2')
     searchable_fields = None
 
+    @classmethod
+    def get_plugin(cls, name=None, status=None):
+        """
+        Return the enabled plugin with the given name, looked up in the
+        in-process snapshot (see spaces.registry) instead of the database.
+        """
+        if name is None or status is not None:
+            if status is None:
+                return super(SpacePluginRegistry, cls).get_plugin(name)
+            return super(SpacePluginRegistry, cls).get_plugin(name, status)
+        from .registry import get_snapshot
+        return get_snapshot().get_plugin(name)
+
+    @classmethod
+    def get_plugins(cls):
+        """Return instances of all enabled plugins, see get_plugin()."""
+        from .registry import get_snapshot
+        return get_snapshot().get_plugins()
+
     def get_plugin_model(self, space=None):
         try: 
-            return self.plugin_model.objects.get_or_create(space=space)[0]
+            return SpacePluginStates.for_space(space).get(self.plugin_model, create=True)
         except AttributeError:
             print("*********\n"
                   "To make get_plugin_model() work for this plugin registry, you have to "
@@ -101,20 +383,29 @@ class SpacePluginRegistry(PluginPoint):
         return None
 
     def is_active(self, space=None):
-        model = self.get_plugin_model(space)
+        model = SpacePluginStates.for_space(space).get(self.plugin_model)
         return model.active if model else False
 
     def reverse_url(self, space=None):
-        model = self.get_plugin_model(space)
-        return model.reverse_url if model else None
+        model = SpacePluginStates.for_space(space).get(self.plugin_model)
+        return (model or self.plugin_model).reverse_url
+
+    # rendered icons by plugin name, kept for the life of the process
+    icon_cache = {}
 
     def get_icon(self):
+        try:
+            return self.icon_cache[self.name]
+        except KeyError:
+            pass
         path = '%s/icon.html' % self.name
         try:
             tpl = get_template(path)
-            return tpl.render()
+            icon = tpl.render()
         except TemplateDoesNotExist:
-            return ''
+            icon = ''
+        self.icon_cache[self.name] = icon
+        return icon
 
 
 
@@ -129,11 +420,170 @@ class SpacePlugin(models.Model):
     reverse_url = ''
 
 
+class SpacePluginStates(object):
+    """
+    The plugin models (SpacePlugin subclass instances) of all registered
+    plugins for one space.
+
+    Plugin models inheriting from SpacePlugin are loaded together with a
+    single query on the SpacePlugin table, joining all subclass tables.
+    Other plugin models cost one query each. Missing rows are only created
+    when asked for with create=True (as get_instance() does), so rendering
+    plugin states never writes to the database.
+
+    Use SpacePluginStates.for_space() to get the states memoized on the
+    space object, so e.g. all template filters handling request.SPACE share
+    them.
+    """
+    attr_name = '_space_plugin_states'
+
+    def __init__(self, space):
+        self.space = space
+        self._instances = None
+
+    @classmethod
+    def for_space(cls, space):
+        """Return the memoized plugin states for the given space."""
+        if space is None:
+            return cls(None)
+        try:
+            return getattr(space, cls.attr_name)
+        except AttributeError:
+            states = cls(space)
+            setattr(space, cls.attr_name, states)
+            return states
+
+    @classmethod
+    def clear(cls, space):
+        space.__dict__.pop(cls.attr_name, None)
+
+    @staticmethod
+    def plugin_models():
+        models = []
+        for plugin in SpacePluginRegistry.plugins:
+            if plugin.plugin_model is not None and plugin.plugin_model not in models:
+                models.append(plugin.plugin_model)
+        return models
+
+    def manager(self, model):
+        # with the space as hint, routers can pick the database of its
+        # plugins (see spaces.routers)
+        return model.objects.db_manager(hints={'instance': self.space})
+
+    def load(self):
+        instances = {}
+        if self.space is None or self.space.pk is None:
+            return instances
+        children = {}
+        for model in self.plugin_models():
+            parent_link = model._meta.parents.get(SpacePlugin)
+            if parent_link is not None:
+                children[parent_link.related_query_name()] = model
+            else:
+                instances[model] = self.manager(model).filter(space=self.space).first()
+        if children:
+            rows = (self.manager(SpacePlugin).filter(space=self.space)
+                        .select_related(*children).order_by('pk'))
+            for row in rows:
+                for name, model in children.items():
+                    instance = getattr(row, name, None)
+                    if instance is not None:
+                        instances.setdefault(model, instance)
+        return instances
+
+    def get(self, model, create=False):
+        """
+        Return the instance of the given plugin model for this space, or
+        None if there is none (and create is False).
+        """
+        if self._instances is None:
+            self._instances = self.load()
+        instance = self._instances.get(model)
+        if instance is None and create:
+            instance = self.manager(model).get_or_create(space=self.space)[0]
+            self._instances[model] = instance
+        return instance
+
+
+class SearchTerm(models.Model):
+    """
+    One entry of the search index: how often a term occurs in the
+    searchable fields of an object belonging to a space.
+    Maintained by spaces.search, don't write to it directly.
+    """
+    space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name='+')
+    term = models.CharField(max_length=64)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, related_name='+')
+    object_id = models.PositiveIntegerField()
+    weight = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['space', 'term']),
+            models.Index(fields=['content_type', 'object_id']),
+        ]
+
+    def __str__(self):
+        return '%s: %s' % (self.space_id, self.term)
+
+
 class SpacePluginFieldNameNotConfigured(Exception):
     """Raised if you forgot to set spaceplugin_field_name in a model"""
     pass
 
-class SpaceManager(models.Manager):
+class SpaceQuerySet(models.QuerySet):
+    """
+    Filter objects of a SpaceModel by space, e.g.
+
+        Ticket.objects.filter(done=False).in_space(request.SPACE)
+
+    The plugin rows of the space are looked up first (one small query on
+    the plugin table), then the objects are filtered on the foreign key
+    column itself, so the query doesn't join the plugin and space tables.
+    """
+
+    def get_spaceplugin_field(self):
+        field_name = self.model.spaceplugin_field_name
+        if field_name is None:
+            msg = "Someone forgot to set spaceplugin_fieldname in model %s" % self.model
+            raise SpacePluginFieldNameNotConfigured(msg)
+        return self.model._meta.get_field(field_name)
+
+    def plugin_ids(self, spaces):
+        """
+        Return the pks of all rows of the plugin model in the given spaces
+        (Space instances or pks).
+        """
+        plugin_model = self.get_spaceplugin_field().related_model
+        space_ids = [getattr(space, 'pk', space) for space in spaces]
+        if issubclass(plugin_model, SpacePlugin):
+            # children share their pk with the SpacePlugin row, so there's
+            # no need to join their own table
+            plugin_model = SpacePlugin
+        return list(plugin_model._base_manager.using(self.db)
+                        .filter(space__in=space_ids).values_list('pk', flat=True))
+
+    def in_spaces(self, spaces, select_related=None):
+        """
+        Restrict to objects in any of the given spaces. With select_related
+        (defaults to the space_select_related attribute of the model) the
+        plugin and its space are fetched along with each object.
+        """
+        field = self.get_spaceplugin_field()
+        ids = self.plugin_ids(spaces)
+        queryset = self.filter(**{field.attname + '__in': ids}) if ids else self.none()
+        if select_related is None:
+            select_related = self.model.space_select_related
+        if select_related:
+            queryset = queryset.select_related(field.name + '__space')
+        return queryset
+
+    def in_space(self, space, select_related=None):
+        """Restrict to objects in the given space, see in_spaces()."""
+        return self.in_spaces([space], select_related=select_related)
+
+
+class SpaceManager(models.Manager.from_queryset(SpaceQuerySet)):
     """
     We often need a way to filter search results by current space. Inside an app that's easy: 
     We know how the field with the foreign key to a SpacePlugin is called, so we can just use that:
@@ -143,20 +593,52 @@ class SpaceManager(models.Manager):
       * the model has to set the "spaceplugin_fieldname" to the corresponding field.
       * the model has to subclass not models.Model, but SpaceModel, thus inheriting this manager.
     Now the model automatically can filter results to current space with Model.objects.in_space(space).
+    Both in_space() and in_spaces() are available on querysets, too (see SpaceQuerySet).
     """
-    
-    def in_space(self, space):
-        try:
-            filterargs = {self.model.spaceplugin_field_name+"__space": space}
-        except TypeError:
-            msg = "Someone forgot to set spaceplugin_fieldname in model %s" % self.model
-            raise SpacePluginFieldNameNotConfigured(msg)
-        return super(SpaceManager, self).get_queryset().filter(**filterargs)
 
 
 class SpaceModel(models.Model):
     objects = SpaceManager()
     spaceplugin_field_name = None
+    # set to True to have in_space() fetch the plugin and space of each object
+    space_select_related = False
 
     class Meta:
-        abstract = True
\ No newline at end of file
+        abstract = True
+
+    @classmethod
+    def check(cls, **kwargs):
+        errors = super(SpaceModel, cls).check(**kwargs)
+        errors.extend(cls._check_spaceplugin_index())
+        return errors
+
+    @classmethod
+    def _check_spaceplugin_index(cls):
+        """
+        in_space() filters on the spaceplugin field. Lists of a space are
+        usually also ordered or filtered by other columns, which needs an
+        index starting with that field.
+        """
+        if cls.spaceplugin_field_name is None:
+            return []
+        try:
+            field = cls._meta.get_field(cls.spaceplugin_field_name)
+        except FieldDoesNotExist:
+            return [checks.Error(
+                "spaceplugin_field_name refers to the nonexistent field '%s'."
+                % cls.spaceplugin_field_name, obj=cls, id='spaces.E001')]
+        leading = set()
+        composite = [index.fields for index in cls._meta.indexes]
+        composite.extend(cls._meta.index_together)
+        composite.extend(cls._meta.unique_together)
+        for fields in composite:
+            if len(fields) > 1:
+                leading.add(fields[0].lstrip('-'))
+        if field.name in leading or field.attname in leading:
+            return []
+        return [checks.Warning(
+            "%s.%s has no composite index starting with it." % (
+                cls._meta.object_name, field.name),
+            hint="Add an index like models.Index(fields=['%s', <ordering "
+                 "column>]) to Meta.indexes." % field.name,
+            obj=cls, id='spaces.W001')]
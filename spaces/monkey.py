@@ -1,9 +1,64 @@
 # coding: utf-8
+import threading
+from collections import OrderedDict
 
+from django.conf import settings
+from django.urls import resolvers
 from django.utils import translation
 from .util import get_space_prefix
 #import util
 
+
+class BoundedDict(OrderedDict):
+    """
+    Dictionary keeping only the maxsize most recently used keys.
+    """
+
+    def __init__(self, maxsize, *args, **kwargs):
+        self.maxsize = maxsize
+        self._lock = threading.RLock()
+        super(BoundedDict, self).__init__(*args, **kwargs)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = super(BoundedDict, self).__getitem__(key)
+            self.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super(BoundedDict, self).__setitem__(key, value)
+            self.move_to_end(key)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+
+
+def get_resolver_language():
+    """
+    Django's URL resolvers cache their reverse lookups per language. As
+    reversed URLs contain the space prefix, they have to be cached per
+    space instead.
+    """
+    return get_space_prefix() or translation.get_language()
+
+
+_populate = resolvers.URLResolver._populate
+
+
+def _bounded_populate(self):
+    """
+    Keep the lookups of at most SPACES_URL_RESOLVER_CACHE_SIZE spaces per
+    resolver, instead of one set per space ever seen.
+    """
+    maxsize = getattr(settings, 'SPACES_URL_RESOLVER_CACHE_SIZE', 1000)
+    for attr in ('_reverse_dict', '_namespace_dict', '_app_dict'):
+        lookups = getattr(self, attr)
+        if not isinstance(lookups, BoundedDict):
+            setattr(self, attr, BoundedDict(maxsize, lookups))
+    _populate(self)
+
+
 def patch():
     """🙈 🙉 🙊"""
-    translation.trans_real.get_language = get_space_prefix
+    resolvers.get_language = get_resolver_language
+    resolvers.URLResolver._populate = _bounded_populate
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+In-process snapshot of the registered space plugins.
+
+django-plugins looks up plugins in its database tables on every
+get_plugin() / get_plugins() call. The snapshot keeps the registered
+plugin classes by name, built from the SpacePluginRegistry subclasses when
+the app is ready, and only reads which of them are enabled from the
+database again after a plugin has been changed (the plugin version in
+spaces.cache is bumped then).
+
+sync_plugins() runs django-plugins' sync only if the set of registered
+plugins changed since the last sync, see the syncspaceplugins command.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from djangoplugins.models import ENABLED, REMOVED, Plugin
+from djangoplugins.point import PluginMount
+from djangoplugins.utils import (
+    db_table_exists, get_plugin_from_string, get_plugin_name, load_plugins)
+
+from .cache import (
+    PLUGIN_VERSION_KEY, bump_plugin_version, get_generation, get_spaces_cache)
+
+SYNC_HASH_KEY = 'spaces:plugins:synced'
+
+
+def plugins_hash(points=None):
+    """
+    Return a hash of all registered plugin points and plugins, with
+    everything django-plugins stores about them.
+    """
+    digest = hashlib.sha1()
+    for point in sorted(points or PluginMount.points, key=get_plugin_name):
+        digest.update(('%s\n' % get_plugin_name(point)).encode('utf-8'))
+        for plugin in sorted(point.plugins, key=get_plugin_name):
+            digest.update(('\t%s\t%s\t%s\n' % (
+                get_plugin_name(plugin), getattr(plugin, 'name', None),
+                getattr(plugin, 'title', ''))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class PluginSnapshot(object):
+    """
+    The plugins of one plugin point, by name.
+    """
+
+    def __init__(self, point):
+        self.point = point
+        self._lock = threading.Lock()
+        self._modules_loaded = False
+        self._enabled = None
+        self.refresh()
+
+    def refresh(self):
+        """Take the currently registered plugin classes."""
+        self.classes = dict((get_plugin_name(plugin), plugin) for plugin in self.point.plugins)
+
+    def load_plugin_modules(self):
+        """
+        Import the plugins modules of all apps, once. Only needed for
+        plugins that aren't defined in modules imported anyway.
+        """
+        if not self._modules_loaded:
+            self._modules_loaded = True
+            load_plugins()
+            self.refresh()
+            from .signals import connect_search_receivers
+            connect_search_receivers()  # for searchable_fields of new plugins
+
+    def get_class(self, pythonpath):
+        plugin = self.classes.get(pythonpath)
+        if plugin is None:  # registered after the snapshot was taken?
+            self.refresh()
+            plugin = self.classes.get(pythonpath)
+        if plugin is None:
+            self.load_plugin_modules()
+            plugin = self.classes.get(pythonpath)
+        if plugin is None:
+            try:
+                plugin = get_plugin_from_string(pythonpath)
+            except (ImportError, AttributeError):
+                return None
+        return plugin
+
+    def load(self):
+        """Return the enabled plugin classes by name, in their order."""
+        enabled = OrderedDict()
+        if not db_table_exists(Plugin._meta.db_table):
+            return enabled
+        paths = Plugin.objects.filter(
+            point__pythonpath=get_plugin_name(self.point), status=ENABLED
+        ).order_by('index').values_list('pythonpath', flat=True)
+        for pythonpath in paths:
+            plugin = self.get_class(pythonpath)
+            if plugin is not None:
+                enabled[plugin.name] = plugin
+        return enabled
+
+    def enabled(self):
+        version = get_generation(get_spaces_cache(), PLUGIN_VERSION_KEY)
+        cached = self._enabled
+        if cached is None or cached[0] != version:
+            with self._lock:
+                cached = (version, self.load())
+                self._enabled = cached
+        return cached[1]
+
+    def get_plugin(self, name):
+        """
+        Return an instance of the enabled plugin with the given name. Raises
+        Plugin.DoesNotExist like django-plugins does.
+        """
+        try:
+            return self.enabled()[name]()
+        except KeyError:
+            raise Plugin.DoesNotExist('No enabled plugin named %r.' % name)
+
+    def get_plugins(self):
+        return [plugin() for plugin in self.enabled().values()]
+
+
+_snapshot = None
+
+
+def get_snapshot():
+    """Return the snapshot of the SpacePluginRegistry plugins."""
+    global _snapshot
+    if _snapshot is None:
+        from .models import SpacePluginRegistry
+        _snapshot = PluginSnapshot(SpacePluginRegistry)
+    return _snapshot
+
+
+def sync_plugins(force=False, verbosity=0):
+    """
+    Sync the registered plugins to the database like the syncplugins
+    command, unless nothing changed since the last sync. Returns True if it
+    synced.
+    """
+    from djangoplugins.management.commands.syncplugins import SyncPlugins
+    load_plugins()
+    if not db_table_exists(Plugin._meta.db_table):
+        return False
+    cache = get_spaces_cache()
+    current = plugins_hash()
+    registered = sum(len(point.plugins) for point in PluginMount.points)
+    if not force and cache.get(SYNC_HASH_KEY) == current and \
+            Plugin.objects.exclude(status=REMOVED).count() == registered:
+        return False
+    SyncPlugins(False, verbosity).all()
+    cache.set(SYNC_HASH_KEY, current, None)
+    bump_plugin_version()
+    get_snapshot().refresh()
+    return True
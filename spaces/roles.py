@@ -1,24 +1,282 @@
 # -*- coding: utf-8 -*-
-from django.contrib.auth.models import Group
+import functools
+
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
 from guardian.shortcuts import assign_perm
+from guardian.utils import get_group_obj_perms_model, get_user_obj_perms_model
+
+from .backends import invalidate_space_permissions
+from .models import Space, SpaceRole
+from .util import chunked
+
+ROLE_ADMINS = SpaceRole.ADMINS
+ROLE_TEAM = SpaceRole.TEAM
+ROLE_MEMBERS = SpaceRole.MEMBERS
+ROLES = (ROLE_ADMINS, ROLE_TEAM, ROLE_MEMBERS)
+ROLE_LABELS = dict(SpaceRole.ROLE_CHOICES)
+
+# object permissions each role group gets for its space
+ROLE_PERMISSIONS = {
+    ROLE_ADMINS: ('access_space', 'add_space_member'),
+    ROLE_TEAM: ('access_space', 'add_space_member'),  # user create functionality
+    ROLE_MEMBERS: ('access_space',),
+}
+
+
+def role_group_name(space, role):
+    return '%s: %s' % (str(space.pk), ROLE_LABELS[role])
+
 
 def roles_init_new(space):
     '''
     Create new groups for the space
     '''
-    space_admins = Group.objects.get_or_create(name='%s: Space Admins' % str(space.pk))[0]
-    team = Group.objects.get_or_create(name='%s: Team' % str(space.pk))[0]
-    members = Group.objects.get_or_create(name='%s: Members' % str(space.pk))[0]
-
-    # ADMIN ALL GROUPS #
-    assign_perm('access_space', members, space)
-    assign_perm('access_space', team, space)
-    assign_perm('access_space', space_admins, space)
-    assign_perm('add_space_member', space_admins, space)  # user create functionality
-    assign_perm('add_space_member', team, space)  # user create functionality
-
-
-# noch unklar, ob ich das SpaceGroup-Model wirklich brauche. Ich versuchs erstmal ohne. 
-#    SpaceGroup.objects.get_or_create(group=g1, event=event)
-#    SpaceGroup.objects.get_or_create(group=g2, event=event)
-    return True
\ No newline at end of file
+    for role in ROLES:
+        group = Group.objects.get_or_create(name=role_group_name(space, role))[0]
+        SpaceRole.objects.get_or_create(space=space, role=role, defaults={'group': group})
+        for perm in ROLE_PERMISSIONS[role]:
+            assign_perm(perm, group, space)
+    return True
+
+
+def roles_init_bulk(spaces, batch_size=500):
+    '''
+    Same as roles_init_new(), but for many saved spaces at once. Groups,
+    SpaceRoles and guardian permissions are created with a handful of
+    batched queries.
+    '''
+    names = dict(((space.pk, role), role_group_name(space, role))
+                 for space in spaces for role in ROLES)
+    group_ids = {}
+    for chunk in chunked(names.values(), batch_size):
+        group_ids.update(
+            Group.objects.filter(name__in=chunk).values_list('name', 'pk'))
+    Group.objects.bulk_create(
+        [Group(name=name) for name in names.values() if name not in group_ids],
+        batch_size=batch_size)
+    for chunk in chunked(names.values(), batch_size):
+        group_ids.update(
+            Group.objects.filter(name__in=chunk).values_list('name', 'pk'))
+
+    SpaceRole.objects.bulk_create(
+        [SpaceRole(space_id=space_id, role=role, group_id=group_ids[name])
+         for (space_id, role), name in names.items()],
+        batch_size=batch_size)
+
+    ctype = ContentType.objects.get_for_model(Space)
+    permission_ids = dict(Permission.objects.filter(
+        content_type=ctype,
+        codename__in=set(p for perms in ROLE_PERMISSIONS.values() for p in perms),
+    ).values_list('codename', 'pk'))
+    GroupObjectPermission = get_group_obj_perms_model()
+    GroupObjectPermission.objects.bulk_create(
+        [GroupObjectPermission(
+            group_id=group_ids[name],
+            permission_id=permission_ids[perm],
+            content_type=ctype,
+            object_pk=str(space_id))
+         for (space_id, role), name in names.items()
+         for perm in ROLE_PERMISSIONS[role]],
+        batch_size=batch_size)
+
+
+def _user_ids(users):
+    return [getattr(user, 'pk', user) for user in users]
+
+
+def _clear_memoized(users):
+    for user in users:
+        if hasattr(user, 'pk'):
+            SpaceRoles.clear(user)
+
+
+def _role_groups(space, roles):
+    """
+    Return {role: group pk} for the roles of the space. Role groups that
+    are missing (e.g. spaces from before SpaceRole whose data migration
+    hasn't run yet) are created first.
+    """
+    unknown = set(roles) - set(ROLES)
+    if unknown:
+        raise ValueError('Unknown role(s): %s' % ', '.join(sorted(unknown)))
+    groups = dict(SpaceRole.objects.filter(space=space, role__in=roles)
+                  .values_list('role', 'group_id'))
+    if len(groups) < len(set(roles)):
+        roles_init_new(space)
+        groups = dict(SpaceRole.objects.filter(space=space, role__in=roles)
+                      .values_list('role', 'group_id'))
+    return groups
+
+
+def _remove_from_groups(group_ids, user_ids):
+    # there are no delete signals for memberships, so this is a single
+    # DELETE without fetching the rows first
+    return User.groups.through.objects.filter(
+        group_id__in=group_ids, user_id__in=user_ids).delete()[0]
+
+
+def _send_members_changed(space, action, roles, user_ids):
+    """
+    Send space_members_changed once the current transaction is committed,
+    so receivers never see (or cache) memberships that are rolled back.
+    """
+    from .signals import space_members_changed
+    transaction.on_commit(functools.partial(
+        space_members_changed.send, sender=Space, space=space, action=action,
+        roles=roles, user_ids=user_ids))
+
+
+def add_members(space, users, role=ROLE_MEMBERS, batch_size=500):
+    """
+    Add users (User instances or pks) to a role of the space. Users that
+    already have the role are skipped.
+
+    Works on the group membership table directly: one INSERT per batch of
+    users and one space_members_changed signal per batch instead of an
+    m2m_changed signal per user. Every batch is a transaction of its own.
+    """
+    Membership = User.groups.through
+    group_id = _role_groups(space, [role])[role]
+    for chunk in chunked(users, batch_size):
+        user_ids = _user_ids(chunk)
+        with transaction.atomic():
+            Membership.objects.bulk_create(
+                [Membership(user_id=user_id, group_id=group_id) for user_id in user_ids],
+                ignore_conflicts=True)
+            _send_members_changed(space, 'add', [role], user_ids)
+        _clear_memoized(chunk)
+
+
+def remove_members(space, users, roles=ROLES, batch_size=500):
+    """
+    Remove users (User instances or pks) from the given roles of the space,
+    by default from all of them. Returns the number of removed
+    memberships. Every batch is a transaction of its own.
+    """
+    group_ids = list(_role_groups(space, roles).values())
+    removed = 0
+    for chunk in chunked(users, batch_size):
+        user_ids = _user_ids(chunk)
+        with transaction.atomic():
+            removed += _remove_from_groups(group_ids, user_ids)
+            _send_members_changed(space, 'remove', list(roles), user_ids)
+        _clear_memoized(chunk)
+    return removed
+
+
+def change_role(space, users, role, batch_size=500):
+    """
+    Give users (User instances or pks) the role in the space, taking away
+    any other role they had there, e.g. to promote members to the team.
+    """
+    if role not in ROLES:
+        raise ValueError('Unknown role: %s' % role)
+    Membership = User.groups.through
+    groups = _role_groups(space, ROLES)
+    other_group_ids = [group_id for name, group_id in groups.items() if name != role]
+    with transaction.atomic():
+        for chunk in chunked(users, batch_size):
+            user_ids = _user_ids(chunk)
+            _remove_from_groups(other_group_ids, user_ids)
+            Membership.objects.bulk_create(
+                [Membership(user_id=user_id, group_id=groups[role]) for user_id in user_ids],
+                ignore_conflicts=True)
+            _clear_memoized(chunk)
+            _send_members_changed(space, 'change', [role], user_ids)
+
+
+def delete_roles(space):
+    """
+    Delete the role groups of the space with their memberships, and all
+    guardian permissions on it. Deleting the space alone leaves these
+    behind, and roles_init_new() would hand the groups to the next space
+    getting the same pk. Returns the number of deleted groups.
+    """
+    ctype = ContentType.objects.get_for_model(Space)
+    groups = Group.objects.filter(
+        Q(space_role__space=space) | Q(name__in=[role_group_name(space, role) for role in ROLES]))
+    group_ids = list(groups.values_list('pk', flat=True).distinct())
+    with transaction.atomic():
+        get_group_obj_perms_model().objects.filter(
+            Q(group_id__in=group_ids) | Q(content_type=ctype, object_pk=str(space.pk))).delete()
+        get_user_obj_perms_model().objects.filter(
+            content_type=ctype, object_pk=str(space.pk)).delete()
+        Group.objects.filter(pk__in=group_ids).delete()
+    invalidate_space_permissions(space.pk)
+    return len(group_ids)
+
+
+class SpaceRoles(object):
+    """
+    Answers "which roles does this user have in that space?".
+
+    All role memberships of the user across all spaces are fetched with a
+    single query on first use and memoized afterwards. Use
+    SpaceRoles.for_user() to get the resolver, it is kept on the user
+    object and thus shared by everything handling the same request.
+    SpacesMiddleware makes it available as request.SPACE_ROLES.
+    """
+    attr_name = '_space_roles'
+
+    def __init__(self, user):
+        self.user = user
+        self._roles = None
+
+    @classmethod
+    def for_user(cls, user):
+        """Return the memoized resolver for the given user."""
+        if user is None:
+            return cls(None)
+        try:
+            return getattr(user, cls.attr_name)
+        except AttributeError:
+            roles = cls(user)
+            setattr(user, cls.attr_name, roles)
+            return roles
+
+    @classmethod
+    def clear(cls, user):
+        """Forget memoized roles, e.g. after changing the user's groups."""
+        user.__dict__.pop(cls.attr_name, None)
+
+    def load(self):
+        roles = {}
+        if self.user is None or not self.user.is_authenticated:
+            return roles
+        memberships = SpaceRole.objects.filter(group__user=self.user)
+        for space_id, role in memberships.values_list('space_id', 'role'):
+            roles.setdefault(space_id, set()).add(role)
+        return roles
+
+    @property
+    def roles(self):
+        """Dictionary mapping space pks to the user's roles."""
+        if self._roles is None:
+            self._roles = self.load()
+        return self._roles
+
+    def get(self, space):
+        """Return the set of roles the user has in the given space."""
+        if space is None:
+            return frozenset()
+        return frozenset(self.roles.get(getattr(space, 'pk', space), ()))
+
+    def has_role(self, space, role):
+        return role in self.get(space)
+
+    def is_admin(self, space):
+        return self.has_role(space, ROLE_ADMINS)
+
+    def is_team(self, space):
+        return self.has_role(space, ROLE_TEAM)
+
+    def is_member(self, space):
+        return self.has_role(space, ROLE_MEMBERS)
+
+    def spaces(self, role=None):
+        """Return the pks of all spaces the user has the given (or any) role in."""
+        return set(pk for pk, names in self.roles.items()
+                   if role is None or role in names)
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Space-sharded database routing.
+
+SpaceShardRouter sends the plugin rows and plugin data of a space (the
+models spaces.transfer exports) to the database its SpacePlacement names.
+Everything else - spaces, roles, users, the search index, placements -
+stays in the default database. Install it with
+
+    DATABASE_ROUTERS = ['spaces.routers.SpaceShardRouter']
+
+and run migrate for every database. Queries are routed by the instance
+they start from (a Space, a plugin row, or an object loaded from a shard)
+or else by the active space (spaces.util.get_space()), so outside of
+requests use spaces.util.override(slug) to work with the data of a space.
+Queries can't join across databases: Space.objects.for_user() only counts
+active plugins in the default database, and foreign keys from plugin data
+to shared models (like users) need db_constraint=False, see check
+spaces.W002. Shards only get a copy of the Space row of their spaces, with
+a placeholder for its creator.
+
+move_space() moves a space to another database; the SpacePlugin and
+SpaceModel pks stay the same, so give every database its own pk range.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import checks
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+
+from .cache import bump_generation, get_generation, get_spaces_cache, invalidate_spaces
+from .models import Space, SpacePlacement
+from .util import get_space
+
+PLACEMENT_VERSION_KEY = 'spaces:placements:version'
+
+
+def get_placement_ttl():
+    """Seconds a worker may route with placements older than the last change."""
+    return getattr(settings, 'SPACES_PLACEMENT_TTL', 1.0)
+
+
+class Placements(object):
+    """
+    All placements, by space pk and by slug. Only moved spaces have one,
+    so they are loaded at once and reloaded after a change, checked for
+    at most every SPACES_PLACEMENT_TTL seconds.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked = 0
+        self.by_id = {}
+        self.by_slug = {}
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.version is not None and now - self.checked < get_placement_ttl():
+            return
+        self.checked = now
+        version = get_generation(get_spaces_cache(), PLACEMENT_VERSION_KEY)
+        if version != self.version:
+            rows = SpacePlacement.objects.using(DEFAULT_DB_ALIAS).values_list(
+                'space_id', 'space__slug', 'database')
+            self.by_id = dict((space_id, database) for space_id, slug, database in rows)
+            self.by_slug = dict((slug, database) for space_id, slug, database in rows)
+            self.version = version
+
+    def for_space_id(self, space_id):
+        self.refresh()
+        return self.by_id.get(space_id, DEFAULT_DB_ALIAS)
+
+    def for_slug(self, slug):
+        self.refresh()
+        return self.by_slug.get(slug, DEFAULT_DB_ALIAS)
+
+
+placements = Placements()
+
+
+def invalidate_placements():
+    bump_generation(get_spaces_cache(), PLACEMENT_VERSION_KEY)
+    placements.version = None
+
+
+def get_space_database(space):
+    """Return the alias of the database holding the data of the space."""
+    return placements.for_space_id(getattr(space, 'pk', space))
+
+
+_space_models = None
+
+
+def space_models():
+    """
+    Return {model: foreign keys to plugin models} for all models routed by
+    space: plugin models (with no such fields) and plugin data.
+    """
+    global _space_models
+    if _space_models is None:
+        from .transfer import data_models, plugin_models
+        models = dict((model, []) for model in plugin_models())
+        for model, field_names in data_models():
+            models[model] = [model._meta.get_field(name) for name in field_names]
+        _space_models = models
+    return _space_models
+
+
+def get_instance_database(instance):
+    """
+    Return the database a query starting at instance should use, or None
+    if that isn't known from the instance.
+    """
+    if isinstance(instance, Space):
+        return get_space_database(instance)
+    if instance._state.db is not None:
+        return instance._state.db
+    if type(instance) in space_models() and hasattr(instance, 'space_id'):
+        return get_space_database(instance.space_id)
+    for field in space_models().get(type(instance), ()):
+        plugin = field.get_cached_value(instance, None)
+        if plugin is not None:
+            return get_instance_database(plugin)
+    return None
+
+
+class SpaceShardRouter(object):
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if model not in space_models():
+            # shared rows referenced from a shard are read from the default
+            # database, never from their copies in the shard
+            if instance is not None and type(instance) in space_models():
+                return DEFAULT_DB_ALIAS
+            return None
+        if instance is not None:
+            database = get_instance_database(instance)
+            if database is not None:
+                return database
+        slug = get_space()
+        if slug is not None:
+            return placements.for_slug(slug)
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if type(obj1) in space_models() or type(obj2) in space_models():
+            return True
+        return None
+
+
+def placeholder_username(pk):
+    return 'spaces-placeholder-%s' % pk
+
+
+def placeholder_user(pk):
+    """
+    An inactive user without name, email or password, standing in for a
+    user kept in the default database.
+    """
+    user = User(pk=pk, username=placeholder_username(pk), is_active=False)
+    user.set_unusable_password()
+    return user
+
+
+def copy_space_row(space, database):
+    """
+    Copy the row of the space to database unless it's there already: plugin
+    rows refer to their space, so the foreign key has to be satisfied in a
+    shard as well. No other shared rows are copied - users (and their
+    password hashes) stay in the default database, so the creator of the
+    space is represented by a placeholder_user().
+    """
+    if Space._base_manager.db_manager(database).filter(pk=space.pk).exists():
+        return
+    stub = Space._base_manager.db_manager(DEFAULT_DB_ALIAS).get(pk=space.pk)
+    with transaction.atomic(using=database):
+        if not User._base_manager.db_manager(database).filter(pk=stub.created_by_id).exists():
+            placeholder_user(stub.created_by_id).save_base(
+                raw=True, force_insert=True, using=database)
+        stub.save_base(raw=True, force_insert=True, using=database)
+
+
+def delete_space_row(space, database):
+    """
+    Delete the copy of the space from database, and the placeholder of its
+    creator once no other copy refers to it.
+    """
+    spaces = Space._base_manager.db_manager(database)
+    creator = spaces.filter(pk=space.pk).values_list('created_by_id', flat=True).first()
+    with transaction.atomic(using=database):
+        spaces.filter(pk=space.pk)._raw_delete(database)
+        if creator is not None and not spaces.filter(created_by_id=creator).exists():
+            User._base_manager.db_manager(database).filter(
+                pk=creator, username=placeholder_username(creator))._raw_delete(database)
+
+
+class MoveError(Exception):
+    pass
+
+
+def space_querysets(space, database):
+    """
+    Return querysets of all rows of the space in the database: plugin rows
+    (SpacePlugin first), then plugin data, referenced models first.
+    """
+    querysets = []
+    for model, fields in space_models().items():
+        condition = Q(space=space)
+        if fields:
+            condition = Q()
+            for field in fields:
+                condition |= Q(**{'%s__space' % field.name: space})
+        querysets.append(model._base_manager.db_manager(database).filter(condition))
+    return querysets
+
+
+def copy_rows(source, target, batch_size, progress=None):
+    """
+    Copy the rows of the source queryset that target lacks, keeping their
+    pks. Returns the number of copied rows.
+    """
+    model = source.model
+    database = target.db
+    manager = model._base_manager.db_manager(database)
+    copied = 0
+    remaining = source.order_by('pk')
+    while True:
+        objects = list(remaining[:batch_size])
+        if not objects:
+            return copied
+        remaining = source.filter(pk__gt=objects[-1].pk).order_by('pk')
+        pks = [obj.pk for obj in objects]
+        present = set(target.filter(pk__in=pks).values_list('pk', flat=True))
+        taken = set(manager.filter(pk__in=pks).values_list('pk', flat=True)) - present
+        if taken:
+            raise MoveError('%s pks %s are taken in database %s.' % (
+                model._meta.label, ', '.join(str(pk) for pk in sorted(taken)), database))
+        objects = [obj for obj in objects if obj.pk not in present]
+        with transaction.atomic(using=database):
+            if model._meta.parents:
+                # bulk_create() can't do table inheritance; the parent
+                # rows have been copied already
+                for obj in objects:
+                    obj.save_base(raw=True, force_insert=True, using=database)
+            else:
+                manager.bulk_create(objects)
+        copied += len(objects)
+        if progress is not None:
+            progress(model._meta.label, copied)
+
+
+def delete_rows(queryset, batch_size):
+    database = queryset.db
+    while True:
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        # a plain DELETE without signals: the rows still exist with the
+        # same pks in the other database, so e.g. the search index is right
+        chunk = queryset.model._base_manager.db_manager(database).filter(pk__in=pks)
+        with transaction.atomic(using=database):
+            chunk._raw_delete(database)
+
+
+def begin_move(space, source):
+    """
+    Archive the space for a move, remembering on its placement whether it
+    was archived before, unless a move that got killed did so already.
+    Returns that state.
+    """
+    placement = SpacePlacement.objects.get_or_create(
+        space=space, defaults={'database': source})[0]
+    if placement.archived_before_move is None:
+        placement.archived_before_move = Space.objects.filter(
+            pk=space.pk).values_list('archived', flat=True).get()
+        placement.save(update_fields=['archived_before_move'])
+    Space.objects.filter(pk=space.pk).update(archived=True)
+    invalidate_spaces()
+    return placement.archived_before_move
+
+
+def end_move(space, archived):
+    """Restore the archived state of the space once a move is over."""
+    SpacePlacement.objects.filter(space=space, database=DEFAULT_DB_ALIAS).delete()
+    SpacePlacement.objects.filter(space=space).update(archived_before_move=None)
+    Space.objects.filter(pk=space.pk).update(archived=archived)
+    invalidate_spaces()
+
+
+def move_space(space, database, batch_size=1000, progress=None):
+    """
+    Move the plugin rows and plugin data of the space to another database.
+    The space is read-only (archived) meanwhile. If the move is
+    interrupted, run it again: rows copied already are skipped, and the
+    space gets the archived state it had before the first attempt.
+    Returns the number of copied rows.
+    """
+    if database not in settings.DATABASES:
+        raise MoveError('Unknown database %s.' % database)
+    source = get_space_database(space)
+    if source == database:
+        unfinished = SpacePlacement.objects.filter(
+            space=space, archived_before_move__isnull=False).values_list(
+            'archived_before_move', flat=True).first()
+        if unfinished is not None:
+            # killed after the switch to database: rows left behind in the
+            # old one are out of reach of the router, just finish the move
+            end_move(space, unfinished)
+            invalidate_placements()
+        return 0
+    archived = begin_move(space, source)
+    try:
+        copy_space_row(space, database)
+        copied = 0
+        for old, new in zip(space_querysets(space, source), space_querysets(space, database)):
+            copied += copy_rows(old, new, batch_size, progress)
+        connection = connections[database]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), list(space_models())):
+                cursor.execute(sql)
+
+        SpacePlacement.objects.filter(space=space).update(database=database)
+        invalidate_placements()
+        # workers route to the old database until they notice the change
+        time.sleep(get_placement_ttl())
+        for queryset in reversed(space_querysets(space, source)):
+            delete_rows(queryset, batch_size)
+        if source != DEFAULT_DB_ALIAS:
+            delete_space_row(space, source)
+    finally:
+        end_move(space, archived)
+        invalidate_placements()
+    return copied
+
+
+@checks.register(checks.Tags.database)
+def check_shard_foreign_keys(app_configs=None, **kwargs):
+    """
+    Plugin data in a shard can't have database constraints on foreign keys
+    to rows kept in the default database only.
+    """
+    if 'spaces.routers.SpaceShardRouter' not in getattr(settings, 'DATABASE_ROUTERS', ()):
+        return []
+    warnings = []
+    for model, fields in space_models().items():
+        for field in model._meta.local_concrete_fields:
+            if not field.is_relation or not field.db_constraint:
+                continue
+            if field.related_model in space_models() or field.related_model is Space:
+                continue
+            warnings.append(checks.Warning(
+                '%s.%s refers to %s, which is kept in the default database.' % (
+                    model.__name__, field.name, field.related_model._meta.label),
+                hint='Set db_constraint=False on the field.',
+                obj=model, id='spaces.W002'))
+    return warnings
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Search across the data of all plugins of a space.
+
+Plugin registries declare what to index with searchable_fields:
+
+    class TrackerPlugin(SpacePluginRegistry):
+        plugin_model = Tracker
+        searchable_fields = ((Ticket, ('title', 'body', 'author__username')),)
+
+The models listed there have to be SpaceModels (or SpacePlugins), so the
+space of each object is known. Their objects are split into terms, which
+are stored in the SearchTerm table, so their primary keys have to be
+integers. spaces.signals keeps the index up to date whenever an object is
+saved or deleted; run the rebuildsearchindex command after adding
+searchable_fields to existing data.
+
+search() only reads the index, base tables are just asked for the objects
+on the requested page.
+"""
+import re
+from collections import Counter, OrderedDict, namedtuple
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Count, IntegerField, Sum
+
+from .models import SearchTerm, Space, SpacePlugin, SpacePluginRegistry
+from .util import chunked
+
+term_re = re.compile(r'\w+')
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = SearchTerm._meta.get_field('term').max_length
+
+SearchHit = namedtuple('SearchHit', ('object', 'score', 'plugin'))
+
+
+def tokenize(text):
+    """
+    Split text into lowercase terms. Very short terms are dropped, long
+    ones are cut to fit into the index.
+    """
+    return [term[:MAX_TERM_LENGTH] for term in term_re.findall(str(text).lower())
+            if len(term) >= MIN_TERM_LENGTH]
+
+
+def check_searchable(model):
+    """SearchTerm.object_id only holds integer pks."""
+    pk = model._meta.pk
+    while pk.remote_field is not None:  # table inheritance
+        pk = pk.target_field
+    if not isinstance(pk, IntegerField):
+        raise ImproperlyConfigured(
+            '%s can\'t be searchable, its primary key is no integer.' % model._meta.label)
+
+
+_searchable_models = None
+
+
+def searchable_models():
+    """
+    Return {model: (plugin registry, field paths)} for all registered
+    plugins with searchable_fields. The mapping is built once, call
+    reset_searchable_models() after plugins changed.
+    """
+    global _searchable_models
+    if _searchable_models is not None:
+        return _searchable_models
+    models = OrderedDict()
+    for plugin in SpacePluginRegistry.plugins:
+        for model, fields in plugin.searchable_fields or ():
+            if model in models:
+                registry, known = models[model]
+                models[model] = (registry, known + tuple(f for f in fields if f not in known))
+            else:
+                check_searchable(model)
+                models[model] = (plugin, tuple(fields))
+    _searchable_models = models
+    return models
+
+
+def reset_searchable_models():
+    global _searchable_models
+    _searchable_models = None
+
+
+def get_space_id(obj):
+    """Return the pk of the space the object belongs to, or None."""
+    if isinstance(obj, SpacePlugin):
+        return obj.space_id
+    field_name = getattr(obj, 'spaceplugin_field_name', None)
+    if field_name is None:
+        return None
+    plugin = getattr(obj, field_name, None)
+    return getattr(plugin, 'space_id', None)
+
+
+def field_values(obj, path):
+    """
+    Follow a "field__relatedfield" path starting at obj and yield the
+    values found at its end. To-many relations are followed as well.
+    """
+    name, _, rest = path.partition('__')
+    value = getattr(obj, name, None)
+    if value is None:
+        return
+    if hasattr(value, 'all') and callable(value.all):
+        related = value.all()
+    else:
+        related = [value]
+    for item in related:
+        if rest:
+            yield from field_values(item, rest)
+        else:
+            yield item
+
+
+def get_terms(obj, fields):
+    """Return a Counter of all terms in the given fields of obj."""
+    terms = Counter()
+    for path in fields:
+        for value in field_values(obj, path):
+            terms.update(tokenize(value))
+    return terms
+
+
+def _delete_terms(**filters):
+    # A plain DELETE; nothing refers to index rows, and going through
+    # Collector would fetch each of them first if any other app listens to
+    # post_delete of all models.
+    queryset = SearchTerm.objects.filter(**filters)
+    queryset._raw_delete(queryset.db)
+
+
+def _unindex(content_type, object_ids):
+    _delete_terms(content_type=content_type, object_id__in=object_ids)
+
+
+def _index_rows(content_type, obj, fields):
+    space_id = get_space_id(obj)
+    if space_id is None:
+        return []
+    return [
+        SearchTerm(space_id=space_id, term=term, content_type=content_type,
+                   object_id=obj.pk, weight=weight)
+        for term, weight in get_terms(obj, fields).items()]
+
+
+def index_object(obj):
+    """
+    (Re-)index one object. Does nothing for models that aren't searchable.
+    """
+    config = searchable_models().get(type(obj))
+    if config is None:
+        return
+    content_type = ContentType.objects.get_for_model(obj)
+    with transaction.atomic():
+        _unindex(content_type, [obj.pk])
+        SearchTerm.objects.bulk_create(_index_rows(content_type, obj, config[1]))
+
+
+def unindex_object(obj):
+    """Remove one object from the index."""
+    if type(obj) in searchable_models():
+        _unindex(ContentType.objects.get_for_model(obj), [obj.pk])
+
+
+def rebuild_index(space=None, batch_size=500):
+    """
+    Rebuild the index of the given space, or of all spaces. Returns the
+    number of indexed objects.
+    """
+    count = 0
+    for model, (registry, fields) in searchable_models().items():
+        content_type = ContentType.objects.get_for_model(model)
+        if issubclass(model, SpacePlugin):
+            queryset = model.objects.all()
+            if space is not None:
+                queryset = queryset.filter(space=space)
+        elif space is not None:
+            queryset = model.objects.in_space(space)
+        else:
+            queryset = model.objects.all()
+        with transaction.atomic():
+            if space is None:
+                _delete_terms(content_type=content_type)
+            else:
+                _delete_terms(content_type=content_type, space=space)
+            for chunk in chunked(queryset.order_by('pk').iterator(), batch_size):
+                rows = []
+                for obj in chunk:
+                    rows.extend(_index_rows(content_type, obj, fields))
+                SearchTerm.objects.bulk_create(rows, batch_size=batch_size)
+                count += len(chunk)
+    return count
+
+
+def search(space, query, page=1, per_page=None):
+    """
+    Search the data of all plugins in the given space.
+
+    Every term of the query has to occur in an object. Hits are ranked by
+    how often the terms occur, and returned as a Page (see
+    django.core.paginator) of SearchHit tuples (object, score, plugin).
+    """
+    if per_page is None:
+        per_page = getattr(settings, 'SPACES_SEARCH_PAGE_SIZE', 20)
+    terms = set(tokenize(query))
+    space_id = space.pk if isinstance(space, Space) else space
+    matches = (SearchTerm.objects
+               .filter(space_id=space_id, term__in=terms)
+               .values('content_type', 'object_id')
+               .annotate(score=Sum('weight'), matched=Count('term'))
+               .filter(matched=len(terms))
+               .order_by('-score', 'content_type', 'object_id'))
+    if not terms:
+        matches = matches.none()
+    page = Paginator(matches, per_page).get_page(page)
+
+    registries = dict((model, registry) for model, (registry, fields)
+                      in searchable_models().items())
+    ids = {}
+    for match in page.object_list:
+        ids.setdefault(match['content_type'], []).append(match['object_id'])
+    objects = {}
+    for content_type_id, object_ids in ids.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        for pk, obj in model._base_manager.in_bulk(object_ids).items():
+            objects[content_type_id, pk] = obj
+    hits = []
+    for match in page.object_list:
+        obj = objects.get((match['content_type'], match['object_id']))
+        if obj is not None:
+            hits.append(SearchHit(obj, match['score'], registries.get(type(obj))))
+    page.object_list = hits
+    return page
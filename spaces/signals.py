@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.signals import setting_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from djangoplugins.models import Plugin
+from guardian.utils import get_group_obj_perms_model, get_user_obj_perms_model
+
+from .backends import invalidate_space_permissions, invalidate_user_permissions
+from .cache import (
+    bump_plugin_version, invalidate_space_cache, invalidate_spaces, reset_resolution_cache)
+from .instrumentation import reset_metrics_store
+from .models import Space, SpacePlacement, SpacePlugin, SpaceRole
+from .roles import SpaceRoles
+from .routers import invalidate_placements
+from .search import (
+    index_object, reset_searchable_models, searchable_models, unindex_object)
+from .throttling import reset_rate_limiter
+
+# Sent by the closeexpiredspaces command for every batch of spaces it
+# archived, with the list of their pks as ``space_ids`` argument.
+spaces_archived = Signal()
+
+# Sent by the bulk membership functions of spaces.roles once per batch,
+# after it has been committed, with the arguments space, action ("add",
+# "remove" or "change"), roles and user_ids. Unlike m2m_changed it covers
+# many users at once.
+space_members_changed = Signal()
+
+
+@receiver(post_save, sender=Space)
+@receiver(post_delete, sender=Space)
+def invalidate_space_resolution(sender, instance, **kwargs):
+    """
+    Renamed, archived or deleted spaces have to be resolved anew by all
+    workers, and everything cached for them is stale.
+    """
+    invalidate_spaces()
+    invalidate_space_cache(instance.pk)
+
+
+@receiver(spaces_archived)
+def invalidate_archived_spaces(sender, space_ids, **kwargs):
+    """closeexpiredspaces archives with UPDATE, sending no post_save."""
+    for space_id in space_ids:
+        invalidate_space_cache(space_id)
+
+
+@receiver(post_save, sender=Space)
+@receiver(post_save, sender=SpacePlacement)
+@receiver(post_delete, sender=SpacePlacement)
+def placement_changed(sender, instance, **kwargs):
+    """SpaceShardRouter looks placements up by slug, too."""
+    invalidate_placements()
+
+
+def bump_space_plugin_version(sender, instance, **kwargs):
+    """
+    Plugin navigation etc. cached for a space is stale once one of its
+    plugin models changed.
+    """
+    bump_plugin_version(instance.space_id)
+    invalidate_space_cache(instance.space_id)
+
+
+def connect_plugin_receivers():
+    """
+    Connect bump_space_plugin_version to the concrete plugin models only,
+    so writes of other models don't go through it. Called when the app is
+    ready, i.e. once all models are loaded.
+    """
+    for model in apps.get_models():
+        if issubclass(model, SpacePlugin):
+            post_save.connect(bump_space_plugin_version, sender=model)
+            post_delete.connect(bump_space_plugin_version, sender=model)
+
+
+def update_search_index(sender, instance, raw=False, **kwargs):
+    """Objects of searchable plugin models are indexed on every save."""
+    if not raw:
+        index_object(instance)
+
+
+def remove_from_search_index(sender, instance, **kwargs):
+    unindex_object(instance)
+
+
+_search_senders = set()
+
+
+def connect_search_receivers():
+    """
+    Connect the search index receivers to the searchable models only, and
+    disconnect them from models that aren't searchable anymore. Called when
+    the app is ready and whenever plugins changed.
+    """
+    reset_searchable_models()
+    models = set(searchable_models())
+    for model in _search_senders - models:
+        post_save.disconnect(update_search_index, sender=model)
+        post_delete.disconnect(remove_from_search_index, sender=model)
+    for model in models - _search_senders:
+        post_save.connect(update_search_index, sender=model)
+        post_delete.connect(remove_from_search_index, sender=model)
+    _search_senders.clear()
+    _search_senders.update(models)
+
+
+@receiver(post_save, sender=Plugin)
+@receiver(post_delete, sender=Plugin)
+def bump_all_plugin_versions(sender, instance, **kwargs):
+    """A plugin has been enabled, disabled or removed."""
+    bump_plugin_version()
+    invalidate_space_cache()
+    connect_search_receivers()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def group_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Memoized roles and cached permissions of a user are stale once its
+    groups changed.
+    """
+    if not reverse:
+        # instance is a user, pk_set holds groups (but is None when clearing)
+        if action == 'pre_clear':
+            instance._cleared_group_pks = list(instance.groups.values_list('pk', flat=True))
+        elif action == 'post_clear':
+            pk_set = instance.__dict__.pop('_cleared_group_pks', ())
+        if action.startswith('post_'):
+            SpaceRoles.clear(instance)
+            invalidate_user_permissions(instance.pk, instance)
+            invalidate_role_spaces(pk_set)
+        return
+    # instance is a group, pk_set holds users (but is None when clearing)
+    if action == 'pre_clear':
+        instance._cleared_user_pks = list(instance.user_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_user_pks', ())
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        for user_pk in pk_set or ():
+            invalidate_user_permissions(user_pk)
+        invalidate_role_spaces([instance.pk])
+
+
+def invalidate_role_spaces(group_pks):
+    """Drop the cached data of the spaces whose role groups changed."""
+    if group_pks:
+        for space_id in set(SpaceRole.objects.filter(
+                group_id__in=group_pks).values_list('space_id', flat=True)):
+            invalidate_space_cache(space_id)
+
+
+@receiver(post_save, sender=SpaceRole)
+@receiver(post_delete, sender=SpaceRole)
+def space_role_changed(sender, instance, **kwargs):
+    invalidate_space_cache(instance.space_id)
+
+
+@receiver(space_members_changed)
+def invalidate_member_permissions(sender, space, **kwargs):
+    """
+    One bump of the space's permission version covers all users of the
+    batch.
+    """
+    invalidate_space_permissions(space.pk)
+    invalidate_space_cache(space.pk)
+
+
+def object_permission_changed(sender, instance, **kwargs):
+    """
+    Guardian permission rows of a space have been assigned or removed.
+    """
+    if instance.content_type_id == ContentType.objects.get_for_model(Space).pk:
+        invalidate_space_permissions(instance.object_pk)
+
+
+for model in (get_user_obj_perms_model(), get_group_obj_perms_model()):
+    post_save.connect(object_permission_changed, sender=model)
+    post_delete.connect(object_permission_changed, sender=model)
+
+
+@receiver(setting_changed)
+def reset_space_caches(sender, setting, **kwargs):
+    if setting in ('SPACES_RESOLUTION_CACHE', 'CACHES'):
+        reset_resolution_cache()
+    if setting in ('SPACES_INSTRUMENTATION_STORE', 'SPACES_CACHE_ALIAS', 'CACHES'):
+        reset_metrics_store()
+    if setting in ('SPACES_RATE_LIMITER', 'SPACES_RATE_LIMITS', 'SPACES_CACHE_ALIAS', 'CACHES'):
+        reset_rate_limiter()
@@ -1,8 +1,14 @@
 from django import template
+from django.conf import settings
 from django.template.base import TemplateSyntaxError, Node, kwarg_re
-from django.urls import reverse
+from django.template.loader import get_template
+from django.urls import NoReverseMatch, reverse
+from django.utils.html import conditional_escape
 
-from spaces.models import Space, SpacePluginRegistry
+from spaces.cache import get_plugin_version, get_spaces_cache
+from spaces.models import Space, SpacePluginRegistry, keyset_cursor
+from spaces.roles import SpaceRoles
+from spaces.util import override
 
 register = template.Library()
 
@@ -24,17 +30,125 @@ class IsSpaceNode(template.Node):
         return retval
 
 class SpaceNode(template.defaulttags.URLNode):
+    """
+    Reverses the URL once per view name and arguments within a render, with
+    a placeholder as space prefix. Every link then only needs the slug of
+    its space substituted for the placeholder, instead of another pass
+    through the URL resolver.
+    """
+    placeholder = '__space__'
+
     def __init__(self,space, view_name, args, kwargs, asvar):
-        self.space = template.Variable(space)
+        self.space = space
         super(SpaceNode, self).__init__(view_name, args, kwargs, asvar)
 
+    def get_current_app(self, context):
+        try:
+            return context.request.current_app
+        except AttributeError:
+            try:
+                return context.request.resolver_match.namespace
+            except AttributeError:
+                return None
+
+    def reverse(self, context, view_name, args, kwargs):
+        """
+        Return the URL with the placeholder as space prefix (if the view is
+        inside space_patterns() at all).
+        """
+        urls = context.render_context.setdefault(self, {})
+        try:
+            key = (view_name, tuple(args), tuple(sorted(kwargs.items())))
+            return urls[key]
+        except TypeError:  # unhashable arguments
+            key = None
+        except KeyError:
+            pass
+        with override(self.placeholder):
+            url = reverse(view_name, args=args, kwargs=kwargs,
+                          current_app=self.get_current_app(context))
+        if key is not None:
+            urls[key] = url
+        return url
+
     def render(self,context):
+        space = self.space.resolve(context)
+        slug = getattr(space, 'slug', space) or None
+        args = [arg.resolve(context) for arg in self.args]
+        kwargs = dict((k, v.resolve(context)) for k, v in self.kwargs.items())
+        view_name = self.view_name.resolve(context)
+        url = ''
         try:
-            space = self.space.resolve(context)
-            retval =  space.slug
-        except template.VariableDoesNotExist:
-            retval =  ''
-        return retval + super(SpaceNode, self).render(context)
+            url = self.reverse(context, view_name, args, kwargs)
+        except NoReverseMatch:
+            if self.asvar is None:
+                raise
+        else:
+            placeholder = '/%s/' % self.placeholder
+            url = url.replace(placeholder, '/%s/' % slug if slug else '/', 1)
+        if self.asvar:
+            context[self.asvar] = url
+            return ''
+        if context.autoescape:
+            url = conditional_escape(url)
+        return url
+
+class SpacePluginNavNode(template.Node):
+    default_template = 'spaces/plugin_nav.html'
+
+    def __init__(self, space, template_name=None):
+        self.space = space
+        self.template_name = template_name
+
+    def get_roles(self, context, space):
+        request = context.get('request')
+        user = getattr(request, 'user', None) or context.get('user')
+        if user is None:
+            return ''
+        return ','.join(sorted(SpaceRoles.for_user(user).get(space)))
+
+    def get_plugins(self, space):
+        plugins = []
+        for plugin in SpacePluginRegistry.get_plugins():
+            if not plugin.is_active(space):
+                continue
+            url_name = plugin.reverse_url(space)
+            url = ''
+            if url_name:
+                # the links point into the given space, whatever space
+                # is active, as the menu is cached for that space
+                with override(space.slug):
+                    url = reverse(url_name)
+            plugins.append({
+                'plugin': plugin,
+                'name': plugin.name,
+                'title': plugin.title,
+                'icon': plugin.get_icon(),
+                'url': url,
+            })
+        return plugins
+
+    def render(self, context):
+        space = self.space.resolve(context)
+        if not space:
+            return ''
+        template_name = self.default_template
+        if self.template_name is not None:
+            template_name = self.template_name.resolve(context)
+        roles = self.get_roles(context, space)
+        key = 'spaces:plugin_nav:%s:%s:%s:%s:%s' % (
+            space.pk, space.slug, get_plugin_version(space.pk), roles,
+            template_name)
+        cache = get_spaces_cache()
+        html = cache.get(key)
+        if html is None:
+            html = get_template(template_name).render({
+                'space': space,
+                'roles': roles.split(',') if roles else [],
+                'plugins': self.get_plugins(space),
+            })
+            cache.set(key, html, getattr(settings, 'SPACES_PLUGIN_NAV_TIMEOUT', 3600))
+        return html
 
 @register.tag
 def is_space(parser, token):
@@ -68,19 +182,22 @@ def space_url(parser, token):
         {% space_url space_instance "path.to.some_view" arg1 arg2 %}
 
     This tag is useful if you want to deeplink into a space from
-    outside that space.
+    outside that space. The link always points into the given space,
+    whatever space is active. Like 'url', it takes "as var" at the end
+    to store the URL in a variable instead of rendering it.
+    The space may also be given by its slug.
     """
     bits = token.contents.split()
     if len(bits) < 3:
         raise TemplateSyntaxError("'%s' takes at least two arguments"
                                   " (space) (path to a view)" % bits[0])
-    space = bits[1]
+    space = parser.compile_filter(bits[1])
     viewname = parser.compile_filter(bits[2])
     args = []
     kwargs = {}
     asvar = None
     bits = bits[3:]
-    if len(bits) >= 3 and bits[-2] == 'as':
+    if len(bits) >= 2 and bits[-2] == 'as':
         asvar = bits[-1]
         bits = bits[:-2]
 
@@ -98,6 +215,27 @@ def space_url(parser, token):
     return SpaceNode(space, viewname, args, kwargs, asvar)
 
 
+@register.tag
+def space_plugin_nav(parser, token):
+    """
+    Renders the navigation menu of all active plugins of a space.
+
+        {% space_plugin_nav space %}
+        {% space_plugin_nav space "path/to/custom_nav.html" %}
+
+    The template gets the space, the user's roles in it and a list of
+    plugins (dicts with plugin, name, title, icon and url). The output is
+    cached per space, plugin state version and role of the user, so it is
+    only rendered again after a plugin of that space has been changed.
+    """
+    bits = token.split_contents()
+    if len(bits) not in (2, 3):
+        raise TemplateSyntaxError("'%s' takes one or two arguments"
+                                  " (space) [template name]" % bits[0])
+    template_name = parser.compile_filter(bits[2]) if len(bits) == 3 else None
+    return SpacePluginNavNode(parser.compile_filter(bits[1]), template_name)
+
+
 @register.filter(name="is_active")
 def is_active(plugin, space):
     """
@@ -110,8 +248,7 @@ def is_active(plugin, space):
 
     """
     if plugin and space:
-        plugin = SpacePluginRegistry().get_instance(plugin.name, space)
-        return plugin.active
+        return plugin.is_active(space)
     return None
 
 
@@ -127,7 +264,8 @@ def plugin_url(plugin, space):
 
     """
     if plugin and space:
-        return reverse(plugin.reverse_url(space))
+        with override(getattr(space, 'slug', space)):
+            return reverse(plugin.reverse_url(space))
     return None
 
 
@@ -144,8 +282,7 @@ def is_team(user, space):
 
     """
     if user and space:
-        team = space.get_team().user_set.all()
-        return True if user in team else False
+        return SpaceRoles.for_user(user).is_team(space)
     return None
 
 @register.filter(name="has_admin_role")
@@ -161,11 +298,39 @@ def has_admin_role(user, space):
     Is only True if the user is a member of the 'admin' group of this space.
     """
     if user and space:
-        admins = space.get_admins().user_set.all()
-    else:
-        return False
-    ret = False
-    if user in admins:
-        ret = True
-    return ret
+        return SpaceRoles.for_user(user).is_admin(space)
+    return False
+
 
+
+@register.simple_tag
+def user_spaces(user, limit=20, after=None):
+    """
+    Returns the spaces the user may access, oldest first, annotated with
+    user_role, expired and active_plugins (see Space.objects.for_user()).
+
+    Usage example:
+
+    {% user_spaces user limit=50 after=request.GET.after as spaces %}
+    {% for space in spaces %}
+      <a href="{{ space.get_absolute_url }}">{{ space }}</a> {{ space.user_role }}
+    {% endfor %}
+    {% if spaces|length == 50 %}<a href="?after={{ spaces|last|space_cursor|urlencode }}">next</a>{% endif %}
+    """
+    spaces = Space.objects.for_user(user)
+    try:
+        spaces = spaces.after(after)
+    except ValueError:  # malformed cursor, start over
+        pass
+    return list(spaces[:int(limit)])
+
+
+@register.filter(name="space_cursor")
+def space_cursor(space):
+    """
+    Returns the pagination cursor for the page following the given space,
+    to be passed as "after" to user_spaces.
+    """
+    if space:
+        return keyset_cursor(space)
+    return ''
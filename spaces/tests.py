@@ -1,8 +1,54 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-from .models import Space
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.management import CommandError, call_command
+from django.db import connection, models
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext, isolate_apps
+from django.urls import get_resolver, path, resolve, reverse
+from django.utils import timezone
 
+from .backends import SpacePermissionBackend, get_space_permissions
+from .benchmarks import BENCHMARKS, DEFAULT_BASELINE, compare_results, load_results, run_benchmark
+from .cache import (
+    bump_plugin_version, invalidate_space_cache, reset_resolution_cache, space_cache_get,
+    space_cache_get_or_set, space_cached)
+from .decorators import space_writable
+from .deletion import delete_space, purge_space
+from .instrumentation import get_metrics_store
+from .middleware import SpacesInstrumentationMiddleware, SpacesMiddleware
+from .models import (
+    SearchTerm, Space, SpaceModel, SpacePlacement, SpacePlugin, SpacePluginRegistry,
+    SpacePluginStates, SpaceRole, keyset_cursor)
+from .registry import sync_plugins
+from .roles import (
+    SpaceRoles, _send_members_changed, add_members, change_role, remove_members)
+from .routers import get_space_database, invalidate_placements, move_space
+from .search import rebuild_index, search
+from .signals import connect_search_receivers, space_members_changed, spaces_archived
+from .throttling import (
+    CacheRateLimiter, get_limits, get_rate_limiter, release, reset_rate_limiter, throttle)
+from .templatetags.space_tags import has_admin_role, is_active, is_team
+from .transfer import InvalidExport, export_spaces, import_spaces
+from .urls import space_patterns
+from .views import search_view
+from .util import activate, get_space, is_space_admin, override
+
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.models import User,Group
+from djangoplugins.models import DISABLED, Plugin
+from guardian.shortcuts import assign_perm, remove_perm
+from guardian.utils import get_group_obj_perms_model
 
 
 class SpaceTests(TestCase):
@@ -36,5 +82,1154 @@ class SpaceTests(TestCase):
         self.assertEqual(normal_user.has_perm('add_space_member',another_space), False)
 
 
-    # TODO:
-    # * ensure a correct slug is created on first save.                  
\ No newline at end of file
+class SpaceResolutionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        reset_resolution_cache()
+        self.user = User.objects.create_user('myuser')
+        self.space = Space.objects.create(name="Resolved", created_by=self.user)
+        self.middleware = SpacesMiddleware(lambda request: None)
+
+    def resolve(self, path):
+        request = RequestFactory().get(path)
+        self.middleware.resolve_space(request)
+        return request.SPACE
+
+    def test_resolution_is_cached(self):
+        self.assertEqual(self.resolve('/resolved/'), self.space)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve('/resolved/'), self.space)
+
+    def test_unknown_slugs_are_cached(self):
+        self.assertIsNone(self.resolve('/favicon.ico'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.resolve('/favicon.ico'))
+
+    def test_space_is_active_during_request_only(self):
+        def get_response(request):
+            return HttpResponse(get_space())
+        response = SpacesMiddleware(get_response)(RequestFactory().get('/resolved/'))
+        self.assertEqual(response.content, b'resolved')
+        self.assertIsNone(get_space())
+
+    def test_async_middleware(self):
+        async def get_response(request):
+            await asyncio.sleep(0)
+            return HttpResponse(get_space())
+        middleware = SpacesMiddleware(get_response)
+        request = RequestFactory().get('/resolved/')
+        response = async_to_sync(middleware)(request)
+        self.assertEqual(response.content, b'resolved')
+        self.assertEqual(request.SPACE, self.space)
+        self.assertIsNone(get_space())
+
+    def test_concurrent_tasks_keep_their_space(self):
+        async def handle(space_slug, delay):
+            with activate(space_slug):
+                await asyncio.sleep(delay)
+                return get_space()
+
+        async def handle_all():
+            return await asyncio.gather(handle('first', 0.02), handle('second', 0.01))
+        self.assertEqual(asyncio.run(handle_all()), ['first', 'second'])
+
+    def test_expired_spaces_are_readonly(self):
+        self.assertFalse(self.space.is_expired())
+        self.space.expires = timezone.now() - timedelta(minutes=1)
+        self.space.save()
+        self.resolve('/resolved/')
+        request = RequestFactory().post('/resolved/')
+        with self.assertNumQueries(0):
+            self.middleware.resolve_space(request)
+        self.assertTrue(request.SPACE_READONLY)
+        with self.assertRaises(PermissionDenied):
+            self.middleware.process_view(request, page_view, (), {})
+        self.assertIsNone(
+            self.middleware.process_view(request, space_writable(lambda request: None), (), {}))
+        request = RequestFactory().get('/resolved/')
+        self.middleware.resolve_space(request)
+        self.assertIsNone(self.middleware.process_view(request, page_view, (), {}))
+
+    @override_settings(
+        ROOT_URLCONF='spaces.tests',
+        MIDDLEWARE=['spaces.middleware.SpacesMiddleware'])
+    def test_archived_space_rejects_posts(self):
+        self.assertEqual(self.client.post('/resolved/page/1/').status_code, 200)
+        self.space.archived = True
+        self.space.save()
+        self.assertEqual(self.client.get('/resolved/page/1/').status_code, 200)
+        self.assertEqual(self.client.post('/resolved/page/1/').status_code, 403)
+
+    def test_save_invalidates_resolution(self):
+        self.assertEqual(self.resolve('/resolved/'), self.space)
+        self.space.slug = 'renamed'
+        self.space.save()
+        self.assertIsNone(self.resolve('/resolved/'))
+        self.assertEqual(self.resolve('/renamed/'), self.space)
+        self.space.delete()
+        self.assertIsNone(self.resolve('/renamed/'))
+
+
+class SpacesInstrumentationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        reset_resolution_cache()
+        self.user = User.objects.create_user('myuser')
+        self.space = Space.objects.create(name="Measured", created_by=self.user)
+
+        def view(request):
+            return HttpResponse(User.objects.count())
+        self.middleware = SpacesInstrumentationMiddleware(SpacesMiddleware(view))
+
+    def test_requests_are_recorded(self):
+        self.middleware(RequestFactory().get('/measured/'))
+        self.middleware(RequestFactory().get('/measured/'))
+        first, second = get_metrics_store().records()
+        self.assertEqual(first['space'], 'measured')
+        self.assertEqual(first['status'], 200)
+        self.assertEqual(first['resolution_misses'], 1)
+        self.assertEqual(second['resolution_hits'], 1)
+        self.assertEqual(second['queries'], 1)
+        self.assertGreaterEqual(second['total_ms'], second['db_ms'])
+
+        out = StringIO()
+        call_command('spacestats', by=['space'], format='prometheus', stdout=out)
+        self.assertIn('spaces_space_requests{space="measured"} 2', out.getvalue())
+
+    @override_settings(SPACES_INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_sampling(self):
+        self.middleware(RequestFactory().get('/measured/'))
+        self.assertEqual(get_metrics_store().records(), [])
+
+
+@override_settings(
+    SPACES_RATE_LIMITER={'BACKEND': 'spaces.throttling.LocalRateLimiter'},
+    SPACES_RATE_LIMITS={
+        'default': {'rate': 1, 'burst': 2},
+        'plans': {'large': {'rate': 100, 'concurrency': 1}},
+        'spaces': {'unlimited': None, 'big': 'large'},
+    })
+class SpaceThrottlingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        reset_resolution_cache()
+        reset_rate_limiter()
+        self.addCleanup(reset_rate_limiter)
+        self.user = User.objects.create_user('myuser')
+        self.space = Space.objects.create(name="Limited", created_by=self.user)
+        self.middleware = SpacesMiddleware(lambda request: HttpResponse('ok'))
+
+    def test_rate_limit(self):
+        statuses = [self.middleware(RequestFactory().get('/limited/')).status_code
+                    for i in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        response = self.middleware(RequestFactory().get('/limited/'))
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.middleware(RequestFactory().get('/elsewhere/')).status_code, 200)
+
+    def test_limits_per_space_and_plan(self):
+        big = Space.objects.create(name="Big", created_by=self.user)
+        unlimited = Space.objects.create(name="Unlimited", created_by=self.user)
+        self.assertEqual(get_limits(self.space), {'rate': 1, 'burst': 2})
+        self.assertEqual(get_limits(big), {'rate': 100, 'concurrency': 1})
+        self.assertIsNone(get_limits(unlimited))
+        with self.settings(SPACES_RATE_LIMITS={'plans': {'large': {'rate': 5}},
+                                               'plan': 'spaces.tests.space_plan'}):
+            self.assertEqual(get_limits(big), {'rate': 5})
+            self.assertIsNone(get_limits(self.space))
+
+    def test_unknown_plan_gets_the_default(self):
+        with self.settings(SPACES_RATE_LIMITS={'default': {'rate': 1},
+                                               'spaces': {'limited': 'missing'}}):
+            with self.assertLogs('spaces.throttling', 'WARNING') as logs:
+                self.assertEqual(get_limits(self.space), {'rate': 1})
+        self.assertIn("'missing'", logs.output[0])
+
+    def test_concurrency_limit(self):
+        Space.objects.create(name="Big", created_by=self.user)
+        statuses = []
+
+        def view(request):
+            statuses.append(middleware(RequestFactory().get('/big/')).status_code)
+            return HttpResponse('ok')
+        middleware = SpacesMiddleware(view)
+        self.assertEqual(middleware(RequestFactory().get('/big/')).status_code, 200)
+        self.assertEqual(statuses, [429])
+        # the slot is free again after the request
+        self.assertEqual(SpacesMiddleware(lambda request: HttpResponse('ok'))(
+            RequestFactory().get('/big/')).status_code, 200)
+
+    def test_concurrency_limit_takes_no_tokens(self):
+        with self.settings(SPACES_RATE_LIMITS={'default': {'rate': 1, 'burst': 1,
+                                                           'concurrency': 1}}):
+            held = RequestFactory().get('/limited/')
+            self.middleware.resolve_space(held)
+            with mock.patch('spaces.throttling.LocalRateLimiter.consume',
+                            return_value=0) as consume:
+                self.assertIsNone(throttle(held))
+                self.assertEqual(self.middleware(
+                    RequestFactory().get('/limited/')).status_code, 429)
+            self.assertEqual(consume.call_count, 1)
+            release(held)
+            # the rate limit refuses the next request and frees its slot
+            statuses = [self.middleware(RequestFactory().get('/limited/')).status_code
+                        for i in range(2)]
+            self.assertEqual(statuses, [200, 429])
+            request = RequestFactory().get('/limited/')
+            self.middleware.resolve_space(request)
+            self.assertEqual(throttle(request).status_code, 429)
+            self.assertFalse(hasattr(request, '_space_in_flight'))
+            self.assertEqual(get_rate_limiter()._in_flight, {})
+
+    def test_async_middleware(self):
+        async def get_response(request):
+            return HttpResponse('ok')
+        middleware = SpacesMiddleware(get_response)
+        statuses = [async_to_sync(middleware)(RequestFactory().get('/limited/')).status_code
+                    for i in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def test_cache_limiter(self):
+        limiter = CacheRateLimiter()
+        with mock.patch('spaces.throttling.time.time', return_value=1000.0) as now:
+            self.assertEqual([limiter.consume('bucket', 2, 3) for i in range(4)], [0, 0, 0, 0.5])
+            now.return_value = 1000.5
+            self.assertEqual(limiter.consume('bucket', 2, 3), 0)
+            self.assertEqual(limiter.consume('bucket', 2, 3), 0.5)
+            now.return_value = 1100.0
+            self.assertEqual([limiter.consume('bucket', 2, 3) for i in range(4)], [0, 0, 0, 0.5])
+        self.assertTrue(limiter.enter('slots', 2))
+        self.assertTrue(limiter.enter('slots', 2))
+        self.assertFalse(limiter.enter('slots', 2))
+        limiter.leave('slots')
+        self.assertTrue(limiter.enter('slots', 2))
+
+    def test_evicted_slot_counter(self):
+        limiter = CacheRateLimiter()
+        with mock.patch.object(limiter.cache, 'incr', side_effect=ValueError):
+            self.assertIsNone(limiter.enter('spaces:in_flight:%s' % self.space.pk, 1))
+        with self.settings(SPACES_RATE_LIMITER={},
+                           SPACES_RATE_LIMITS={'default': {'concurrency': 1}}):
+            request = RequestFactory().get('/limited/')
+            self.middleware.resolve_space(request)
+            with mock.patch.object(CacheRateLimiter, 'enter', return_value=None), \
+                    mock.patch.object(CacheRateLimiter, 'leave') as leave:
+                self.assertIsNone(throttle(request))
+                release(request)
+            leave.assert_not_called()
+
+
+def space_plan(space):
+    return 'large' if space.slug == 'big' else None
+
+
+
+@space_cached()
+def cached_plugin_count(space, active):
+    return SpacePlugin.objects.filter(space=space, active=active).count()
+
+
+@space_cached()
+def cached_view(request):
+    return HttpResponse(str(request.user))
+
+
+@space_cached()
+def cached_creator(space, other_space):
+    return other_space.pk
+
+
+@space_cached(per_user=False)
+def cached_shared_view(request):
+    response = HttpResponse(request.GET.get('greeting', ''))
+    if 'remember' in request.GET:
+        response.set_cookie('seen', '1')
+    return response
+
+
+class SpaceCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('admin')
+        self.space = Space.objects.create(name="Cached", created_by=self.user)
+        self.other = Space.objects.create(name="Other", created_by=self.user)
+
+    def assertInvalidates(self, change):
+        space_cache_get_or_set(self.space, 'key', 'old')
+        space_cache_get_or_set(self.other, 'key', 'other')
+        change()
+        self.assertIsNone(space_cache_get(self.space, 'key'))
+        self.assertEqual(space_cache_get(self.other, 'key'), 'other')
+
+    def test_get_or_set(self):
+        compute = mock.Mock(return_value=42)
+        self.assertEqual(space_cache_get_or_set(self.space, 'answer', compute), 42)
+        self.assertEqual(space_cache_get_or_set(self.space.slug, 'answer', compute), 42)
+        self.assertEqual(compute.call_count, 1)
+        invalidate_space_cache()
+        self.assertIsNone(space_cache_get(self.space.pk, 'answer'))
+
+    def test_invalidation(self):
+        self.assertInvalidates(self.space.save)
+        self.assertInvalidates(lambda: SpacePlugin.objects.create(space=self.space))
+        def add_member():
+            with self.captureOnCommitCallbacks(execute=True):
+                add_members(self.space, [self.user])
+        self.assertInvalidates(add_member)
+        member = User.objects.create_user('member')
+        self.assertInvalidates(lambda: member.groups.add(self.space.get_team()))
+        self.assertInvalidates(lambda: self.space.get_team().user_set.clear())
+
+    def test_space_cached(self):
+        self.assertEqual(cached_plugin_count(self.space, True), 0)
+        SpacePlugin.objects.bulk_create([SpacePlugin(space=self.space, active=True)])
+        self.assertEqual(cached_plugin_count(self.space, True), 0)
+        self.assertEqual(cached_plugin_count(self.space, active=False), 0)
+        self.space.save()
+        self.assertEqual(cached_plugin_count(self.space, True), 1)
+
+        request = RequestFactory().get('/cached/')
+        request.SPACE, request.user = self.space, self.user
+        self.assertEqual(cached_view(request).content, b'admin')
+        request.user = User.objects.create_user('member')
+        self.assertEqual(cached_view(request).content, b'member')
+        with mock.patch.object(HttpResponse, '__init__', side_effect=AssertionError):
+            self.assertEqual(cached_view(request).content, b'member')
+
+    def test_models_are_keyed_by_pk(self):
+        twins = [Space.objects.create(name="Twin", created_by=self.user) for i in range(2)]
+        self.assertEqual(str(twins[0]), str(twins[1]))
+        self.assertEqual([cached_creator(self.space, twin) for twin in twins],
+                         [twin.pk for twin in twins])
+
+    def test_shared_views_skip_cookies(self):
+        request = RequestFactory().get('/cached/', {'greeting': 'hi', 'remember': '1'})
+        request.SPACE = self.space
+        self.assertIn('seen', cached_shared_view(request).cookies)
+        with mock.patch.object(HttpResponse, '__init__', side_effect=AssertionError):
+            with self.assertRaises(AssertionError):
+                cached_shared_view(request)
+        request = RequestFactory().get('/cached/', {'greeting': 'hi'})
+        request.SPACE = self.space
+        request.META['CSRF_COOKIE_USED'] = True
+        cached_shared_view(request)
+        del request.META['CSRF_COOKIE_USED']
+        with mock.patch.object(HttpResponse, '__init__', side_effect=AssertionError):
+            with self.assertRaises(AssertionError):
+                cached_shared_view(request)
+        cached_shared_view(request)
+        with mock.patch.object(HttpResponse, '__init__', side_effect=AssertionError):
+            self.assertEqual(cached_shared_view(request).content, b'hi')
+
+    def test_anonymous_views_skip_csrf_tokens(self):
+        request = RequestFactory().get('/cached/')
+        request.SPACE, request.user = self.space, AnonymousUser()
+        request.META['CSRF_COOKIE_USED'] = True
+        self.assertEqual(cached_view(request).content, b'AnonymousUser')
+        with mock.patch.object(HttpResponse, '__init__', side_effect=AssertionError):
+            with self.assertRaises(AssertionError):
+                cached_view(request)
+        request.user = self.user
+        cached_view(request)
+        with mock.patch.object(HttpResponse, '__init__', side_effect=AssertionError):
+            self.assertEqual(cached_view(request).content, b'admin')
+
+
+class SpaceRolesTests(TestCase):
+
+    def setUp(self):
+        self.admin_user = User.objects.create_user('admin')
+        self.spaces = [
+            Space.objects.create(name="Space %d" % i, created_by=self.admin_user)
+            for i in range(3)]
+        self.user = User.objects.create_user('normal')
+        self.user.groups.add(self.spaces[0].get_admins(), self.spaces[1].get_team())
+
+    def test_roles_are_resolved_with_one_query(self):
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(is_space_admin(user, self.spaces[0]))
+            self.assertFalse(is_space_admin(user, self.spaces[1]))
+            self.assertTrue(is_team(user, self.spaces[1]))
+            self.assertFalse(has_admin_role(user, self.spaces[2]))
+            self.assertEqual(SpaceRoles.for_user(user).spaces(),
+                             {self.spaces[0].pk, self.spaces[1].pk})
+
+    def test_group_changes_clear_memoized_roles(self):
+        self.assertFalse(is_space_admin(self.user, self.spaces[2]))
+        self.user.groups.add(self.spaces[2].get_admins())
+        self.assertTrue(is_space_admin(self.user, self.spaces[2]))
+
+    def test_role_users(self):
+        self.assertEqual(
+            list(self.spaces[1].get_role_users(SpaceRole.TEAM)), [self.user])
+        self.assertFalse(self.spaces[1].get_role_users(SpaceRole.ADMINS).exists())
+
+
+class BulkMembershipTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('owner')
+        self.space = Space.objects.create(name="Crowded", created_by=self.owner)
+        User.objects.bulk_create([User(username='user%d' % i) for i in range(250)])
+        self.users = list(User.objects.filter(username__startswith='user').order_by('pk'))
+
+    def roles_of(self, user):
+        return SpaceRoles.for_user(User.objects.get(pk=user.pk)).get(self.space)
+
+    def test_add_members_in_batches(self):
+        received = []
+        space_members_changed.connect(
+            lambda sender, **kwargs: received.append(kwargs['user_ids']), weak=False,
+            dispatch_uid='test_add_members')
+        self.addCleanup(space_members_changed.disconnect, dispatch_uid='test_add_members')
+        with self.captureOnCommitCallbacks(execute=True):
+            add_members(self.space, self.users[:10])
+        self.assertEqual(get_space_permissions(self.users[100], self.space), frozenset())
+        # one query per batch plus its savepoint, and the role lookup
+        with self.assertNumQueries(10), self.captureOnCommitCallbacks(execute=True):
+            add_members(self.space, self.users, batch_size=100)
+        self.assertEqual([len(ids) for ids in received], [10, 100, 100, 50])
+        self.assertEqual(self.space.get_members().user_set.count(), 250)
+        user = User.objects.get(pk=self.users[100].pk)
+        self.assertEqual(get_space_permissions(user, self.space), {'access_space'})
+
+    def test_change_and_remove(self):
+        add_members(self.space, self.users)
+        change_role(self.space, self.users[:5], 'team')
+        self.assertEqual(self.roles_of(self.users[0]), {'team'})
+        self.assertEqual(self.roles_of(self.users[5]), {'members'})
+        self.assertEqual(remove_members(self.space, self.users[:50]), 50)
+        self.assertEqual(self.roles_of(self.users[0]), set())
+        self.assertEqual(self.space.get_members().user_set.count(), 200)
+
+    def test_failed_batch_is_rolled_back_unannounced(self):
+        received = []
+        space_members_changed.connect(
+            lambda sender, **kwargs: received.append(kwargs['user_ids']), weak=False,
+            dispatch_uid='test_failed_batch')
+        self.addCleanup(space_members_changed.disconnect, dispatch_uid='test_failed_batch')
+        calls = []
+
+        def send_then_fail(*args):
+            _send_members_changed(*args)
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(RuntimeError):
+            with mock.patch('spaces.roles._send_members_changed', send_then_fail):
+                add_members(self.space, self.users, batch_size=100)
+        self.assertEqual([len(ids) for ids in received], [100])
+        self.assertEqual(self.space.get_members().user_set.count(), 100)
+
+    def test_missing_role_groups_are_created(self):
+        SpaceRole.objects.filter(space=self.space).delete()
+        add_members(self.space, self.users[:1], role='team')
+        self.assertEqual(self.roles_of(self.users[0]), {'team'})
+        with self.assertRaises(ValueError):
+            add_members(self.space, self.users[:1], role='owners')
+
+    def test_import_command(self):
+        rows = 'crowded,user1\ncrowded,user2,admins\nnowhere,user3\n'
+        out, err = StringIO(), StringIO()
+        with mock.patch('sys.stdin', StringIO(rows)):
+            call_command('importmembers', '-', batch_size=2, stdout=out, stderr=err)
+        self.assertIn('Imported 2 memberships, skipped 1 rows.', out.getvalue())
+        self.assertEqual(self.roles_of(self.users[2]), {'admins'})
+
+
+class UserSpacesTests(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.user = User.objects.create_user('dashboard')
+        self.spaces = [Space.objects.create(name="Space %d" % i, created_by=self.owner)
+                       for i in range(5)]
+        add_members(self.spaces[0], [self.user], 'admins')
+        add_members(self.spaces[0], [self.user])
+        add_members(self.spaces[1], [self.user], 'team')
+        assign_perm('access_space', self.user, self.spaces[2])
+        add_members(self.spaces[3], [self.user])
+        self.spaces[3].archived = True
+        self.spaces[3].save()
+        self.spaces[1].expires = timezone.now() - timedelta(days=1)
+        self.spaces[1].save()
+        SpacePlugin.objects.create(space=self.spaces[0], active=True)
+        SpacePlugin.objects.create(space=self.spaces[0], active=True)
+        SpacePlugin.objects.create(space=self.spaces[0], active=False)
+
+    def test_for_user(self):
+        with self.assertNumQueries(1):
+            spaces = list(Space.objects.for_user(self.user))
+        self.assertEqual(spaces, self.spaces[:3])
+        self.assertEqual([space.user_role for space in spaces], ['admins', 'team', None])
+        self.assertEqual([space.expired for space in spaces], [False, True, False])
+        self.assertEqual([space.active_plugins for space in spaces], [2, 0, 0])
+        self.assertEqual(len(Space.objects.for_user(self.owner)), 0)
+        self.owner.is_superuser = True
+        self.assertEqual(len(Space.objects.for_user(self.owner)), 4)
+        self.assertEqual(list(Space.objects.for_user(None)), [])
+
+    def test_keyset_pagination(self):
+        first = list(Space.objects.for_user(self.user)[:2])
+        template = Template(
+            '{% load space_tags %}{% user_spaces user limit=2 after=cursor as spaces %}'
+            '{% for space in spaces %}{{ space.slug }} {% endfor %}')
+        html = template.render(Context({'user': self.user, 'cursor': keyset_cursor(first[-1])}))
+        self.assertEqual(html, 'space-2 ')
+        for cursor in ('garbage', 'garbage,1'):
+            html = template.render(Context({'user': self.user, 'cursor': cursor}))
+            self.assertEqual(html, 'space-0 space-1 ')
+        # cursors with a "Z" for UTC, as other clients write them
+        cursor = keyset_cursor(first[-1]).replace('+00:00', 'Z')
+        self.assertEqual(list(Space.objects.for_user(self.user).after(cursor)[:1]),
+                         list(Space.objects.for_user(self.user)[2:3]))
+
+
+class BulkProvisionTests(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        Space.objects.create(name="Project", created_by=self.owner)
+
+    def test_bulk_provision(self):
+        spaces = Space.objects.bulk_provision(
+            [("Project", self.owner)] * 20 + [("Other", self.owner)])
+        self.assertEqual(
+            [space.slug for space in spaces],
+            ['project%d' % i for i in range(1, 21)] + ['other'])
+        user = User.objects.create_user('normal')
+        user.groups.add(spaces[3].get_team())
+        self.assertTrue(user.has_perm('spaces.add_space_member', spaces[3]))
+        self.assertFalse(user.has_perm('spaces.add_space_member', spaces[4]))
+        self.assertTrue(is_team(user, spaces[3]))
+
+    def test_bulk_provision_query_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            Space.objects.bulk_provision(
+                [("Space %d" % i, self.owner) for i in range(200)])
+        self.assertLess(len(queries), 25)
+
+    def test_provisionspaces_command(self):
+        out = StringIO()
+        csvfile = StringIO('Project,owner\nNew Space\n')
+        with mock.patch('sys.stdin', csvfile):
+            call_command('provisionspaces', '-', owner='owner', stdout=out)
+        self.assertIn('Created 2 spaces.', out.getvalue())
+        self.assertTrue(Space.objects.filter(slug='project1').exists())
+        self.assertTrue(Space.objects.filter(slug='new-space').exists())
+
+
+class SlugTests(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+
+    def create(self, name):
+        return Space.objects.create(name=name, created_by=self.owner)
+
+    def test_slug_is_created_on_first_save(self):
+        self.assertEqual(self.create("My new Space").slug, 'my-new-space')
+        self.assertEqual(self.create("My new Space").slug, 'my-new-space1')
+        self.assertEqual(self.create("My new Space").slug, 'my-new-space2')
+        self.assertEqual(self.create("My new Space 1").slug, 'my-new-space-1')
+
+    def test_long_slugs_are_shortened(self):
+        name = 'x' * 60
+        slugs = [self.create(name).slug for i in range(12)]
+        self.assertEqual(slugs[0], 'x' * 50)
+        self.assertEqual(slugs[1], 'x' * 49 + '1')
+        self.assertEqual(slugs[11], 'x' * 48 + '11')
+
+    def test_slug_allocation_query_count_is_constant(self):
+        for i in range(30):
+            self.create("Project")
+        with self.assertNumQueries(1):
+            self.assertEqual(Space.objects.next_free_slug('project'), 'project30')
+
+    def test_free_slug_is_used_despite_suffixed_variants(self):
+        self.create("Web3")
+        self.assertEqual(self.create("Web").slug, 'web')
+        self.assertEqual(self.create("Web").slug, 'web4')
+
+    def test_slug_ending_in_digits_is_used_if_free(self):
+        self.create("Project 2026")
+        self.create("Project2026")
+        self.assertEqual(self.create("Project").slug, 'project')
+        self.assertEqual(self.create("Project").slug, 'project2027')
+
+    def test_taken_slug_is_retried(self):
+        self.create("Project")
+        with mock.patch.object(Space.objects, 'free_slug_suffix',
+                side_effect=[0, 1]) as patched:
+            space = self.create("Project")
+        self.assertEqual(space.slug, 'project1')
+        self.assertEqual(patched.call_count, 2)
+
+    def test_same_name_benchmark(self):
+        result = run_benchmark('same_name_slugs', size=20)
+        self.assertEqual(result['calls'], 20)
+        self.assertFalse(Space.objects.filter(name='Project').exists())
+
+
+class BenchmarkTests(TestCase):
+
+    def test_benchmarks_run_and_roll_back(self):
+        for name in BENCHMARKS:
+            result = run_benchmark(name, size=5)
+            self.assertIn('p99_ms', result)
+        self.assertFalse(Space.objects.exists())
+        self.assertFalse(User.objects.filter(username__startswith='benchmark').exists())
+
+    def test_compare_results(self):
+        baseline = {'x': {'p50_ms': 1.0, 'queries_mean': 2.0, 'memory_kb': 1000.0}}
+        self.assertEqual(compare_results(
+            {'x': {'p50_ms': 1.1, 'queries_mean': 2.0, 'memory_kb': 1050.0}}, baseline), [])
+        self.assertEqual(compare_results(
+            {'x': {'p50_ms': 1.5, 'queries_mean': 3.0, 'memory_kb': 1500.0}}, baseline),
+            [('x', 'p50_ms', 1.0, 1.5), ('x', 'queries_mean', 2.0, 3.0),
+             ('x', 'memory_kb', 1000.0, 1500.0)])
+        self.assertEqual(compare_results(
+            {'x': {'p50_ms': 1.5, 'queries_mean': 2.0, 'memory_kb': 1000.0}}, baseline,
+            latencies=False), [])
+
+    def test_shipped_baseline_ignores_latencies(self):
+        baseline = load_results(DEFAULT_BASELINE)
+        slow = {'reverse_distinct_spaces': dict(
+            baseline['reverse_distinct_spaces'], p50_ms=1000.0, p99_ms=1000.0)}
+        with mock.patch('spaces.management.commands.benchspaces.run_benchmark',
+                        side_effect=lambda name, size: slow[name]):
+            call_command('benchspaces', 'reverse_distinct_spaces', compare=DEFAULT_BASELINE,
+                         stdout=StringIO())
+            with tempfile.TemporaryDirectory() as directory:
+                own = os.path.join(directory, 'baseline.json')
+                call_command('benchspaces', 'reverse_distinct_spaces', save_baseline=own,
+                             stdout=StringIO())
+                slow['reverse_distinct_spaces'] = dict(
+                    slow['reverse_distinct_spaces'], p50_ms=3000.0)
+                with self.assertRaises(CommandError):
+                    call_command('benchspaces', 'reverse_distinct_spaces', compare=own,
+                                 stdout=StringIO())
+
+    def test_shipped_baseline_covers_all_benchmarks(self):
+        self.assertEqual(set(load_results(DEFAULT_BASELINE)), set(BENCHMARKS))
+
+    def test_warm_runs_hit_the_cache(self):
+        # more entries than the default cache holds (300)
+        baseline = load_results(DEFAULT_BASELINE)
+        for name in ('middleware_resolution', 'permission_checks'):
+            self.assertEqual(run_benchmark(name, size=400)['warm_queries_max'], 0)
+            self.assertEqual(baseline[name]['warm_queries_max'], 0)
+
+
+class CloseExpiredSpacesTests(TestCase):
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        now = timezone.now()
+        self.expired = [
+            Space.objects.create(name="Expired", created_by=owner,
+                                 expires=now - timedelta(days=1))
+            for i in range(5)]
+        self.running = Space.objects.create(
+            name="Running", created_by=owner, expires=now + timedelta(days=1))
+        self.unlimited = Space.objects.create(name="Unlimited", created_by=owner)
+
+    def archived(self):
+        return set(Space.objects.filter(archived=True))
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('closeexpiredspaces', dry_run=True, stdout=out)
+        self.assertIn('5 spaces would be archived', out.getvalue())
+        self.assertEqual(self.archived(), set())
+
+    def test_expired_spaces_are_archived_in_batches(self):
+        batches = []
+
+        def receiver(sender, space_ids, **kwargs):
+            batches.append(space_ids)
+        spaces_archived.connect(receiver)
+        self.addCleanup(spaces_archived.disconnect, receiver)
+
+        out = StringIO()
+        call_command('closeexpiredspaces', batch_size=2, stdout=out)
+        self.assertIn('5 spaces archived', out.getvalue())
+        self.assertEqual(self.archived(), set(self.expired))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+
+class PluginTestRegistry(SpacePluginRegistry):
+    name = 'spaces_test_plugin'
+    title = 'Test Plugin'
+    plugin_model = SpacePlugin
+
+
+class SpacePluginStatesTests(TestCase):
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        self.space = Space.objects.create(name="Plugins", created_by=owner)
+        self.plugin = PluginTestRegistry()
+
+    def test_plugin_states_are_loaded_once(self):
+        SpacePlugin.objects.create(space=self.space, active=True)
+        space = Space.objects.get(pk=self.space.pk)
+        self.assertTrue(is_active(self.plugin, space))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_active(self.plugin, space))
+            self.assertEqual(self.plugin.reverse_url(space), '')
+            self.assertTrue(self.plugin.get_plugin_model(space).active)
+
+    def test_missing_plugin_rows_are_created_on_demand(self):
+        self.assertFalse(is_active(self.plugin, self.space))
+        self.assertFalse(SpacePlugin.objects.filter(space=self.space).exists())
+        instance = self.plugin.get_plugin_model(self.space)
+        self.assertEqual(instance.space, self.space)
+        self.assertIs(self.plugin.get_plugin_model(self.space), instance)
+
+
+def patch_searchable_fields(testcase, searchable_fields):
+    """Make PluginTestRegistry searchable for the test."""
+    testcase.addCleanup(connect_search_receivers)
+    patcher = mock.patch.object(PluginTestRegistry, 'searchable_fields', searchable_fields)
+    patcher.start()
+    testcase.addCleanup(patcher.stop)
+    connect_search_receivers()
+
+
+class SpaceSearchTests(TestCase):
+
+    def setUp(self):
+        patch_searchable_fields(self, ((SpacePlugin, ('space__name',)),))
+        self.user = User.objects.create_user('admin')
+        self.alpha = Space.objects.create(name="Alpha Project", created_by=self.user)
+        self.beta = Space.objects.create(name="Beta Project", created_by=self.user)
+        self.plugins = [SpacePlugin.objects.create(space=space)
+                        for space in (self.alpha, self.alpha, self.beta)]
+
+    def test_hits_are_limited_to_the_space(self):
+        page = search(self.alpha, 'PROJECT')
+        self.assertEqual([hit.object for hit in page], self.plugins[:2])
+        self.assertEqual(page.object_list[0].plugin, PluginTestRegistry)
+        self.assertEqual(len(search(self.alpha, 'alpha beta')), 0)
+        self.assertEqual(len(search(self.alpha, '')), 0)
+
+    def test_pagination(self):
+        page = search(self.alpha, 'alpha project', page=2, per_page=1)
+        self.assertEqual(page.paginator.count, 2)
+        self.assertEqual([hit.object for hit in page], self.plugins[1:2])
+
+    def test_index_is_updated(self):
+        self.plugins[0].delete()
+        self.assertEqual([hit.object for hit in search(self.alpha, 'alpha')], self.plugins[1:2])
+        SearchTerm.objects.all().delete()
+        self.assertEqual(rebuild_index(), 2)
+        self.assertEqual(len(search(self.beta, 'beta')), 1)
+
+    def test_only_searchable_models_are_indexed(self):
+        with mock.patch('spaces.signals.index_object') as index_object:
+            User.objects.create_user('unrelated')
+            SpacePlugin.objects.create(space=self.beta)
+        self.assertEqual(index_object.call_count, 1)
+
+    @isolate_apps('spaces')
+    def test_integer_pks_are_required(self):
+        class Note(SpaceModel):
+            code = models.CharField(primary_key=True, max_length=10)
+        with mock.patch.object(PluginTestRegistry, 'searchable_fields', ((Note, ('code',)),)):
+            with self.assertRaises(ImproperlyConfigured):
+                connect_search_receivers()
+
+    def test_view(self):
+        request = RequestFactory().get('/alpha-project/search/', {'q': 'alpha'})
+        request.user = User.objects.create_superuser('root', 'root@example.com', 'pw')
+        request.SPACE = self.alpha
+        response = search_view(request)
+        self.assertContains(response, 'space-search-hit space-plugin-spaces_test_plugin', count=2)
+
+
+
+class SpaceDeletionTests(TestCase):
+
+    def setUp(self):
+        patch_searchable_fields(self, ((SpacePlugin, ('space__name',)),))
+        self.user = User.objects.create_user('admin')
+        self.space = Space.objects.create(name="Doomed", created_by=self.user)
+        self.other = Space.objects.create(name="Other", created_by=self.user)
+        SpacePlugin.objects.bulk_create([SpacePlugin(space=self.space) for i in range(5)])
+        SpacePlugin.objects.create(space=self.other)
+        rebuild_index()
+        add_members(self.space, [self.user])
+
+    def test_delete_space_in_chunks(self):
+        progress = []
+        counts = delete_space(self.space, batch_size=2,
+                              progress=lambda *args: progress.append(args))
+        self.assertEqual(counts['spaces.SpacePlugin'], 5)
+        self.assertEqual(counts['auth.Group'], 3)
+        self.assertEqual(
+            [deleted for label, deleted in progress if label == 'spaces.SpacePlugin'], [2, 4, 5])
+        self.assertFalse(Space.objects.filter(pk=self.space.pk).exists())
+        self.assertEqual(SpacePlugin.objects.count(), 1)
+        self.assertEqual(set(SearchTerm.objects.values_list('space', flat=True)), {self.other.pk})
+        self.assertEqual(Group.objects.count(), 3)
+        self.assertFalse(self.user.has_perm('spaces.access_space', self.space))
+        self.assertEqual(
+            get_group_obj_perms_model().objects.filter(object_pk=str(self.space.pk)).count(), 0)
+
+    def test_purge_is_resumable(self):
+        with mock.patch('spaces.deletion.transaction.atomic', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                purge_space(self.space, batch_size=2)
+        self.assertTrue(Space.objects.get(pk=self.space.pk).archived)
+        out = StringIO()
+        call_command('deletespaces', 'doomed', keep_space=True, stdout=out)
+        self.assertIn('doomed: deleted', out.getvalue())
+        self.assertFalse(SpacePlugin.objects.filter(space=self.space).exists())
+        self.assertEqual(SpaceRole.objects.filter(space=self.space).count(), 3)
+
+
+
+class SpaceTransferTests(TestCase):
+
+    def setUp(self):
+        patch_searchable_fields(self, ((SpacePlugin, ('space__name',)),))
+        self.user = User.objects.create_user('admin')
+        self.member = User.objects.create_user('member')
+        self.space = Space.objects.create(name="Travelling", created_by=self.user)
+        SpacePlugin.objects.bulk_create(
+            [SpacePlugin(space=self.space, active=bool(i % 2)) for i in range(3)])
+        add_members(self.space, [self.member])
+        add_members(self.space, [self.user], role='admins')
+
+    def test_export_and_import(self):
+        out = StringIO()
+        export_spaces([self.space], out, batch_size=2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1 + 1 + 2 + 3)
+        spaces = import_spaces(lines, batch_size=2)
+        self.assertEqual(len(spaces), 1)
+        copy = spaces[0]
+        self.assertNotEqual(copy.slug, self.space.slug)
+        self.assertEqual(copy.name, self.space.name)
+        self.assertEqual(copy.created_by, self.user)
+        self.assertEqual(
+            sorted(SpacePlugin.objects.filter(space=copy).values_list('active', flat=True)),
+            [False, False, True])
+        self.assertEqual(list(copy.get_role_users('members')), [self.member])
+        self.assertEqual(list(copy.get_role_users('admins')), [self.user])
+        self.assertEqual(len(search(copy, 'travelling')), 3)
+
+    def test_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'export.ndjson.gz')
+            call_command('exportspaces', 'travelling', output=filename, stdout=StringIO())
+            out = StringIO()
+            call_command('importspaces', filename, created_by='member', stdout=out)
+        self.assertIn('Imported space travelling1.', out.getvalue())
+        self.assertEqual(Space.objects.filter(created_by=self.member).count(), 1)
+        with self.assertRaises(InvalidExport):
+            import_spaces(['{"format": "other"}'])
+
+
+
+SHARDS = [alias for alias in settings.DATABASES if alias != 'default']
+
+
+@skipUnless(SHARDS, 'needs a second database')
+@override_settings(DATABASE_ROUTERS=['spaces.routers.SpaceShardRouter'], SPACES_PLACEMENT_TTL=0)
+class SpaceShardRouterTests(TestCase):
+    databases = set(['default'] + SHARDS)
+
+    def setUp(self):
+        self.addCleanup(invalidate_placements)  # placements vanish with the rollback
+        self.shard = SHARDS[0]
+        self.user = User.objects.create_user('admin')
+        self.space = Space.objects.create(name="Big Tenant", created_by=self.user)
+        self.other = Space.objects.create(name="Small Tenant", created_by=self.user)
+        SpacePlugin.objects.bulk_create(
+            [SpacePlugin(space=self.space, active=True) for i in range(3)]
+            + [SpacePlugin(space=self.other)])
+
+    def test_move_space(self):
+        self.assertEqual(move_space(self.space, self.shard, batch_size=2), 3)
+        self.assertEqual(get_space_database(self.space), self.shard)
+        self.assertEqual(SpacePlacement.objects.get().database, self.shard)
+        self.assertFalse(Space.objects.get(pk=self.space.pk).archived)
+        self.assertEqual(SpacePlugin.objects.using('default').count(), 1)
+        # the shard gets the space, but none of the creator's data
+        creator = User.objects.using(self.shard).get(pk=self.user.pk)
+        self.assertFalse(creator.is_active)
+        self.assertFalse(creator.has_usable_password())
+        self.assertNotEqual(creator.username, self.user.username)
+
+        with override(self.space.slug):
+            plugins = list(SpacePlugin.objects.filter(space=self.space))
+        self.assertEqual(len(plugins), 3)
+        self.assertEqual(plugins[0]._state.db, self.shard)
+        self.assertEqual(plugins[0].space._state.db, 'default')
+        with override(self.other.slug):
+            self.assertEqual(SpacePlugin.objects.count(), 1)
+        space = Space.objects.get(pk=self.space.pk)
+        self.assertTrue(PluginTestRegistry().get_plugin_model(space).active)
+        self.assertEqual(SpacePluginStates.for_space(space).get(SpacePlugin)._state.db, self.shard)
+
+        move_space(self.space, 'default')
+        self.assertFalse(SpacePlacement.objects.exists())
+        self.assertEqual(SpacePlugin.objects.using('default').count(), 4)
+        self.assertFalse(SpacePlugin.objects.using(self.shard).exists())
+        self.assertFalse(Space.objects.using(self.shard).exists())
+        self.assertFalse(User.objects.using(self.shard).filter(pk=self.user.pk).exists())
+
+    def test_resumed_move_restores_archived_state(self):
+        # a killed move leaves the space archived: end_move() never runs
+        with mock.patch('spaces.routers.end_move'), \
+                mock.patch('spaces.routers.copy_rows', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                move_space(self.space, self.shard)
+        self.assertTrue(Space.objects.get(pk=self.space.pk).archived)
+        space = Space.objects.get(pk=self.space.pk)
+        self.assertEqual(move_space(space, self.shard), 3)
+        self.assertFalse(Space.objects.get(pk=self.space.pk).archived)
+        self.assertIsNone(SpacePlacement.objects.get().archived_before_move)
+
+        self.other.archived = True
+        self.other.save()
+        move_space(self.other, self.shard)
+        self.assertTrue(Space.objects.get(pk=self.other.pk).archived)
+
+    def test_delete_placed_space(self):
+        move_space(self.space, self.shard)
+        delete_space(self.space)
+        self.assertFalse(SpacePlugin.objects.using(self.shard).exists())
+        self.assertFalse(Space.objects.using(self.shard).filter(pk=self.space.pk).exists())
+        self.assertEqual(get_space_database(self.space), 'default')
+
+    def test_placeholder_creator_is_shared(self):
+        move_space(self.space, self.shard)
+        move_space(self.other, self.shard)
+        creator = User.objects.using(self.shard).filter(pk=self.user.pk)
+        self.assertEqual(creator.count(), 1)
+        move_space(self.space, 'default')
+        self.assertEqual(creator.count(), 1)
+        delete_space(self.other)
+        self.assertFalse(creator.exists())
+
+
+with isolate_apps('spaces'):
+    class Note(SpaceModel):
+        """Only used by SpaceQuerySetTests, which create its table."""
+        plugin = models.ForeignKey(SpacePlugin, on_delete=models.CASCADE)
+        position = models.PositiveIntegerField()
+        spaceplugin_field_name = 'plugin'
+
+        class Meta:
+            indexes = [models.Index(fields=['plugin', 'position'])]
+
+
+class SpaceQuerySetTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as editor:
+            editor.create_model(Note)
+        super(SpaceQuerySetTests, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(SpaceQuerySetTests, cls).tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(Note)
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user('admin')
+        cls.spaces = [Space.objects.create(name="Notes %d" % i, created_by=user)
+                      for i in range(3)]
+        SpacePlugin.objects.bulk_create(
+            [SpacePlugin(space=space) for space in cls.spaces for i in range(50)])
+        Note.objects.bulk_create(
+            [Note(plugin=plugin, position=i)
+             for plugin in SpacePlugin.objects.all() for i in range(20)])
+
+    def test_in_space_filters_on_the_foreign_key(self):
+        with self.assertNumQueries(2):
+            notes = list(Note.objects.filter(position__lt=5).in_space(self.spaces[0]))
+        self.assertEqual(len(notes), 250)
+        self.assertEqual(set(note.plugin.space_id for note in notes[:3]), {self.spaces[0].pk})
+        queryset = Note.objects.in_space(self.spaces[0].pk)
+        self.assertNotIn('JOIN', str(queryset.query))
+
+    def test_in_spaces(self):
+        with self.assertNumQueries(2):
+            notes = list(Note.objects.in_spaces(self.spaces[1:], select_related=True))
+        self.assertEqual(len(notes), 2000)
+        self.assertEqual(notes[0].plugin.space.name, "Notes 1")
+        self.assertEqual(Note.objects.in_spaces([]).count(), 0)
+
+    def test_index_check(self):
+        self.assertEqual(Note._check_spaceplugin_index(), [])
+        with mock.patch.object(Note._meta, 'indexes', []):
+            self.assertEqual(
+                [error.id for error in Note._check_spaceplugin_index()], ['spaces.W001'])
+
+
+class SpacePluginNavTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        call_command('syncplugins', verbosity=0)
+        self.owner = User.objects.create_user('owner')
+        self.space = Space.objects.create(name="Plugins", created_by=self.owner)
+        self.template = Template('{% load space_tags %}{% space_plugin_nav space %}')
+
+    def render(self):
+        space = Space.objects.get(pk=self.space.pk)
+        return self.template.render(Context({'space': space, 'user': self.owner}))
+
+    def test_nav_is_cached_until_plugins_change(self):
+        self.assertNotIn('Test Plugin', self.render())
+        plugin = SpacePlugin.objects.create(space=self.space, active=True)
+        self.assertIn('Test Plugin', self.render())
+        with self.assertNumQueries(1):
+            self.assertIn('Test Plugin', self.render())
+        plugin.active = False
+        plugin.save()
+        self.assertNotIn('Test Plugin', self.render())
+
+    @override_settings(ROOT_URLCONF='spaces.tests')
+    def test_links_point_into_the_rendered_space(self):
+        SpacePlugin.objects.create(space=self.space, active=True)
+        other = Space.objects.create(name="Other", created_by=self.owner)
+        with mock.patch.object(SpacePlugin, 'reverse_url', 'space-test-index'):
+            with override(other.slug):
+                self.assertIn('href="/plugins/"', self.render())
+            self.assertIn('href="/plugins/"', self.render())
+
+
+class PluginSnapshotTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_sync_is_skipped_if_nothing_changed(self):
+        out = StringIO()
+        call_command('syncspaceplugins', stdout=out)
+        call_command('syncspaceplugins', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(),
+                         ['Plugins synced.', 'Plugins unchanged, nothing to sync.'])
+        Plugin.objects.all().delete()
+        self.assertTrue(sync_plugins())
+
+    def test_lookups_use_the_snapshot(self):
+        sync_plugins()
+        self.assertIsInstance(
+            SpacePluginRegistry.get_plugin('spaces_test_plugin'), PluginTestRegistry)
+        with self.assertNumQueries(0):
+            for i in range(10):
+                SpacePluginRegistry.get_plugin('spaces_test_plugin')
+                list(SpacePluginRegistry.get_plugins())
+        Plugin.objects.filter(name='spaces_test_plugin').update(status=DISABLED)
+        bump_plugin_version()
+        with self.assertRaises(Plugin.DoesNotExist):
+            SpacePluginRegistry.get_plugin('spaces_test_plugin')
+
+
+def page_view(request, number):
+    return HttpResponse()
+
+
+urlpatterns = space_patterns(
+    path('', page_view, {'number': 0}, name='space-test-index'),
+    path('page/<int:number>/', page_view, name='space-test-page'),
+)
+
+
+@override_settings(AUTHENTICATION_BACKENDS=[
+    'django.contrib.auth.backends.ModelBackend',
+    'spaces.backends.SpacePermissionBackend',
+    'guardian.backends.ObjectPermissionBackend',
+])
+class SpacePermissionBackendTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('owner')
+        self.space = Space.objects.create(name="Perms", created_by=self.owner)
+        self.user = User.objects.create_user('normal')
+
+    def test_permissions_are_cached(self):
+        self.user.groups.add(self.space.get_members())
+        self.assertTrue(self.user.has_perm('spaces.access_space', self.space))
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('spaces.access_space', self.space))
+            self.assertFalse(user.has_perm('spaces.add_space_member', self.space))
+
+    def test_denied_without_asking_guardian(self):
+        with mock.patch('guardian.backends.ObjectPermissionBackend.has_perm') as has_perm:
+            self.assertFalse(self.user.has_perm('spaces.access_space', self.space))
+        self.assertFalse(has_perm.called)
+        self.assertFalse(SpacePermissionBackend().has_perm(
+            self.user, 'auth.add_user', self.space))
+
+    def test_membership_changes_invalidate(self):
+        self.assertFalse(self.user.has_perm('spaces.access_space', self.space))
+        self.user.groups.add(self.space.get_team())
+        self.assertTrue(self.user.has_perm('spaces.add_space_member', self.space))
+        self.space.get_team().user_set.remove(self.user)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(user.has_perm('spaces.access_space', self.space))
+
+    def test_permission_changes_invalidate(self):
+        self.assertFalse(self.user.has_perm('spaces.access_space', self.space))
+        assign_perm('access_space', self.user, self.space)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(user.has_perm('spaces.access_space', self.space))
+        remove_perm('access_space', self.user, self.space)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(user.has_perm('spaces.access_space', self.space))
+
+
+@override_settings(ROOT_URLCONF='spaces.tests', SPACES_URL_RESOLVER_CACHE_SIZE=5)
+class SpaceURLTests(TestCase):
+
+    def test_reverse_and_resolve_in_active_space(self):
+        self.assertEqual(reverse('space-test-page', args=[1]), '/page/1/')
+        for slug in ('first', 'second', 'first'):
+            with override(slug):
+                self.assertEqual(
+                    reverse('space-test-page', args=[1]), '/%s/page/1/' % slug)
+                match = resolve('/%s/page/2/' % slug)
+                self.assertEqual(match.kwargs, {'number': 2})
+
+    def test_resolver_caches_are_bounded(self):
+        for i in range(20):
+            with override('space-%d' % i):
+                self.assertEqual(
+                    reverse('space-test-page', args=[i]), '/space-%d/page/%d/' % (i, i))
+        resolver = get_resolver()
+        self.assertLessEqual(len(resolver._reverse_dict), 5)
+        self.assertEqual(len(resolver.url_patterns[0]._reverse_dict), 1)
+
+    def test_space_url(self):
+        user = User.objects.create_user('linker')
+        spaces = [Space.objects.create(name="Linked %d" % i, created_by=user)
+                  for i in range(3)]
+        template = Template(
+            '{% load space_tags %}{% for space in spaces %}'
+            '{% space_url space "space-test-page" 7 %} {% endfor %}'
+            '{% space_url "other" "space-test-page" number=3 as link %}[{{ link }}]')
+        with override('first'), mock.patch(
+                'spaces.templatetags.space_tags.reverse', wraps=reverse) as patched:
+            html = template.render(Context({'spaces': spaces}))
+        self.assertEqual(html, '/linked-0/page/7/ /linked-1/page/7/ /linked-2/page/7/ '
+                               '[/other/page/3/]')
+        self.assertEqual(patched.call_count, 2)
+        self.assertEqual(get_space(), None)
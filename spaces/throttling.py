@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Per-space rate limits for SpacesMiddleware.
+
+Every space gets a token bucket (``rate`` requests per second, up to
+``burst`` at once) and a cap on the requests it may have in flight at the
+same time (``concurrency``). Requests beyond that are answered with 429 Too
+Many Requests and a Retry-After header. Limits are configured per space
+slug, per plan or as default:
+
+    SPACES_RATE_LIMITS = {
+        'default': {'rate': 10, 'burst': 20, 'concurrency': 5},
+        'plans': {'large': {'rate': 100, 'burst': 200, 'concurrency': 50}},
+        'spaces': {'big-tenant': 'large', 'test': None},
+        'plan': 'myproject.billing.get_space_plan',
+    }
+
+The optional plan function gets the space and returns the name of its plan
+(or None for the default); its results are kept per process for a minute.
+Unknown plan names are logged to the "spaces.throttling" logger and get the
+default limits. Leave a value out (or the whole setting) for no limit.
+
+The state is kept by the backend configured with SPACES_RATE_LIMITER, by
+default in Django's cache (SPACES_CACHE_ALIAS), which has to be shared by all
+workers. LocalRateLimiter keeps it in the process, for tests.
+"""
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from .cache import LocalLRUCache
+from .instrumentation import count
+
+logger = logging.getLogger('spaces.throttling')
+
+
+class LocalRateLimiter(object):
+    """Keeps buckets and counters in this process only."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._in_flight = {}
+
+    def consume(self, key, rate, burst):
+        """
+        Take a token from the bucket. Returns 0 if there was one, else the
+        seconds until there will be one.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def enter(self, key, limit):
+        """
+        Take one of limit slots. Returns True if it got one, False if there
+        is none left and None if no slot could be counted; leave() only
+        after True.
+        """
+        with self._lock:
+            current = self._in_flight.get(key, 0)
+            if current >= limit:
+                return False
+            self._in_flight[key] = current + 1
+            return True
+
+    def leave(self, key):
+        with self._lock:
+            current = self._in_flight.get(key, 0) - 1
+            if current > 0:
+                self._in_flight[key] = current
+            else:
+                self._in_flight.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._in_flight.clear()
+
+
+class CacheRateLimiter(object):
+    """
+    Keeps buckets and counters in a Django cache. Only incr() and decr()
+    change counts, so concurrent requests of all workers are counted
+    right.
+
+    A bucket is the time it was last full and the number of tokens taken
+    since: it holds burst + rate * elapsed - taken tokens. Once that would
+    exceed burst, the bucket starts over. Counters of requests in flight
+    that were never left (e.g. killed workers) vanish after timeout
+    seconds.
+    """
+
+    def __init__(self, alias=None, timeout=3600):
+        self.alias = alias or getattr(settings, 'SPACES_CACHE_ALIAS', 'default')
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def consume(self, key, rate, burst):
+        cache = self.cache
+        now = time.time()
+        start_key, taken_key = key + ':start', key + ':taken'
+        start = cache.get(start_key)
+        taken = None
+        if start is not None:
+            try:
+                taken = cache.incr(taken_key)
+            except ValueError:
+                pass
+        if taken is None or burst + (now - start) * rate - (taken - 1) > burst:
+            cache.set_many({start_key: now, taken_key: 1}, self.timeout)
+            return 0
+        missing = taken - burst - (now - start) * rate
+        if missing <= 0:
+            return 0
+        try:
+            cache.decr(taken_key)  # denied requests take no token
+        except ValueError:
+            pass
+        return missing / rate
+
+    def enter(self, key, limit):
+        cache = self.cache
+        for attempt in range(2):
+            cache.add(key, 0, self.timeout)
+            try:
+                current = cache.incr(key)
+            except ValueError:  # evicted between add() and incr()
+                continue
+            if current > limit:
+                self.leave(key)
+                return False
+            return True
+        return None
+
+    def leave(self, key):
+        try:
+            self.cache.decr(key)
+        except ValueError:
+            pass
+
+
+_limiter = None
+_plans = LocalLRUCache(maxsize=10000, ttl=60)
+
+
+def get_rate_limiter():
+    """
+    Return the backend configured by SPACES_RATE_LIMITER, e.g.
+
+        SPACES_RATE_LIMITER = {
+            'BACKEND': 'spaces.throttling.CacheRateLimiter',
+            'OPTIONS': {'alias': 'default', 'timeout': 3600},
+        }
+    """
+    global _limiter
+    if _limiter is None:
+        config = getattr(settings, 'SPACES_RATE_LIMITER', {})
+        backend = import_string(config.get('BACKEND', 'spaces.throttling.CacheRateLimiter'))
+        _limiter = backend(**config.get('OPTIONS', {}))
+    return _limiter
+
+
+def reset_rate_limiter():
+    global _limiter
+    _limiter = None
+    _plans.clear()
+
+
+def get_limits(space):
+    """Return the limits dict for the space, or None if it has none."""
+    config = getattr(settings, 'SPACES_RATE_LIMITS', None)
+    if not config:
+        return None
+    plans = config.get('plans', {})
+    spaces = config.get('spaces', {})
+    if space.slug in spaces:
+        limits = spaces[space.slug]
+    else:
+        limits = config.get('default')
+        if config.get('plan'):
+            plan = _plans.get(space.pk, _plans)
+            if plan is _plans:
+                plan = import_string(config['plan'])(space)
+                _plans.set(space.pk, plan)
+            if plan is not None:
+                limits = plan
+    if isinstance(limits, str):
+        if limits in plans:
+            limits = plans[limits]
+        else:
+            logger.warning('Unknown rate limit plan %r of space %s, using the default.',
+                           limits, space.slug)
+            limits = config.get('default')
+    return limits or None
+
+
+def too_many_requests(retry_after):
+    response = HttpResponse('Too many requests in this space.', status=429,
+                            content_type='text/plain')
+    response['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+    return response
+
+
+def throttle(request):
+    """
+    Apply the limits of request.SPACE. Returns a 429 response if the
+    request has to wait, else None; then call release(request) once the
+    request is done.
+    """
+    space = getattr(request, 'SPACE', None)
+    if space is None:
+        return None
+    limits = get_limits(space)
+    if limits is None:
+        return None
+    limiter = get_rate_limiter()
+    # a request turned away for concurrency must not use up a token
+    if limits.get('concurrency'):
+        key = 'spaces:in_flight:%s' % space.pk
+        entered = limiter.enter(key, limits['concurrency'])
+        if entered is False:
+            count('throttled')
+            return too_many_requests(1)
+        if entered:
+            request._space_in_flight = key
+    if limits.get('rate'):
+        wait = limiter.consume('spaces:rate:%s' % space.pk, limits['rate'],
+                               limits.get('burst') or limits['rate'])
+        if wait:
+            release(request)
+            count('throttled')
+            return too_many_requests(wait)
+    return None
+
+
+def release(request):
+    key = request.__dict__.pop('_space_in_flight', None)
+    if key is not None:
+        get_rate_limiter().leave(key)
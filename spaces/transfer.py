@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Moving spaces between installations.
+
+export_spaces() writes spaces as newline-delimited JSON, one object per
+line, reading the database with iterators so memory use doesn't grow with
+the size of a space:
+
+    {"format": "spaces", "version": 1}
+    {"model": "spaces.space", "pk": 3, "fields": {"name": ..., ...}}
+    {"model": "spaces.spacerole", "fields": {"role": "admins", "members": [["alice"]]}}
+    {"model": "demo.tracker", "pk": 7, "fields": {"space": 3, "active": true}}
+    {"model": "demo.ticket", "pk": 12, "fields": {"tracker": 7, "title": ...}}
+
+After each space follow its role memberships, its plugin rows (SpacePlugin
+rows as the plugin model they belong to) and the plugin data: all models
+with a cascading foreign key to a plugin model, which includes every
+SpaceModel. Foreign keys to exported objects hold the exported pk,
+foreign keys to other models with natural keys (like users) the natural
+key, anything else the plain pk. Many-to-many fields of plugin data are
+not exported.
+
+import_spaces() reads that back, creating new pks (and new slugs where
+they are taken) and inserting the plugin data with bulk_create() in
+batches. The search index of imported spaces is rebuilt.
+"""
+import json
+
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
+
+from .deletion import plugin_data_relations
+from .models import Space, SpacePlugin, SpacePluginStates, SpaceRole
+from .roles import ROLES, add_members
+from .routers import get_space_database
+from .search import rebuild_index
+from .util import chunked
+
+FORMAT_VERSION = 1
+
+
+class InvalidExport(ValueError):
+    """The input is no space export this version can read."""
+
+
+def model_label(model):
+    return model._meta.label_lower
+
+
+def plugin_child_models():
+    """Models inheriting directly from SpacePlugin."""
+    return [model for model in apps.get_models() if SpacePlugin in model._meta.parents]
+
+
+def plugin_models():
+    """All plugin models, SpacePlugin and its children first."""
+    models = [SpacePlugin] + plugin_child_models()
+    models.extend(model for model in SpacePluginStates.plugin_models() if model not in models)
+    return models
+
+
+def data_models():
+    """
+    Return {model: [names of foreign keys to plugin models]} for all plugin
+    data, models referenced by others first.
+    """
+    fields = {}
+    for plugin_model in plugin_models():
+        for model, field_name in plugin_data_relations(plugin_model):
+            fields.setdefault(model, [])
+            if field_name not in fields[model]:
+                fields[model].append(field_name)
+    ordered = []
+
+    def add(model, seen=()):
+        if model in ordered or model in seen:
+            return
+        for field in model._meta.concrete_fields:
+            if field.is_relation and field.related_model in fields:
+                add(field.related_model, seen + (model,))
+        ordered.append(model)
+
+    for model in fields:
+        add(model)
+    return [(model, fields[model]) for model in ordered]
+
+
+def exported_fields(model):
+    """The concrete fields of model exported besides the pk."""
+    return [field for field in model._meta.concrete_fields
+            if not field.primary_key and not getattr(field.remote_field, 'parent_link', False)]
+
+
+def encode_row(model, obj, exported):
+    values = {}
+    for field in exported_fields(model):
+        value = getattr(obj, field.attname)
+        if field.is_relation and value is not None and field.related_model not in exported \
+                and hasattr(field.related_model, 'natural_key'):
+            value = list(getattr(obj, field.name).natural_key())
+        values[field.name] = value
+    return {'model': model_label(model), 'pk': obj.pk, 'fields': values}
+
+
+def iter_space(space, batch_size=1000):
+    """Yield the rows of the space export, as dicts."""
+    data = data_models()
+    exported = set([Space] + plugin_models() + [model for model, names in data])
+    yield encode_row(Space, space, exported)
+
+    for role in ROLES:
+        members = space.get_role_users(role).order_by('pk').iterator(chunk_size=batch_size)
+        for chunk in chunked(members, batch_size):
+            yield {'model': model_label(SpaceRole), 'fields': {
+                'role': role, 'members': [list(user.natural_key()) for user in chunk]}}
+
+    database = get_space_database(space)
+    children = plugin_child_models()
+    bare = SpacePlugin._base_manager.db_manager(database).filter(space=space, **dict(
+        ('%s__isnull' % model._meta.parents[SpacePlugin].related_query_name(), True)
+        for model in children))
+    querysets = [(SpacePlugin, bare)] + [
+        (model, model._base_manager.db_manager(database).filter(space=space))
+        for model in plugin_models() if model is not SpacePlugin]
+    for model, field_names in data:
+        condition = models.Q()
+        for name in field_names:
+            condition |= models.Q(**{'%s__space' % name: space})
+        querysets.append((model, model._base_manager.db_manager(database).filter(condition)))
+
+    for model, queryset in querysets:
+        for obj in queryset.order_by('pk').iterator(chunk_size=batch_size):
+            yield encode_row(model, obj, exported)
+
+
+def export_spaces(spaces, out, batch_size=1000):
+    """
+    Write the spaces as newline-delimited JSON to the text stream out.
+    Returns the number of written rows.
+    """
+    written = 0
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    out.write(json.dumps({'format': 'spaces', 'version': FORMAT_VERSION}) + '\n')
+    for space in spaces:
+        for row in iter_space(space, batch_size):
+            out.write(encoder.encode(row) + '\n')
+            written += 1
+    return written
+
+
+class SpaceImporter(object):
+    """
+    Reads an export line by line. Rows of one model are collected into
+    batches of batch_size and inserted together; only the mapping of
+    exported to new pks is kept for the whole import.
+    """
+
+    def __init__(self, created_by=None, batch_size=1000):
+        self.created_by = created_by
+        self.batch_size = batch_size
+        data = [model for model, names in data_models()]
+        self.models = dict((model_label(model), model)
+                           for model in [Space] + plugin_models() + data)
+        # models whose new pks are needed for rows referencing them
+        self.referenced = set(plugin_models())
+        for model in data:
+            self.referenced.update(field.related_model for field in exported_fields(model)
+                                   if field.is_relation)
+        self.pks = {}
+        self.natural = {}
+        self.spaces = []
+        self.batch = []
+        self.batch_model = None
+
+    def run(self, lines):
+        lines = iter(lines)
+        header = self.parse(next(lines, '{}'))
+        if header.get('format') != 'spaces' or header.get('version') != FORMAT_VERSION:
+            raise InvalidExport('Not a space export of version %d.' % FORMAT_VERSION)
+        for line in lines:
+            if line.strip():
+                self.add(self.parse(line))
+        self.flush()
+        for space in self.spaces:
+            rebuild_index(space, batch_size=self.batch_size)
+        return self.spaces
+
+    def parse(self, line):
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            raise InvalidExport('Invalid line: %s' % e)
+
+    def add(self, row):
+        label = row.get('model')
+        if label == model_label(SpaceRole):
+            self.flush()
+            self.add_members(row['fields'])
+            return
+        model = self.models.get(label)
+        if model is None:
+            raise InvalidExport('Unknown model %s.' % label)
+        if model is not self.batch_model or len(self.batch) >= self.batch_size:
+            self.flush()
+        self.batch_model = model
+        self.batch.append(row)
+        if model is Space:
+            self.flush()
+
+    def resolve(self, field, value):
+        """Turn an exported foreign key value into a pk of this database."""
+        target = field.related_model
+        if value is None:
+            return None
+        if isinstance(value, list):
+            key = (target, tuple(value))
+            if key not in self.natural:
+                try:
+                    obj = target._default_manager.get_by_natural_key(*value)
+                except target.DoesNotExist:
+                    raise InvalidExport('Unknown %s %s.' % (model_label(target), ', '.join(value)))
+                self.natural[key] = obj.pk
+            return self.natural[key]
+        if model_label(target) in self.models:
+            try:
+                return self.pks[model_label(target), value]
+            except KeyError:
+                raise InvalidExport('%s %s is referenced before it was imported.'
+                                  % (model_label(target), value))
+        return value
+
+    def build(self, model, row):
+        obj = model()
+        for name, value in row['fields'].items():
+            field = model._meta.get_field(name)
+            if field.is_relation:
+                setattr(obj, field.attname, self.resolve(field, value))
+            else:
+                setattr(obj, field.attname, field.to_python(value))
+        return obj
+
+    def remember(self, model, old_pk, new_pk):
+        for label in [model] + model._meta.get_parent_list():
+            self.pks[model_label(label), old_pk] = new_pk
+
+    def flush(self):
+        model, rows = self.batch_model, self.batch
+        self.batch, self.batch_model = [], None
+        if not rows:
+            return
+        if model is Space:
+            return self.import_space(rows[0])
+        objects = [self.build(model, row) for row in rows]
+        # bulk_create() doesn't support table inheritance, and doesn't
+        # return the new pks on every database
+        with transaction.atomic():
+            if model._meta.parents or (model in self.referenced and
+                                       not connection.features.can_return_rows_from_bulk_insert):
+                for obj in objects:
+                    obj.save(force_insert=True)
+            else:
+                model._base_manager.bulk_create(objects)
+        for row, obj in zip(rows, objects):
+            if obj.pk is not None:
+                self.remember(model, row['pk'], obj.pk)
+
+    def import_space(self, row):
+        fields = dict(row['fields'])
+        created_at = fields.pop('created_at', None)
+        if self.created_by is not None:
+            fields['created_by'] = list(self.created_by.natural_key())
+        space = self.build(Space, {'fields': fields})
+        if Space.objects.filter(slug=space.slug).exists():
+            space.slug = ''  # Space.save() picks a free one
+        space.save()
+        if created_at is not None:
+            Space.objects.filter(pk=space.pk).update(
+                created_at=Space._meta.get_field('created_at').to_python(created_at))
+        self.remember(Space, row['pk'], space.pk)
+        self.spaces.append(space)
+
+    def add_members(self, fields):
+        if not self.spaces:
+            raise InvalidExport('Role members before the first space.')
+        usernames = [key[0] for key in fields['members']]
+        user_ids = list(User.objects.filter(username__in=usernames).values_list('pk', flat=True))
+        add_members(self.spaces[-1], user_ids, fields['role'], batch_size=self.batch_size)
+
+
+def import_spaces(lines, created_by=None, batch_size=1000):
+    """
+    Import the spaces of an export, given as iterable of lines. Users are
+    looked up by username, members missing here are skipped; pass
+    created_by to own the new spaces by another user than the exported one.
+    Returns the new spaces.
+    """
+    return SpaceImporter(created_by, batch_size).run(lines)
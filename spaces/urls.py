@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
-import re
-from django.urls import URLResolver, URLPattern, LocalePrefixPattern
+from django.urls import URLResolver, LocalePrefixPattern
 from django.conf.urls import url
 
 from .models import Space
@@ -14,16 +13,40 @@ def space_patterns(*urls, app_name=None):
     """
     return [
         SpaceURLResolver(
-            LocalePrefixPattern(prefix_default_language=False),
+            SpacePrefixPattern(),
             list(urls), 
             app_name=app_name
         )
     ]
 
 
+class SpacePrefixPattern(LocalePrefixPattern):
+    """
+    Variant of django.urls.LocalePrefixPattern, matching the prefix of the
+    currently active space. Matching is a plain string comparison, no
+    regular expression is compiled per space.
+    """
+
+    def __init__(self):
+        super(SpacePrefixPattern, self).__init__(prefix_default_language=False)
+
+    @property
+    def language_prefix(self):
+        prefix = util.get_space_prefix()
+        if prefix is None:  # this happens if reverse is called while we
+                            # are not yet inside a space (e.g. a template
+                            # wants a deeplink into another space
+            return ''
+        return '%s/' % prefix
+
+
 class SpaceURLResolver(URLResolver):
     """
     Variant of django.core.urlresolvers.LocaleRegexURLResolver.
+
+    The reverse lookups of the resolver itself don't contain the space
+    prefix (the parent resolver adds it), so they are populated once and
+    shared by all spaces.
     """
     def __init__(self, pattern, urlconf_name, default_kwargs=None,
                  app_name=None, namespace=None):
@@ -31,17 +54,21 @@ class SpaceURLResolver(URLResolver):
         super(SpaceURLResolver, self).__init__(
             pattern, urlconf_name, default_kwargs, app_name, namespace)
 
+    def _populate(self):
+        with util.override(None):
+            super(SpaceURLResolver, self)._populate()
 
     @property
-    def regex(self):
-        prefix = util.get_space_prefix()
-        if prefix not in self._regex_dict:
-            if prefix is None:  # this happens if reverse is called while we
-                                # are not yet inside a space (e.g. a template
-                                # wants a deeplink into another space
-                compiled_regex = re.compile(''.format(prefix), re.UNICODE)
-            else:
-                compiled_regex = re.compile('^{}/'.format(prefix), re.UNICODE)
-            self._regex_dict[prefix] = compiled_regex
-#        print(self._regex_dict)
-        return self._regex_dict[prefix]
\ No newline at end of file
+    def reverse_dict(self):
+        with util.override(None):
+            return super(SpaceURLResolver, self).reverse_dict
+
+    @property
+    def namespace_dict(self):
+        with util.override(None):
+            return super(SpaceURLResolver, self).namespace_dict
+
+    @property
+    def app_dict(self):
+        with util.override(None):
+            return super(SpaceURLResolver, self).app_dict
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
-from threading import local
-_space = local()
+from contextvars import ContextVar
+from itertools import islice
+
+# A context variable instead of a thread local: under ASGI several
+# requests share one thread, but every request runs in its own context.
+_space = ContextVar('space', default=None)
 
 def get_space(): # das war mal get_country
     """Return the currently selected space or None."""
-    return getattr(_space, 'value', None)
+    return _space.get()
 
 def get_space_prefix():
         """
@@ -17,22 +21,72 @@ def get_space_prefix():
         return space_slug
 
 
+class SpaceActivation(object):
+    """
+    Returned by activate() and deactivate(). When used as context manager,
+    the previously selected space is restored on exit.
+    """
+
+    def __init__(self, token):
+        self.token = token
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _space.reset(self.token)
+
+
 def activate(space_slug):
     """
-    Select the space for the current thread
+    Select the space for the current context, e.g.
+
+        activate('my-space')
+
+    or, to switch back to the previous space afterwards,
+
+        with activate('my-space'):
+            ...
     """
-    _space.value = space_slug
+    return SpaceActivation(_space.set(space_slug))
 
 
 def deactivate():
-    """Remove the space for the current thread."""
-    if hasattr(_space, "value"):
-        del _space.value
+    """Remove the space for the current context. Works like activate()."""
+    return SpaceActivation(_space.set(None))
+
+
+def override(space_slug):
+    """
+    Temporarily select another space (or none, if space_slug is None)
+    """
+    if space_slug is None:
+        return deactivate()
+    return activate(space_slug)
 
 def is_space_admin(user, space):
     """
     Returns True if the user has the admin role in the given space.
     Returns False otherwise.
     """
-    is_admin = user in space.get_admins().user_set.all()
-    return is_admin
\ No newline at end of file
+    from .roles import SpaceRoles
+    return SpaceRoles.for_user(user).is_admin(space)
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most size items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def percentile(values, pct):
+    """
+    Return the pct-th percentile (nearest rank) of a non-empty sequence.
+    """
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
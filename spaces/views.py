@@ -1,4 +1,27 @@
 # -*- coding: utf-8 -*-
+from django.core.exceptions import PermissionDenied
+from django.http import Http404
 from django.shortcuts import render
 
-# Create your views here.
+from .search import search
+
+
+def search_view(request, template_name='spaces/search.html'):
+    """
+    Search the current space. Expects the query in the "q" and the page
+    number in the "page" GET parameter. django-spaces doesn't route it,
+    add it to the space_patterns() of your URLconf:
+
+        path('search/', search_view, name='space_search'),
+    """
+    if request.SPACE is None:
+        raise Http404
+    if not request.user.has_perm('spaces.access_space', request.SPACE):
+        raise PermissionDenied
+    query = request.GET.get('q', '').strip()
+    page = search(request.SPACE, query, page=request.GET.get('page', 1))
+    return render(request, template_name, {
+        'query': query,
+        'page': page,
+        'hits': page.object_list,
+    })